@@ -0,0 +1,130 @@
+import asyncio
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, List, Dict, Optional
+
+from ismcore.model.base_model import ProcessorStateDirection
+from ismcore.model.processor_state import State
+from ismcore.utils.ism_logger import ism_logger
+
+# the database driver is imported once a storage is created, not by every module importing the facade
+if TYPE_CHECKING:
+    from ismdb.postgres_storage_class import PostgresDatabaseStorage
+
+logger = ism_logger(__name__)
+
+
+def create_postgres_storage(database_url: str, max_concurrency: int) -> 'PostgresDatabaseStorage':
+    """
+    Create the postgres storage with a thread-safe connection pool.
+
+    ismdb shares a single SimpleConnectionPool per database url, which is not safe to use from
+    more than one thread, so the pool is seeded with a ThreadedConnectionPool sized for every
+    executor worker before the storage classes pick it up.
+
+    No connection is opened here, they are opened by AsyncStorage.prewarm (or on first use), and one
+    connection per executor worker is kept open once returned to the pool.
+    """
+    from ismdb.base import BaseDatabaseAccessSinglePool, MIN_DB_CONNECTIONS, MAX_DB_CONNECTIONS
+    from ismdb.postgres_storage_class import PostgresDatabaseStorage
+    from psycopg2.pool import ThreadedConnectionPool
+
+    if database_url not in BaseDatabaseAccessSinglePool._pools:
+        max_connections = max(MAX_DB_CONNECTIONS, max_concurrency + 1)
+        logger.info(f"establishing threaded connection pool with max connections: {max_connections}")
+        connection_pool = ThreadedConnectionPool(0, max_connections, database_url)
+        connection_pool.minconn = max(MIN_DB_CONNECTIONS, max_concurrency)    # idle connections kept open
+        BaseDatabaseAccessSinglePool._pools[database_url] = connection_pool
+
+    return PostgresDatabaseStorage(database_url=database_url, incremental=True)
+
+
+class AsyncStorage:
+    """
+    Async facade over the synchronous storage class.
+
+    Blocking storage calls run on a bounded thread pool so the event loop keeps fetching and
+    publishing messages while a batch is persisted. Writes to the same state are serialized by a
+    per state_id lock, writes to different states run concurrently up to max_concurrency.
+    """
+
+    def __init__(self, storage: 'PostgresDatabaseStorage', max_concurrency: int = 4):
+        self.storage = storage
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="state-sync-storage"
+        )
+
+        # locks are only kept alive while a caller holds a reference to them
+        self.state_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    def state_lock(self, state_id: str) -> asyncio.Lock:
+        lock = self.state_locks.get(state_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.state_locks[state_id] = lock
+        return lock
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def fetch_processor_state_route(self, route_id: str = None, state_id: str = None,
+                                          direction: ProcessorStateDirection = None):
+        return await self.run(
+            self.storage.fetch_processor_state_route,
+            route_id=route_id,
+            state_id=state_id,
+            direction=direction
+        )
+
+    async def fetch_processor(self, processor_id: str):
+        return await self.run(self.storage.fetch_processor, processor_id=processor_id)
+
+    async def fetch_processor_provider(self, id: str):
+        return await self.run(self.storage.fetch_processor_provider, id=id)
+
+    async def load_state(self, state_id: str, load_data: bool = True) -> Optional[State]:
+        return await self.run(self.storage.load_state, state_id=state_id, load_data=load_data)
+
+    async def save_state(self, state: State) -> State:
+        async with self.state_lock(state.id):
+            return await self.run(self.storage.save_state, state=state)
+
+    async def append_state_data_direct(self, state_id: str, query_states: List[Dict],
+                                       scope_variable_mappings: dict = None) -> Optional[State]:
+        async with self.state_lock(state_id):
+            return await self.run(
+                self.storage.append_state_data_direct,
+                state_id=state_id,
+                query_states=query_states,
+                scope_variable_mappings=scope_variable_mappings
+            )
+
+    def ping(self, connections: int = 1):
+        """Check out a number of pooled connections at once (opening them if needed) and query each."""
+        from state_tables import state_storage_of
+
+        connection_pool = state_storage_of(self.storage) or self.storage
+        checked_out = []
+        try:
+            for _ in range(connections):
+                connection = connection_pool.create_connection()
+                checked_out.append(connection)
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+        finally:
+            for connection in checked_out:
+                connection_pool.release_connection(connection)
+
+    async def prewarm(self):
+        """
+        Open a pooled connection for every storage thread, such that the first batches do not wait for the
+        connections to be established. Raises if the database cannot be reached.
+        """
+        await self.run(self.ping, connections=self.max_concurrency)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
@@ -1,12 +0,0 @@
-def memoize(func):
-    cache = {}
-
-    def wrapper(*args):
-        if args in cache:
-            return cache[args]
-        else:
-            result = func(*args)
-            cache[args] = result
-            return result
-
-    return wrapper
\ No newline at end of file
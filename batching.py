@@ -0,0 +1,116 @@
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from ismcore.utils.ism_logger import ism_logger
+
+logger = ism_logger(__name__)
+
+
+class PendingGroup:
+    """Messages of a group (route_id) that are buffered until the group is flushed."""
+
+    def __init__(self, group_key: str):
+        self.group_key = group_key
+        self.messages: List[Any] = []   # raw (nats) messages, acked once the group is processed
+        self.data: List[dict] = []      # the parsed messages
+        self.keys: List[Any] = []       # dedup keys of the messages, marked once the group is persisted
+        self.rows = 0                   # number of query state entries
+        self.bytes = 0                  # raw payload size
+        self.created_at = time.monotonic()
+
+    def add(self, msg: Any, data: dict, size: int, key: Any = None):
+        query_state = data.get('query_state') if isinstance(data, dict) else None
+        self.messages.append(msg)
+        self.data.append(data)
+        if key is not None:
+            self.keys.append(key)
+        self.rows += len(query_state) if isinstance(query_state, list) else 1
+        self.bytes += size
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created_at
+
+
+class AdaptiveBatchSizer:
+    """
+    Adaptive batch window, decides when a pending group is flushed and tunes the target row count
+    from the latency of recent persistence calls.
+
+    A group is flushed when it reaches the target row count, the max byte size or the max linger
+    time, whichever comes first. The target row count grows while persists complete well within the
+    target latency and shrinks when they exceed it (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self,
+                 initial_rows: int = 100,
+                 min_rows: int = 10,
+                 max_rows: int = 5000,
+                 max_bytes: int = 4 * 1024 * 1024,
+                 max_linger: float = 0.25,
+                 target_latency: float = 0.2,
+                 smoothing: float = 0.3):
+
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.target_rows = max(min_rows, min(initial_rows, max_rows))
+
+        # persist latency, exponentially weighted moving average in seconds
+        self.latency_ewma: Optional[float] = None
+
+        # metrics: flushes by trigger and the recently flushed batch sizes (rows)
+        self.flushes: Dict[str, int] = {"rows": 0, "bytes": 0, "linger": 0}
+        self.recent_sizes: deque = deque(maxlen=256)
+
+    def flush_trigger(self, group: PendingGroup) -> Optional[str]:
+        if group.rows >= self.target_rows:
+            return "rows"
+        if group.bytes >= self.max_bytes:
+            return "bytes"
+        if group.age >= self.max_linger:
+            return "linger"
+        return None
+
+    def next_deadline(self, groups: List[PendingGroup]) -> Optional[float]:
+        """Seconds until the oldest pending group lingers long enough to be flushed."""
+        if not groups:
+            return None
+        return max(0.0, self.max_linger - max(group.age for group in groups))
+
+    def record_flush(self, group: PendingGroup, trigger: str):
+        self.flushes[trigger] += 1
+        self.recent_sizes.append(group.rows)
+
+    def record_persist(self, rows: int, seconds: float):
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma = self.smoothing * seconds + (1 - self.smoothing) * self.latency_ewma
+
+        previous = self.target_rows
+        if self.latency_ewma > self.target_latency:
+            self.target_rows = max(self.min_rows, int(self.target_rows * 0.75))
+        elif self.latency_ewma < self.target_latency / 2 and rows >= self.target_rows / 2:
+            # only grow when batches actually fill up, otherwise the linger time is what flushes
+            self.target_rows = min(self.max_rows, self.target_rows + max(1, self.target_rows // 4))
+
+        if self.target_rows != previous:
+            logger.info(
+                f'adjusted batch target from {previous} to {self.target_rows} rows, '
+                f'persist latency: {self.latency_ewma * 1000:.1f}ms'
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        sizes = sorted(self.recent_sizes)
+        return {
+            "target_rows": self.target_rows,
+            "latency_ewma": self.latency_ewma,
+            "flushes": dict(self.flushes),
+            "recent_size_p50": sizes[len(sizes) // 2] if sizes else 0,
+            "recent_size_max": sizes[-1] if sizes else 0,
+        }
@@ -0,0 +1,294 @@
+import asyncio
+import copy
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from ismcore.messaging.base_message_route_model import MessageStatus, RouteMessageStatus
+from ismcore.model.base_model import Processor, ProcessorProvider, ProcessorState, ProcessorStateDirection
+from ismcore.model.processor_state import State, StateConfig, StateDataRowColumnData
+
+
+class Latency:
+    """Injected latency of a fake, a fixed cost per call plus a cost per row."""
+
+    def __init__(self, call: float = 0.0, row: float = 0.0):
+        self.call = call
+        self.row = row
+
+    def sleep(self, rows: int = 0):
+        seconds = self.call + self.row * rows
+        if seconds > 0:
+            time.sleep(seconds)
+
+    async def async_sleep(self, rows: int = 0):
+        seconds = self.call + self.row * rows
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+
+class FakeCursor:
+
+    def __init__(self, storage: 'FakeStorage', connection: 'FakeConnection'):
+        self.storage = storage
+        self.connection = connection
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        sql = sql.decode() if isinstance(sql, bytes) else sql
+        self.storage.record('execute')
+        self.storage.latency.sleep()
+
+        # the only statement whose effect is read back, the state count
+        if sql.startswith("UPDATE state SET count = count +"):
+            rows, state_id = params
+            self.result = None
+            if state_id in self.storage.states:
+                with self.storage.lock:
+                    self.storage.states[state_id].count += rows
+                    self.result = (self.storage.states[state_id].count,)
+
+    def fetchone(self):
+        return self.result
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        self.storage.record('executemany')
+        self.storage.latency.sleep(rows=len(rows))
+
+    def mogrify(self, template, args):
+        return repr(tuple(args)).encode()
+
+    def copy_expert(self, sql, file, size: int = 8192):
+        self.storage.record('copy')
+        rows = 0
+        while chunk := file.read(size):
+            rows += chunk.count(b'\n')
+        self.storage.latency.sleep(rows=rows)
+
+
+class FakeConnection:
+
+    def __init__(self, storage: 'FakeStorage'):
+        self.storage = storage
+        self.autocommit = True
+        self.encoding = 'UTF8'
+
+    def cursor(self):
+        return FakeCursor(self.storage, self)
+
+    def commit(self):
+        self.storage.record('commit')
+
+    def rollback(self):
+        self.storage.record('rollback')
+
+
+class FakeStateStorage:
+    """Stand-in of the database state storage, exposing the connection pool used by the state writer."""
+
+    def __init__(self, storage: 'FakeStorage'):
+        self.storage = storage
+
+    def create_connection(self):
+        return FakeConnection(self.storage)
+
+    def release_connection(self, connection):
+        pass
+
+
+class FakeStorage:
+    """
+    In-memory stand-in of the postgres storage class, with injected latency per call and per row.
+
+    Only state metadata (config, columns and count) is kept, row data is counted but not stored,
+    such that the benchmarks measure the consumer rather than the fake.
+    """
+
+    def __init__(self, latency: Latency = None):
+        self.latency = latency or Latency()
+        self.states: Dict[str, State] = {}
+        self.routes: Dict[str, ProcessorState] = {}
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.lock = threading.Lock()
+        self.next_column_id = 1
+        self._delegate_state_storage = FakeStateStorage(self)
+
+    def record(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+    def call(self, name: str, rows: int = 0):
+        self.record(name)
+        self.latency.sleep(rows=rows)
+
+    def add_state(self, state_id: str, properties: dict = None):
+        if state_id not in self.states:
+            self.states[state_id] = State(id=state_id, config=StateConfig(name=state_id), properties=properties)
+
+    def add_route(self, route_id: str, state_id: str, direction=ProcessorStateDirection.OUTPUT,
+                  processor_id: str = "processor"):
+        self.routes[route_id] = ProcessorState(
+            id=route_id,
+            state_id=state_id,
+            processor_id=processor_id,
+            direction=direction
+        )
+
+    def copy_state(self, state_id: str) -> Optional[State]:
+        stored = self.states.get(state_id)
+        if not stored:
+            return None
+
+        state = State(
+            id=stored.id,
+            config=stored.config,
+            properties=stored.properties,
+            count=stored.count,
+            columns=copy.deepcopy(stored.columns)
+        )
+        state.persisted_position = state.count - 1
+        return state
+
+    # processor and route metadata
+
+    def fetch_processor_state_route(self, route_id: str = None, state_id: str = None,
+                                    direction: ProcessorStateDirection = None, **kwargs) -> Optional[List[ProcessorState]]:
+        self.call('fetch_processor_state_route')
+        if route_id:
+            return [self.routes[route_id]] if route_id in self.routes else None
+
+        return [
+            route for route in self.routes.values()
+            if route.state_id == state_id and (direction is None or route.direction == direction)
+        ] or None
+
+    def fetch_processor(self, processor_id: str) -> Processor:
+        self.call('fetch_processor')
+        return Processor(id=processor_id, project_id="project", provider_id="provider")
+
+    def fetch_processor_provider(self, id: str) -> ProcessorProvider:
+        self.call('fetch_processor_provider')
+        return ProcessorProvider(id=id, name="provider", version="1", class_name="benchmark")
+
+    # state metadata and data
+
+    def fetch_state(self, state_id: str) -> Optional[State]:
+        self.call('fetch_state')
+        return self.copy_state(state_id)
+
+    def load_state_metadata(self, state_id: str) -> Optional[State]:
+        self.call('load_state_metadata')
+        return self.copy_state(state_id)
+
+    def load_state_columns(self, state_id: str):
+        self.call('load_state_columns')
+        return copy.deepcopy(self.states[state_id].columns)
+
+    def load_state_data(self, columns: dict, state_count: int, offset: int = None, limit: int = 1000):
+        rows = state_count if offset is None else max(0, min(limit, state_count - offset))
+        self.call('load_state_data', rows=rows * len(columns))
+        return {column: StateDataRowColumnData(values=[None] * rows, count=rows) for column in columns}
+
+    def load_state_data_mappings(self, state_id: str, offset: int = None, limit: int = 1000):
+        self.call('load_state_data_mappings')
+        return None
+
+    def load_state(self, state_id: str, load_data: bool = True, **kwargs) -> Optional[State]:
+        state = self.copy_state(state_id)
+        self.call('load_state', rows=state.count * len(state.columns or {}) if state and load_data else 0)
+        if state and load_data:
+            state.data = {
+                column: StateDataRowColumnData(values=[None] * state.count, count=state.count)
+                for column in state.columns or {}
+            }
+        return state
+
+    def insert_state_columns(self, state: State, force_update: bool = False):
+        self.call('insert_state_columns')
+        with self.lock:
+            for column in (state.columns or {}).values():
+                if column.id is None:
+                    column.id = self.next_column_id
+                    self.next_column_id += 1
+            self.states[state.id].columns = copy.deepcopy(state.columns)
+
+    def save_state(self, state: State, options: dict = None) -> State:
+        rows = state.count - (state.persisted_position + 1)
+        self.call('save_state', rows=rows * len(state.columns or {}))
+        self.insert_state_columns(state)
+        self.states[state.id].count = state.count
+        state.persisted_position = state.count - 1
+        return state
+
+    def append_state_data_direct(self, state_id: str, query_states: List[Dict],
+                                 scope_variable_mappings: dict = None, **kwargs) -> Optional[State]:
+        state = self.load_state_metadata(state_id)
+        if not state:
+            return None
+
+        for entry in query_states:
+            state.apply_query_state(query_state=entry, skip_data_append=True,
+                                    scope_variable_mappings=scope_variable_mappings or {})
+
+        self.insert_state_columns(state)
+        self.call('append_state_data_direct', rows=len(query_states) * len(state.columns or {}))
+        state.count += len(query_states)
+        state.persisted_position = state.count - 1
+        self.states[state_id].count = state.count
+        return state
+
+
+class FakeMessage:
+    """A consumed message, along with the times it was delivered and acked."""
+
+    def __init__(self, index: int, data: bytes):
+        self.index = index
+        self.data = data
+        self.delivered_at: Optional[float] = None
+        self.acked_at: Optional[float] = None
+
+    @property
+    def latency(self) -> Optional[float]:
+        if self.delivered_at is None or self.acked_at is None:
+            return None
+        return self.acked_at - self.delivered_at
+
+
+class FakeRoute:
+    """Stand-in of a nats route, for acking consumed messages and publishing forwarded query states."""
+
+    def __init__(self, latency: Latency = None, subject: str = "benchmark"):
+        self.latency = latency or Latency()
+        self.subject = subject
+        self.published = 0
+        self.flushes = 0
+
+    async def connect(self) -> bool:
+        await self.latency.async_sleep()
+        return True
+
+    def get_message_id(self, msg: FakeMessage) -> int:
+        return msg.index
+
+    def friendly_message(self, message: Any) -> str:
+        return str(getattr(message, 'index', message))
+
+    async def ack(self, msg: FakeMessage) -> bool:
+        msg.acked_at = time.perf_counter()
+        return True
+
+    async def publish(self, msg: Any, subject: str = None) -> RouteMessageStatus:
+        await self.latency.async_sleep()
+        self.published += 1
+        return RouteMessageStatus(id=str(self.published), message=None, status=MessageStatus.QUEUED)
+
+    async def flush(self):
+        self.flushes += 1
@@ -0,0 +1,256 @@
+"""
+Offline benchmark of the state sync consumer, against an in-memory route and storage with injected latency.
+
+    python -m benchmarks.run --mode all --messages 2000 --rows 10 --storage-latency-ms 2
+    python -m benchmarks.run --mode batch --workload recorded.jsonl --output results.json
+
+Replays a synthetic or recorded workload (one query_state_route / query_state_direct message per line)
+through the standard, lightweight and batch consumers, and reports throughput and p50/p99 latency from
+the delivery of a message to its ack.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from typing import List, Dict, Optional
+
+# no network and no noise: a local routing file and warnings only, before the consumer modules are imported
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault("ROUTING_FILE", os.path.join(BENCHMARK_DIR, "routing.yaml"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from pydantic import PrivateAttr   # noqa: E402
+
+from benchmarks.fakes import FakeMessage, FakeRoute, FakeStorage, Latency    # noqa: E402
+from benchmarks.workload import HOT_ROUTE_ID, generate_workload, load_workload, register_workload   # noqa: E402
+from codec import json_codec    # noqa: E402
+from main import MessagingStateSyncConsumer    # noqa: E402
+from message_router import get_state_sync_route    # noqa: E402
+from route_batch import StateSyncRouteBatch    # noqa: E402
+from scheduling import SCHEDULERS, parse_priority_classes    # noqa: E402
+from services import StateSyncServices    # noqa: E402
+
+MODES = ["standard", "lightweight", "batch"]
+
+
+class BenchmarkRouteBatch(StateSyncRouteBatch):
+    """Batch route that fetches from an in-memory queue, and stops once the queue is drained."""
+
+    _queue: deque = PrivateAttr(default_factory=deque)
+
+    def enqueue(self, messages: List[FakeMessage]):
+        self._queue.extend(messages)
+
+    async def fetch(self, timeout: float) -> list:
+        if not self._queue:
+            if not self._pending:
+                self.consumer_active = False
+            else:
+                await asyncio.sleep(timeout)    # lingering groups, as if no messages arrived
+            return []
+
+        now = time.perf_counter()
+        messages = []
+        while self._queue and len(messages) < self.batch_size:
+            message = self._queue.popleft()
+            message.delivered_at = now
+            messages.append(message)
+
+        await asyncio.sleep(0)
+        return messages
+
+    async def ack(self, msg: FakeMessage, **kwargs) -> bool:
+        msg.acked_at = time.perf_counter()
+        return True
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def replay_messages(consumer: MessagingStateSyncConsumer, messages: List[FakeMessage], concurrency: int):
+    """Deliver the messages one by one to on_receive, with up to concurrency messages in flight."""
+    route = FakeRoute()
+    queue = deque(messages)
+
+    async def worker():
+        while queue:
+            message = queue.popleft()
+            message.delivered_at = time.perf_counter()
+            await consumer.on_receive(route, message, message.data)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+async def replay_batches(consumer: MessagingStateSyncConsumer, messages: List[FakeMessage], batch_size: int,
+                         max_in_flight: int, persist_workers: int, scheduler: str, group_max_concurrency: int):
+    """Deliver the messages to the batch route, fetch by fetch, as the batch consumer does."""
+    route = BenchmarkRouteBatch.from_route(
+        route=get_state_sync_route().clone({"batch_size": batch_size}),
+        batch_callback=consumer.on_receive_batch,
+        group_by_fn=consumer.batch_group_key,
+        batch_sizer=consumer.batch_sizer,
+        max_in_flight=max_in_flight,
+        persist_workers=persist_workers,
+        dedup=consumer.dedup_window,
+        scheduler=scheduler,
+        group_max_concurrency=group_max_concurrency,
+        priority_classes=parse_priority_classes(""),
+        priority_fn=consumer.group_priority
+    )
+    route.enqueue(messages)
+    await route.consume()
+
+
+async def run_mode(mode: str, workload: List[Dict], args) -> Dict:
+    storage = FakeStorage(latency=Latency(call=args.storage_latency_ms / 1000, row=args.row_latency_us / 1e6))
+    register_workload(
+        storage=storage,
+        workload=workload,
+        states=args.states,
+        forward_routes=args.forward_routes,
+        dispatch=args.dispatch
+    )
+
+    router_route = FakeRoute(latency=Latency(call=args.publish_latency_ms / 1000))
+    services = StateSyncServices(
+        storage=storage,
+        router_route=router_route,
+        max_concurrency=args.storage_concurrency,
+        adaptive_batch=args.adaptive
+    )
+    consumer = MessagingStateSyncConsumer(
+        route=get_state_sync_route(),
+        monitor_route=None,
+        services=services,
+        lightweight=mode != "standard"
+    )
+
+    messages = [
+        FakeMessage(index=index, data=json_codec.dumps(message).encode('utf-8'))
+        for index, message in enumerate(workload)
+    ]
+
+    started = time.perf_counter()
+    try:
+        if mode == "batch":
+            await replay_batches(
+                consumer,
+                messages,
+                batch_size=args.batch_size,
+                max_in_flight=args.max_in_flight,
+                persist_workers=args.persist_workers,
+                scheduler=args.scheduler,
+                group_max_concurrency=args.group_max_concurrency
+            )
+        else:
+            await replay_messages(consumer, messages, concurrency=args.concurrency)
+    finally:
+        services.shutdown()
+    elapsed = time.perf_counter() - started
+
+    latencies = [message.latency for message in messages if message.latency is not None]
+    cold_latencies = [
+        message.latency for message, payload in zip(messages, workload)
+        if message.latency is not None and payload.get('route_id') != HOT_ROUTE_ID
+    ]
+    rows = sum(len(message.get('query_state') or []) for message in workload)
+    return {
+        "mode": mode,
+        "messages": len(messages),
+        "acked": len(latencies),
+        "rows": rows,
+        "seconds": elapsed,
+        "messages_per_second": len(messages) / elapsed if elapsed else 0.0,
+        "rows_per_second": rows / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p99_cold_ms": percentile(cold_latencies, 0.99) * 1000,
+        "storage_calls": sum(storage.calls.values()),
+        "storage_calls_by_name": dict(storage.calls),
+        "published": router_route.published,
+    }
+
+
+def print_results(results: List[Dict]):
+    header = f'{"mode":<12} {"msgs":>7} {"acked":>7} {"rows":>8} {"msg/s":>10} {"rows/s":>11} ' \
+             f'{"p50 ms":>9} {"p99 ms":>9} {"p99 cold":>9} {"db calls":>9} {"published":>10}'
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f'{result["mode"]:<12} {result["messages"]:>7} {result["acked"]:>7} {result["rows"]:>8} '
+              f'{result["messages_per_second"]:>10.1f} {result["rows_per_second"]:>11.1f} '
+              f'{result["p50_ms"]:>9.2f} {result["p99_ms"]:>9.2f} {result["p99_cold_ms"]:>9.2f} '
+              f'{result["storage_calls"]:>9} {result["published"]:>10}')
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="offline benchmark of the state sync consumer")
+    parser.add_argument("--mode", choices=MODES + ["all"], default="all")
+    parser.add_argument("--workload", help="recorded workload, one consumed message per line (jsonl)")
+    parser.add_argument("--messages", type=int, default=1000, help="synthetic workload: number of messages")
+    parser.add_argument("--rows", type=int, default=10, help="synthetic workload: query state rows per message")
+    parser.add_argument("--routes", type=int, default=8, help="synthetic workload: number of routes")
+    parser.add_argument("--states", type=int, default=4, help="number of states the routes are spread over")
+    parser.add_argument("--direct-ratio", type=float, default=0.0,
+                        help="synthetic workload: fraction of query_state_direct messages")
+    parser.add_argument("--hot-ratio", type=float, default=0.0,
+                        help=f"synthetic workload: fraction of the route messages of the hot route ({HOT_ROUTE_ID}), "
+                             f"the p99 cold latency is that of the other messages")
+    parser.add_argument("--forward-routes", type=int, default=1, help="downstream routes per state")
+    parser.add_argument("--dispatch", default="batch", help="routing dispatch of the states")
+    parser.add_argument("--storage-latency-ms", type=float, default=1.0, help="latency per storage call")
+    parser.add_argument("--row-latency-us", type=float, default=5.0, help="latency per written or loaded cell")
+    parser.add_argument("--publish-latency-ms", type=float, default=0.1, help="latency per published message")
+    parser.add_argument("--storage-concurrency", type=int, default=4, help="storage threads")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="messages in flight for the standard and lightweight modes")
+    parser.add_argument("--batch-size", type=int, default=100, help="messages per fetch in batch mode")
+    parser.add_argument("--max-in-flight", type=int, default=800,
+                        help="messages not yet acked before the batch mode stops fetching, 0 is unbounded")
+    parser.add_argument("--persist-workers", type=int, default=4, help="groups persisted concurrently in batch mode")
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default="fifo",
+                        help="scheduling of the ready groups in batch mode")
+    parser.add_argument("--group-max-concurrency", type=int, default=0,
+                        help="workers persisting the groups of a single route at once in batch mode, 0 is unbounded")
+    parser.add_argument("--adaptive", action="store_true", help="use the adaptive batch window in batch mode")
+    parser.add_argument("--output", help="write the results as json, e.g. to compare against a baseline")
+    return parser.parse_args(argv)
+
+
+async def run(args) -> List[Dict]:
+    if args.workload:
+        workload = load_workload(args.workload)
+    else:
+        workload = generate_workload(
+            messages=args.messages,
+            rows=args.rows,
+            routes=args.routes,
+            states=args.states,
+            direct_ratio=args.direct_ratio,
+            hot_ratio=args.hot_ratio
+        )
+
+    modes = MODES if args.mode == "all" else [args.mode]
+    return [await run_mode(mode, workload, args) for mode in modes]
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"args": vars(args), "results": results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import json
+import random
+import zlib
+from typing import List, Dict
+
+from ismcore.model.base_model import ProcessorStateDirection
+
+from benchmarks.fakes import FakeStorage
+
+MESSAGE_TYPES = ("query_state_route", "query_state_direct")
+
+
+HOT_ROUTE_ID = "route-0"
+
+
+def generate_workload(messages: int = 1000, rows: int = 10, routes: int = 8, states: int = 4,
+                      direct_ratio: float = 0.0, hot_ratio: float = 0.0, seed: int = 7) -> List[Dict]:
+    """
+    Synthetic workload, messages of a number of rows spread over routes (and states, for direct messages).
+    A hot_ratio of the route messages goes to the hot route, route-0, the others are spread evenly.
+    """
+    rng = random.Random(seed)
+    workload = []
+    for index in range(messages):
+        query_state = [
+            {
+                "input": f"question {index}-{row}",
+                "output": " ".join(rng.choice(("alpha", "beta", "gamma", "delta")) for _ in range(12)),
+                "score": rng.random(),
+                "index": row,
+            }
+            for row in range(rows)
+        ]
+
+        if rng.random() < direct_ratio:
+            workload.append({
+                "type": "query_state_direct",
+                "state_id": f"state-{rng.randrange(states)}",
+                "query_state": query_state,
+            })
+        else:
+            workload.append({
+                "type": "query_state_route",
+                "route_id": HOT_ROUTE_ID if rng.random() < hot_ratio else f"route-{rng.randrange(routes)}",
+                "query_state": query_state,
+            })
+
+    return workload
+
+
+def load_workload(path: str) -> List[Dict]:
+    """Recorded workload, one consumed message (query_state_route or query_state_direct) per line."""
+    workload = []
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            message = json.loads(line)
+            if message.get('type') in MESSAGE_TYPES:
+                workload.append(message)
+    return workload
+
+
+def save_workload(path: str, workload: List[Dict]):
+    with open(path, 'w') as file:
+        for message in workload:
+            file.write(json.dumps(message) + '\n')
+
+
+def register_workload(storage: FakeStorage, workload: List[Dict], states: int = 4, forward_routes: int = 1,
+                      dispatch: str = "batch"):
+    """
+    Register the routes and states of a workload with the fake storage. Routes are assigned to states by
+    hash, and each state forwards its rows to a number of downstream (input) routes.
+    """
+    properties = {"routing": {"mode": "after_save", "dispatch": dispatch}} if forward_routes else None
+
+    state_ids = set()
+    for message in workload:
+        if message.get('state_id'):
+            state_ids.add(message['state_id'])
+        route_id = message.get('route_id')
+        if route_id and route_id not in storage.routes:
+            state_id = f"state-{zlib.crc32(route_id.encode('utf-8')) % states}"
+            storage.add_route(route_id=route_id, state_id=state_id)
+            state_ids.add(state_id)
+
+    for state_id in state_ids:
+        storage.add_state(state_id=state_id, properties=properties)
+        for forward in range(forward_routes):
+            storage.add_route(
+                route_id=f"{state_id}-forward-{forward}",
+                state_id=state_id,
+                direction=ProcessorStateDirection.INPUT
+            )
@@ -0,0 +1,83 @@
+import json
+from typing import Any
+
+from ismcore.utils.ism_logger import ism_logger
+
+from environment import MSG_JSON_CODEC
+
+logger = ism_logger(__name__)
+
+
+class JsonCodec:
+    """Stdlib json codec, used when no faster json library is installed."""
+    name = "json"
+
+    def dumps(self, obj: Any) -> str:
+        return json.dumps(obj)
+
+    def loads(self, data: bytes | str) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        self.options = orjson.OPT_NON_STR_KEYS   # parity with json.dumps for int keys
+
+    def dumps(self, obj: Any) -> str:
+        return self.orjson.dumps(obj, option=self.options).decode('utf-8')
+
+    def loads(self, data: bytes | str) -> Any:
+        # orjson decodes utf-8 bytes directly, no intermediate str copy is needed
+        return self.orjson.loads(data)
+
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj: Any) -> str:
+        return self.encoder.encode(obj).decode('utf-8')
+
+    def loads(self, data: bytes | str) -> Any:
+        return self.decoder.decode(data)
+
+
+CODECS = {
+    OrjsonCodec.name: OrjsonCodec,
+    MsgspecCodec.name: MsgspecCodec,
+    JsonCodec.name: JsonCodec,
+}
+
+
+def create_codec(name: str = "auto") -> JsonCodec:
+    """
+    Create the json codec by name, one of: auto, orjson, msgspec or json.
+    In auto mode, the first installed codec of orjson, msgspec and json is used.
+    """
+    name = (name or "auto").lower()
+    if name != "auto" and name not in CODECS:
+        raise ValueError(f'unsupported json codec {name}, must be one of: auto, {", ".join(CODECS)}')
+
+    candidates = list(CODECS) if name == "auto" else [name]
+    for candidate in candidates:
+        try:
+            codec = CODECS[candidate]()
+            logger.info(f'using json codec: {codec.name}')
+            return codec
+        except ImportError:
+            if name != "auto":
+                logger.warning(f'json codec {candidate} is not installed, falling back to json')
+
+    return JsonCodec()
+
+
+# the json codec for inbound and outbound messages
+json_codec = create_codec(MSG_JSON_CODEC)
@@ -0,0 +1,79 @@
+import hashlib
+from typing import Any, Iterable, Optional
+
+from ismcore.utils.ism_logger import ism_logger
+
+from route_cache import TTLCache
+
+logger = ism_logger(__name__)
+
+DEDUP_MODE_OFF = "off"
+DEDUP_MODE_MESSAGE = "message"      # the Nats-Msg-Id header, or the stream sequence of a redelivered message
+DEDUP_MODE_CONTENT = "content"      # a hash of the payload, which carries the route id (or state id)
+DEDUP_MODES = (DEDUP_MODE_OFF, DEDUP_MODE_MESSAGE, DEDUP_MODE_CONTENT)
+
+
+def content_key(payload: Any) -> Optional[bytes]:
+    if payload is None:
+        return None
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def message_key(msg: Any) -> Optional[str]:
+    headers = getattr(msg, 'headers', None)
+    if headers and headers.get('Nats-Msg-Id'):
+        return f"id:{headers['Nats-Msg-Id']}"
+
+    try:
+        metadata = msg.metadata
+        return f"seq:{metadata.stream}:{metadata.sequence.stream}"
+    except Exception:
+        return None
+
+
+class DedupWindow(TTLCache):
+    """
+    Bounded window of the keys of recently persisted messages, to drop redelivered messages and
+    upstream retries before they are written and forwarded again.
+
+    A key is only added once its message was persisted (or spooled), such that a message that failed
+    is not dropped when it is redelivered.
+    """
+
+    def __init__(self, mode: str = DEDUP_MODE_MESSAGE, max_size: int = 100000, ttl: float = 600.0):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f'unsupported dedup mode {mode}, must be one of {DEDUP_MODES}')
+
+        super().__init__(name="dedup", max_size=max_size, ttl=ttl)
+        self.mode = mode
+
+        # metrics
+        self.duplicates = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != DEDUP_MODE_OFF
+
+    def key_of(self, msg: Any, payload: Any = None) -> Optional[Any]:
+        """The dedup key of a message, None if it cannot be deduplicated."""
+        if self.mode == DEDUP_MODE_CONTENT:
+            return content_key(payload if payload is not None else getattr(msg, 'data', None))
+        if self.mode == DEDUP_MODE_MESSAGE:
+            return message_key(msg)
+        return None
+
+    def seen(self, key: Any) -> bool:
+        """Whether the key was persisted, counting it as a duplicate if so."""
+        if key is None:
+            return False
+        if self.get(key) is not None:
+            self.duplicates += 1
+            return True
+        return False
+
+    def mark(self, keys: Iterable[Any]):
+        for key in keys:
+            if key is not None:
+                self.put(key, True)
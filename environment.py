@@ -27,3 +27,107 @@ ROUTING_FILE = os.environ.get("ROUTING_FILE", '.routing.yaml')
 # Batch consumer settings
 CONSUMER_BATCH_SIZE = int(os.environ.get("CONSUMER_BATCH_SIZE", "100"))
 
+# Storage concurrency - max number of blocking storage calls (and thus batches) in flight at once
+STORAGE_MAX_CONCURRENCY = int(os.environ.get("STORAGE_MAX_CONCURRENCY", "4"))
+
+# Route metadata cache (processor state route, processor, provider by route id), also bounds the routing plan and
+# state metadata caches
+ROUTE_CACHE_MAX_SIZE = int(os.environ.get("ROUTE_CACHE_MAX_SIZE", "1024"))
+ROUTE_CACHE_TTL = float(os.environ.get("ROUTE_CACHE_TTL", "300"))
+
+# State cache (standard mode) - memory budget of the fully loaded states, and the seconds after which a cached
+# state is revalidated and refreshed with the rows appended to it in the meantime
+STATE_CACHE_MAX_BYTES = int(os.environ.get("STATE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+STATE_CACHE_TTL = float(os.environ.get("STATE_CACHE_TTL", "10"))
+
+# Bulk ingest of appended rows: off (column wise executemany), values (multi-row inserts) or copy (COPY into a
+# staging table, then upserted), with the number of cells per statement or COPY
+STATE_WRITE_BULK_MODE = os.environ.get("STATE_WRITE_BULK_MODE", "off").lower()
+STATE_WRITE_BULK_CHUNK_SIZE = int(os.environ.get("STATE_WRITE_BULK_CHUNK_SIZE", "5000"))
+
+# Downstream publishing - max publishes in flight, and entries per message for the "chunked" routing dispatch
+PUBLISH_MAX_IN_FLIGHT = int(os.environ.get("PUBLISH_MAX_IN_FLIGHT", "64"))
+ROUTING_DISPATCH_CHUNK_SIZE = int(os.environ.get("ROUTING_DISPATCH_CHUNK_SIZE", "50"))
+
+# JSON codec for consumed and published messages: auto (orjson, msgspec, then json), orjson, msgspec or json
+MSG_JSON_CODEC = os.environ.get("MSG_JSON_CODEC", "auto")
+
+# Adaptive batch window - a route_id group is flushed at the target row count (tuned between min and max rows
+# from the persist latency), at the max byte size or after the max linger time, whichever comes first
+CONSUMER_ADAPTIVE_BATCH = os.environ.get("CONSUMER_ADAPTIVE_BATCH", "false").lower() == "true"
+CONSUMER_BATCH_MIN_ROWS = int(os.environ.get("CONSUMER_BATCH_MIN_ROWS", "10"))
+CONSUMER_BATCH_MAX_ROWS = int(os.environ.get("CONSUMER_BATCH_MAX_ROWS", "5000"))
+CONSUMER_BATCH_MAX_BYTES = int(os.environ.get("CONSUMER_BATCH_MAX_BYTES", str(4 * 1024 * 1024)))
+CONSUMER_BATCH_MAX_LINGER = float(os.environ.get("CONSUMER_BATCH_MAX_LINGER_MS", "250")) / 1000
+CONSUMER_BATCH_TARGET_LATENCY = float(os.environ.get("CONSUMER_BATCH_TARGET_LATENCY_MS", "200")) / 1000
+
+# Flow control of the batch consumer - fetching pauses once CONSUMER_MAX_IN_FLIGHT consumed messages are not yet
+# acked (0 disables the bound), ready groups are persisted by CONSUMER_PERSIST_WORKERS workers through a queue of
+# the same size, and the messages of a group that failed to persist are redelivered after CONSUMER_NAK_DELAY_MS.
+# The server stops delivering once max_ack_pending (1000, set by the NATSRoute consumer) messages are unacked, so the
+# default bound stays below it, leaving room for the messages of the fetch that reaches it
+NATS_MAX_ACK_PENDING = 1000
+CONSUMER_MAX_IN_FLIGHT = int(os.environ.get("CONSUMER_MAX_IN_FLIGHT", str(NATS_MAX_ACK_PENDING * 4 // 5)))
+CONSUMER_PERSIST_WORKERS = int(os.environ.get("CONSUMER_PERSIST_WORKERS", str(STORAGE_MAX_CONCURRENCY)))
+CONSUMER_NAK_DELAY = float(os.environ.get("CONSUMER_NAK_DELAY_MS", "1000")) / 1000
+
+# Scheduling of the ready groups of the batch consumer - "fifo" persists them in the order they are ready, "fair"
+# (opt-in, it trades the latency of hot routes for that of the others) shares the persist workers between the groups
+# (routes, or states for direct writes) by weighted fair queuing. In fair mode a group is persisted by at most
+# CONSUMER_GROUP_MAX_CONCURRENCY workers at once (0 is unbounded), and weighted by its priority class, set by the
+# "priority" of the state's routing properties once its routing plan is known:
+#   CONSUMER_PRIORITY_CLASSES: name:weight[:max_concurrency], groups without (or with an unknown) priority are "normal"
+CONSUMER_SCHEDULER = os.environ.get("CONSUMER_SCHEDULER", "fifo").lower()
+CONSUMER_GROUP_MAX_CONCURRENCY = int(os.environ.get("CONSUMER_GROUP_MAX_CONCURRENCY", "0"))
+CONSUMER_PRIORITY_CLASSES = os.environ.get("CONSUMER_PRIORITY_CLASSES", "high:8,normal:1,low:0.25:1")
+
+# Deduplication of redelivered messages and upstream retries - by "message" (Nats-Msg-Id header or stream sequence),
+# "content" (a hash of the payload, which includes the route id, drops identical rows sent twice on purpose too) or
+# "off", within a window of the most recently persisted DEDUP_WINDOW_SIZE messages of the last DEDUP_WINDOW_TTL seconds
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "message").lower()
+DEDUP_WINDOW_SIZE = int(os.environ.get("DEDUP_WINDOW_SIZE", "100000"))
+DEDUP_WINDOW_TTL = float(os.environ.get("DEDUP_WINDOW_TTL", "600"))
+
+# Write spool - batches that fail to persist for lack of a database (connection, operational or pool errors) are
+# spooled to segment files in WRITE_SPOOL_DIR (empty disables the spool) and acked, then replayed with exponential
+# backoff, also after a restart. Once WRITE_SPOOL_MAX_BYTES are spooled, failed batches are redelivered instead, and
+# records failing WRITE_SPOOL_MAX_ATTEMPTS times (0 retries forever), or for another reason, are moved to a dead
+# letter file
+WRITE_SPOOL_DIR = os.environ.get("WRITE_SPOOL_DIR", "")
+WRITE_SPOOL_MAX_BYTES = int(os.environ.get("WRITE_SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))
+WRITE_SPOOL_SEGMENT_BYTES = int(os.environ.get("WRITE_SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+WRITE_SPOOL_RETRY_BASE = float(os.environ.get("WRITE_SPOOL_RETRY_BASE_MS", "1000")) / 1000
+WRITE_SPOOL_RETRY_MAX = float(os.environ.get("WRITE_SPOOL_RETRY_MAX_MS", "60000")) / 1000
+WRITE_SPOOL_MAX_ATTEMPTS = int(os.environ.get("WRITE_SPOOL_MAX_ATTEMPTS", "20"))
+# spool directories left with records by workers that no longer run (e.g. after the worker count was lowered), set by
+# the supervisor for worker 0, which replays them along with its own spool
+WRITE_SPOOL_ORPHANS = [path for path in os.environ.get("WRITE_SPOOL_ORPHANS", "").split(os.pathsep) if path]
+
+# Partitioned consumption (lightweight mode) - messages are republished to one of PARTITION_COUNT partitions by
+# a hash of their state id, each partition is consumed by exactly one worker, 0 disables partitioning.
+#   PARTITION_IDS: partitions owned by this process, "all", a list/ranges ("0,2,4-7") or "ordinal" (statefulset
+#                  pod ordinal, owns partition % PARTITION_REPLICAS == ordinal)
+#   PARTITION_FORWARD: whether this process also forwards the messages of the main subject to the partitions
+PARTITION_COUNT = int(os.environ.get("PARTITION_COUNT", "0"))
+PARTITION_IDS = os.environ.get("PARTITION_IDS", "all")
+PARTITION_REPLICAS = int(os.environ.get("PARTITION_REPLICAS", "1"))
+PARTITION_FORWARD = os.environ.get("PARTITION_FORWARD", "true").lower() == "true"
+
+# Multi-process mode - number of consumer worker processes started by `main.py --workers N` (1 runs the consumer in
+# this process, "auto" one per available core), supervised and restarted by the main process. The index and count of
+# a worker are set by the supervisor, workers split the owned partitions (PARTITION_IDS) between them
+WORKERS = os.environ.get("WORKERS", "1")
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+WORKER_SHUTDOWN_GRACE = float(os.environ.get("WORKER_SHUTDOWN_GRACE", "30"))
+
+# Readiness - the consumer is ready once its database and nats connections are established, served on GET /ready of
+# the metrics endpoint (with all workers ready in multi-process mode) and signalled by READY_FILE, a file that only
+# exists while the consumer is ready (empty disables the file)
+READY_FILE = os.environ.get("READY_FILE", "")
+
+# Metrics - prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics (0 disables the endpoint), and a
+# snapshot published on the monitor route every METRICS_PUBLISH_INTERVAL seconds (0 disables publishing)
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("METRICS_PUBLISH_INTERVAL", "60"))
@@ -1,74 +1,88 @@
+import argparse
 import asyncio
-import json
-from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, List
+import os
+import time
+from typing import Optional, Dict, List, Any, Awaitable, Callable
 
 from ismcore.messaging.base_message_provider import BaseMessageConsumer
 from ismcore.messaging.base_message_route_model import BaseRoute
-from ismcore.messaging.nats_message_provider import NATSMessageProvider
 from ismcore.messaging.nats_message_route import NATSRoute
-from ismcore.model.base_model import Processor, ProcessorProvider, ProcessorState, ProcessorStateDirection
-from ismcore.model.processor_state import State, RoutingMode, RoutingDispatch
+from ismcore.model.processor_state import State
 from ismcore.utils.ism_logger import ism_logger
-from ismdb.postgres_storage_class import PostgresDatabaseStorage
 
-from environment import DATABASE_URL, MSG_URL, MSG_TOPIC, MSG_TOPIC_SUBSCRIPTION, MSG_MANAGE_TOPIC, USE_LIGHTWEIGHT_MODE
-from message_router import monitor_route, state_sync_route, state_router_route
-from ismcore.messaging.nats_message_route_batch import NATSRouteBatch
+from async_storage import create_postgres_storage
+from codec import json_codec
+from environment import DATABASE_URL, MSG_MANAGE_TOPIC, USE_LIGHTWEIGHT_MODE, STORAGE_MAX_CONCURRENCY, \
+    PARTITION_COUNT, PARTITION_IDS, PARTITION_REPLICAS, PARTITION_FORWARD, \
+    METRICS_HOST, METRICS_PORT, METRICS_PUBLISH_INTERVAL, CONSUMER_MAX_IN_FLIGHT, CONSUMER_PERSIST_WORKERS, \
+    CONSUMER_NAK_DELAY, CONSUMER_SCHEDULER, CONSUMER_GROUP_MAX_CONCURRENCY, CONSUMER_PRIORITY_CLASSES, \
+    WRITE_SPOOL_DIR, WORKERS, WORKER_INDEX, WORKER_COUNT, WORKER_SHUTDOWN_GRACE, READY_FILE
+from metrics import metrics, MetricsServer, monitor_event_loop_lag, publish_metrics, messages_consumed, \
+    batch_rows, stage_latency, rows_persisted, event_loop_lag, event_loop_lag_histogram, messages_nacked
+from message_router import get_monitor_route, get_state_sync_route, get_state_router_route, \
+    get_state_sync_manage_route
+from readiness import Readiness, CHECK_DATABASE, CHECK_NATS
+from services import StateSyncServices
+from state_writer import WriteSegment
+from transform import TransformPlan
+from partitioning import parse_partition_ids, create_partition_route, ensure_partition_stream
+from route_batch import StateSyncRouteBatch
+from scheduling import parse_priority_classes
+from spool import SpoolFullError, SpoolRecord, WriteSpool, is_transient_error, orphaned_spool_dirs
+from supervisor import WorkerSupervisor, AggregatedMetricsServer, resolve_worker_count
 
 logger = ism_logger(__name__)
 
 # flag that determines whether to shut down the consumers
 RUNNING = True
 
-# Log the mode we're running in
-if USE_LIGHTWEIGHT_MODE:
-    logger.info("Running in LIGHTWEIGHT mode - memory-efficient incremental updates enabled")
-else:
-    logger.info("Running in STANDARD mode - full state loading enabled")
-
-# catch-all storage class configuration
-storage = PostgresDatabaseStorage(database_url=DATABASE_URL, incremental=True)
-
-# set up message provider for routing messages between state machines and processors in the system
-message_provider = NATSMessageProvider()
-
-class StateCacheRouteItem:
-
-    def __init__(self, route_id: str, processor: Processor, provider: ProcessorProvider, processor_state: ProcessorState):
-        self.route_id: str = route_id
-        self.processor: Processor = processor
-        self.provider: ProcessorProvider = provider
-        self.processor_state: ProcessorState = processor_state
-        self.processor: Optional[Processor] = None  # Will be set later when fetched from storage
-
-class StateCacheItem:
-
-    def __init__(self, state: State):
-        self.state: State = state
-        self.routes = {}  # Cache by route_id
-        self.last_update = datetime.now(tz=timezone.utc)
-
-    def add_route(self, route_id: str,
-                  provider: ProcessorProvider,
-                  processor_state: ProcessorState,
-                  processor: Processor = None) -> None:
-
-        self.routes[route_id] = StateCacheRouteItem(
-            route_id=route_id,
-            processor=processor,
-            provider=provider,
-            processor_state=processor_state)
-
-        self.last_update = datetime.now(tz=timezone.utc)
+# batch group key prefix of direct writes (query_state_direct), which are grouped by state rather than route
+DIRECT_GROUP_PREFIX = "state:"
 
+# attempts to connect to the database or nats before consuming time out (the nats client keeps retrying a first
+# connection on its own), and are retried with exponential backoff
+CONNECT_TIMEOUT = 15.0
+CONNECT_RETRY_BASE = 1.0
+CONNECT_RETRY_MAX = 30.0
 
 # set up state data synchronization consumer class
 class MessagingStateSyncConsumer(BaseMessageConsumer):
 
-    def __init__(self, route: NATSRoute, monitor_route: BaseRoute = None, **kwargs):
+    def __init__(self, route: NATSRoute, monitor_route: BaseRoute = None, services: StateSyncServices = None,
+                 lightweight: bool = USE_LIGHTWEIGHT_MODE, **kwargs):
         super().__init__(route=route, monitor_route=monitor_route)
-        self.state_cache: Dict[str, StateCacheItem] = {}  # Cache by state_id instead of route_id
+
+        # Log the mode we're running in
+        self.lightweight = lightweight
+        if self.lightweight:
+            logger.info("Running in LIGHTWEIGHT mode - memory-efficient incremental updates enabled")
+        else:
+            logger.info("Running in STANDARD mode - full state loading enabled")
+
+        # storage, caches, writer and publisher, on the postgres storage unless given
+        self.services = services or StateSyncServices(
+            storage=create_postgres_storage(database_url=DATABASE_URL, max_concurrency=STORAGE_MAX_CONCURRENCY),
+            router_route=get_state_router_route()
+        )
+        self.async_storage = self.services.async_storage
+        self.state_write_coalescer = self.services.state_write_coalescer
+        self.route_cache = self.services.route_cache
+        self.routing_plan_cache = self.services.routing_plan_cache
+        self.state_cache = self.services.state_cache
+        self.state_metadata_cache = self.services.state_metadata_cache
+        self.query_state_publisher = self.services.query_state_publisher
+        self.batch_sizer = self.services.batch_sizer
+        self.write_spool = self.services.write_spool
+        self.dedup_window = self.services.dedup_window
+        self.priority_classes = parse_priority_classes(CONSUMER_PRIORITY_CLASSES)
+
+        self.partition_routes: List[StateSyncRouteBatch] = []   # forwarder and owned partitions, if partitioned
+        self.metrics_tasks: List[asyncio.Task] = []
+        self.spool_task: Optional[asyncio.Task] = None
+        self.spool_tasks: List[asyncio.Task] = []               # replays of orphaned spools
+
+        # ready to consume once the database and nats connections are established
+        self.readiness = Readiness(checks=[CHECK_DATABASE, CHECK_NATS], ready_file=READY_FILE)
 
     async def pre_execute(self, consumer_message_mapping: dict, **kwargs):
         pass    # do not send any data synchronization updates, for now
@@ -76,29 +90,58 @@ class MessagingStateSyncConsumer(BaseMessageConsumer):
     async def post_execute(self, consumer_message_mapping: dict, **kwargs):
         pass    # do not send any data synchronization updates, for now
 
-    # # @memoize
-    async def fetch_state2(self, state_id: str) -> Optional[State]:
-        # NOTE: This method is currently unused but kept for potential future use
-        
-        state = None    # start with state is not cached yet
-
-        if state_id in self.state_cache:    # if the state is already cached
-            state_cache_item = self.state_cache[state_id]   # fetch the cached item
+    async def on_receive(self, route: BaseRoute, msg: Any, data: Any):
+        # same as the base consumer, but decodes the message with the configured json codec, and acks a message only
+        # once it was processed or failed validation, a message whose processing failed (e.g. its write) is redelivered
+        _id = None
+        redeliver = False
+        try:
+            _id = route.get_message_id(msg)
+            logger.debug(f'received with message id: {_id}')
+            message_dict = json_codec.loads(data)
+            messages_consumed.inc(type=message_dict.get('type') or 'unknown')
+
+            # a copy of a message that was already persisted is acked without writing or forwarding it again
+            key = self.dedup_window.key_of(msg, payload=data)
+            if self.dedup_window.seen(key):
+                logger.debug(f'dropping duplicate message id: {_id}')
+                return
+
+            # validation errors are reported and swallowed by _execute (status False), any other error is of
+            # processing a valid message. Only processed messages are remembered, such that a message that failed
+            # validation is processed again when it is published again, and a message that failed otherwise when
+            # it is redelivered
+            redeliver = True
+            status = await self._execute(message_dict)
+            redeliver = False
+            if status:
+                self.dedup_window.mark([key])
+            logger.debug(f"message id: {_id}, status: {status}")
+        except Exception as e:
+            friendly_msg = route.friendly_message(message=msg)
+            if redeliver:
+                logger.error(f"error processing message: {friendly_msg}, redelivering it, error: {e}")
+            else:
+                logger.warning(f"critical error trying to process message: {friendly_msg} error: {e}")
+                await self.fail_validate_input_message(consumer_message_mapping=msg, exception=e)
+        finally:
+            if redeliver:
+                await self.nak_message(route, msg)
+                logger.debug(f"finalizing message id: {_id}, nacked")
+            else:
+                acked = await route.ack(msg)
+                logger.debug(f"finalizing message id: {_id}, acked: {acked}")
 
-            # calculate the time since last updating the cache element
-            elapsed_last_access = datetime.now(tz=timezone.utc) - state_cache_item.last_update
-            if elapsed_last_access.total_seconds() < 30:     # if not 30 seconds has elapsed, then use the cache item
-                state = state_cache_item.state
-                state_cache_item.last_update = datetime.now(tz=timezone.utc)    # update the cache state
+    async def nak_message(self, route: BaseRoute, msg: Any):
+        """Negatively ack a message, such that it is redelivered after the nak delay (jetstream only)."""
+        if not getattr(route, 'jetstream_enabled', False):
+            return
 
-        # otherwise the state is null and we need to reload it and cache it again
-        if not state:
-            state = storage.load_state(state_id=state_id)
-            # Note: This would need processor and provider info to create a proper StateCacheItem
-            # For now, this method is not used in the main flow
-            
-        # return the final state cached or just renewed/loaded
-        return state
+        messages_nacked.inc(subject=route.subject)
+        try:
+            await msg.nak(delay=CONSUMER_NAK_DELAY)
+        except Exception as e:
+            logger.warning(f"failed to nak message: {e}")
 
     def remove_complex_values(self, query_state):
         if not query_state:
@@ -136,14 +179,23 @@ class MessagingStateSyncConsumer(BaseMessageConsumer):
         if message_type == 'query_state_direct':
             query_states, state = await self.execute_direct(message=message)
         elif message_type == 'query_state_route':
-            if USE_LIGHTWEIGHT_MODE:
+            if self.lightweight:
                 query_states, state = await self.execute_route_lightweight(message=message)
             else:
                 query_states, state = await self.execute_route(message=message)
         else:
             raise ValueError(f'invalid message type {message_type}')
 
-        return await self.route_query_states(state=state, query_states=query_states)
+        # spooled rows are routed once they are replayed
+        if state is None:
+            return None
+
+        # the rows are persisted and thus acked even if forwarding fails, a redelivery would append them again
+        try:
+            return await self.route_query_states(state=state, query_states=query_states)
+        except Exception as e:
+            logger.error(f'error routing {len(query_states)} rows of state: {state.id}: {e}')
+            return None
 
     async def execute_direct(self, message: dict):
 
@@ -152,30 +204,99 @@ class MessagingStateSyncConsumer(BaseMessageConsumer):
 
         state_id = message['state_id']
 
-        # fetch the state object from the cache or backend
-        # state = await self.fetch_state(state_id=state_id)
-        # TODO temporary fix until we get this state synchronizer shit sorted out
-        # TODO definitely do not want to be doing this outside the other path of persistence
-        #  (but since the other path uses the route id and not the state id, well you get the point.....)
-        state = storage.load_state(state_id=state_id, load_data=True)
+        # append through the same incremental path as lightweight routing, such that only the state
+        # metadata is loaded and the write costs the new rows rather than the whole state
+        segment = self.direct_segment(state_id=state_id, query_states=message['query_state'])
 
-        # persist the query state list
-        query_states = message['query_state']
-        query_states, state = await self.save_state(state=state, query_states=query_states, scope_variable_mapping={
-            "state_id": state_id
-        })
+        logger.info(f'persisting {len(segment.query_states)} rows to state: {state_id} (direct)')
+        updated_state = await self.persist_segment(state_id=state_id, segment=segment)
 
-        return query_states, state
+        # a cached copy of the state (standard mode) merges the appended rows on its next use
+        self.state_cache.expire(state_id)
+        return self.direct_rows(segment), updated_state
 
+    @staticmethod
+    def direct_segment(state_id: str, query_states: List[dict]) -> WriteSegment:
+        # as save_state, each entry is bound to the data variable of its own row
+        return WriteSegment(
+            query_states=query_states,
+            scope_variable_mappings={"state_id": state_id},
+            entry_variable="data"
+        )
 
-    def load_route_cache_item(self, processor_state: ProcessorState, cache_item: StateCacheItem):
-        route_id = processor_state.id
-        if route_id in cache_item.routes:
-            return
+    @staticmethod
+    def direct_rows(segment: WriteSegment) -> List[dict]:
+        """The rows routed downstream of a direct write, transformed (with defaults and computed values) once written."""
+        return segment.rows if segment.rows is not None else segment.query_states
 
-        processor = storage.fetch_processor(processor_id=processor_state.processor_id)
-        provider = storage.fetch_processor_provider(id=processor.provider_id)
-        cache_item.add_route(route_id, processor=processor, provider=provider, processor_state=processor_state)
+    async def persist_segment(self, state_id: str, segment: WriteSegment, route_id: str = None) -> Optional[State]:
+        """
+        Append the rows of a segment to the state. When the write fails for a transient reason (the database
+        or its connection) and a write spool is configured, the rows are spooled for replay and None is
+        returned, otherwise (or when the spool is full) the error is raised. While rows of the state are
+        spooled, new rows are spooled behind them, such that the replay does not append them out of order.
+        """
+        if self.write_spool and self.write_spool.has_pending(state_id):
+            return await self.spool_segment(state_id, segment, route_id=route_id, reason='earlier rows are spooled')
+
+        try:
+            return await self.state_write_coalescer.submit(state_id=state_id, segment=segment)
+        except Exception as e:
+            # errors of the rows themselves would fail every replay too, they are redelivered or dropped instead
+            if not self.write_spool or not is_transient_error(e):
+                raise
+
+            try:
+                return await self.spool_segment(state_id, segment, route_id=route_id, reason=f'failed to persist: {e}')
+            except SpoolFullError:
+                raise e
+
+    async def spool_segment(self, state_id: str, segment: WriteSegment, route_id: str = None,
+                            reason: str = None) -> None:
+        try:
+            record = await self.write_spool.append(
+                state_id=state_id,
+                route_id=route_id,
+                query_states=segment.query_states
+            )
+        except SpoolFullError as full:
+            logger.error(f'unable to spool {len(segment.query_states)} rows of state: {state_id}: {full}')
+            raise
+
+        logger.warning(
+            f'spooled {len(segment.query_states)} rows of state: {state_id} as record {record.id} for replay, '
+            f'{reason}'
+        )
+        return None
+
+    async def replay_spooled(self, record: SpoolRecord):
+        """Write a spooled record to its state, then route its rows downstream as if it never failed."""
+        if record.route_id:
+            resolution = await self.route_cache.resolve(route_id=record.route_id)
+            segment = WriteSegment(
+                query_states=record.query_states,
+                scope_variable_mappings={**resolution.scope_variable_mappings(), "data": None}
+            )
+        else:
+            segment = self.direct_segment(state_id=record.state_id, query_states=record.query_states)
+
+        state = await self.state_write_coalescer.submit(state_id=record.state_id, segment=segment)
+        self.state_cache.expire(record.state_id)
+        logger.info(f'replayed spooled record {record.id}, {len(record.query_states)} rows to state: {record.state_id}')
+
+        if state:
+            try:
+                query_states = record.query_states if record.route_id else self.direct_rows(segment)
+                await self.route_query_states(state=state, query_states=query_states)
+            except Exception as e:
+                logger.error(f'error routing replayed record {record.id} of state: {record.state_id}: {e}')
+
+    async def replay_orphaned_spool(self, spool: WriteSpool):
+        """Replay the spool of a worker that no longer runs, along with this worker's own spool."""
+        logger.warning(f'{spool.records} spooled records in {spool.directory}, which no worker spools to anymore, '
+                       f'replaying them')
+        await spool.replay(handler=self.replay_spooled, drain=True)
+        logger.info(f'replayed the orphaned spool {spool.directory}')
 
     async def execute_route(self, message: dict):
 
@@ -189,68 +310,40 @@ class MessagingStateSyncConsumer(BaseMessageConsumer):
         # TODO final the state should probably not use a complex data structure but be as simple as dumping a json row (aka finalized query state rather than persisting each column and value per row, although this is kind of like a key which we can use a distributed hash for I suppose? but not as efficient as I would expect)
         # TODO to say the least, this whole fucking thing around `synchronizing` state persistence needs to be looked at BADLY and quickly, as it won't scale
 
-        # First, fetch processor state route information to get the state_id
-        processor_state = storage.fetch_processor_state_route(route_id=route_id)
-        
-        # ensure that processor state route is correct
-        if not processor_state or len(processor_state) != 1:
-            raise ValueError(
-                f'unable to identity route id {route_id}, '
-                f'expected 1 result, received {processor_state}'
-            )
-
-        ## Unpack the processor state since there should only be one result
-        processor_state = processor_state[0]
-        state_id = processor_state.state_id
-        
-        load = True
-        cache_item = None
-
-        # Check the cache using state_id instead of route_id
-        if state_id in self.state_cache:
-            cache_item = self.state_cache[state_id]
-
-            # load the route information into the cache item if not already present
-
-            # calculate the time since last updating the cache element
-            elapsed_last_access = datetime.now(tz=timezone.utc) - cache_item.last_update
-            if elapsed_last_access.total_seconds() >= 10:  # if cache expired
-                self.state_cache.pop(state_id)
-                cache_item = None
-            else:
-                self.load_route_cache_item(processor_state, cache_item)
-                load = False
-
-        if load:
-            # fetch the state object from the backend
-            state = storage.load_state(state_id=state_id, load_data=True)
+        # First, resolve the processor state route information to get the state_id
+        with stage_latency.time(stage="resolve"):
+            resolution = await self.route_cache.resolve(route_id=route_id)
+        state_id = resolution.state_id
 
-            # Create cache item and cache by state_id
-            cache_item = StateCacheItem(state=state)
-            self.load_route_cache_item(processor_state, cache_item)
-            self.state_cache[state_id] = cache_item
+        # the cached state, refreshed with the rows appended since it was cached, or loaded in full
+        state = await self.state_cache.get(state_id=state_id)
+        if not state:
+            raise ValueError(f'state not found: {state_id}')
 
         # persist the query state list
         query_states = message['query_state']    # likely individual state entries (a list)
 
         # TODO BATCH THE SHIT OUT OF THIS
-        query_states, state = await self.save_state(
-            state=cache_item.state,
-            query_states=query_states,
-            scope_variable_mapping={
-                "route_id": route_id,
-                "provider": cache_item.routes[route_id].provider,
-                "processor": cache_item.routes[route_id].processor,
-                "processor_state": cache_item.routes[route_id].processor_state
-            }
-        )
-        cache_item.state = state
+        try:
+            query_states, state = await self.save_state(
+                state=state,
+                query_states=query_states,
+                scope_variable_mapping=resolution.scope_variable_mappings()
+            )
+        except Exception:
+            # the cached state holds the rows that were not saved, it would keep serving them without revalidating,
+            # so it is loaded again by the next message (or the redelivery of this one)
+            self.state_cache.discard(state_id)
+            raise
+
+        # re-measure the saved state, it grew by the appended rows
+        self.state_cache.put(state)
 
         return query_states, state
 
     async def execute_route_lightweight(self, message: dict):
         """
-        Memory-efficient version of execute_route that doesn't use caching or load full state data.
+        Memory-efficient version of execute_route that doesn't cache or load full state data.
         Passes raw query_states to append_state_data_direct which handles transformations and persistence.
         """
         if 'route_id' not in message:
@@ -258,193 +351,422 @@ class MessagingStateSyncConsumer(BaseMessageConsumer):
 
         route_id = message['route_id']
 
-        # First, fetch processor state route information to get the state_id
-        processor_state = storage.fetch_processor_state_route(route_id=route_id)
-
-        # ensure that processor state route is correct
-        if not processor_state or len(processor_state) != 1:
-            raise ValueError(
-                f'unable to identity route id {route_id}, '
-                f'expected 1 result, received {processor_state}'
-            )
-
-        ## Unpack the processor state since there should only be one result
-        processor_state = processor_state[0]
-        state_id = processor_state.state_id
-
-        # Fetch route-related info for scope variable mappings
-        processor = storage.fetch_processor(processor_id=processor_state.processor_id)
-        provider = storage.fetch_processor_provider(id=processor.provider_id)
+        # resolve route-related info (state id and scope variable mappings) from the route cache
+        with stage_latency.time(stage="resolve"):
+            resolution = await self.route_cache.resolve(route_id=route_id)
+        state_id = resolution.state_id
 
-        # LIGHTWEIGHT: Pass raw query_states directly to storage
-        # append_state_data_direct will handle: metadata loading, transformations, and direct DB writes
+        # LIGHTWEIGHT: Pass raw query_states directly to the state writer
+        # the writer will handle: metadata loading, transformations, and direct DB writes
         query_states = message['query_state']
 
         logger.info(f'persisting {len(query_states)} rows to state: {state_id} (lightweight mode)')
-        updated_state = storage.append_state_data_direct(
+        updated_state = await self.persist_segment(
             state_id=state_id,
-            query_states=query_states,
-            scope_variable_mappings={
-                "route_id": route_id,
-                "provider": provider,
-                "processor": processor,
-                "processor_state": processor_state,
-                "data": None,  # Will be set per entry in append_state_data_direct
-            }
+            route_id=route_id,
+            segment=WriteSegment(
+                query_states=query_states,
+                scope_variable_mappings={
+                    **resolution.scope_variable_mappings(),
+                    "data": None,
+                }
+            )
         )
 
-        # Return the query_states (now transformed inside append_state_data_direct)
         return query_states, updated_state
 
     async def save_state(self, state: State, query_states: [], scope_variable_mapping=None):
         # overwrite each slot in the original list
         if scope_variable_mapping is None:
             scope_variable_mapping = {}
-        for idx, entry in enumerate(query_states):
-            query_states[idx] = state.apply_query_state(
-                query_state=entry,
-                scope_variable_mappings={
-                    **scope_variable_mapping,
-                    "data": entry,
-                }
-            )
+        with stage_latency.time(stage="transform"):
+            plan = TransformPlan(state=state, scope_variable_mappings=scope_variable_mapping, entry_variable="data")
+            query_states[:] = plan.apply(query_states, skip_data_append=False)
 
         logger.info(f'persisting state: {state.id} to storage {state.config.storage_class} with count: {state.count}')
-        state = storage.save_state(state=state)
+        with stage_latency.time(stage="persist"):
+            state = await self.async_storage.save_state(state=state)
+        rows_persisted.inc(len(query_states))
         return query_states, state
 
 
-    def _should_route_after_save(self, state: State) -> bool:
-        """Check whether this state should auto-route after persistence."""
-        props = state.typed_properties
-        if props.routing and props.routing.mode:
-            return RoutingMode(props.routing.mode) == RoutingMode.AFTER_SAVE
-        return False
-
-    def _should_dispatch_batch(self, state: State) -> bool:
-        """Check whether downstream routing should send the full set as one message."""
-        props = state.typed_properties
-        if props.routing and props.routing.dispatch:
-            return RoutingDispatch(props.routing.dispatch) == RoutingDispatch.BATCH
-        return False
-
     async def route_query_states(self, state: State, query_states: List[Dict]):
 
         state_id = state.id
-        if not self._should_route_after_save(state):
+
+        # the compiled routing plan of the state (routing mode, dispatch mode and forward routes)
+        plan = await self.routing_plan_cache.resolve(state=state)
+        if not plan.route_after_save:
             logger.debug(f'routing after save is disabled for state id {state_id}')
             return
 
-        # the current state id is an INPUT into other processors (if any)
-        forward_routes = storage.fetch_processor_state_route(
-            state_id=state_id,
-            direction=ProcessorStateDirection.INPUT
-        )
-
         # ensure there are forwarding hop(s)
-        if not forward_routes:
+        if not plan.forward_route_ids:
             logger.debug(f'no forward routes found for state id: {state_id}')
             return
 
-        # Determine dispatch mode from the current state's routing properties
-        dispatch_batch = self._should_dispatch_batch(state)
-
-        for forward_route in forward_routes:
-            if dispatch_batch:
-                # send entire query state set as a single message
-                logger.debug(f'forwarding full query state set ({len(query_states)} entries) to route {forward_route.id}')
-                await state_router_route.publish(json.dumps({
-                    "type": "query_state_entry",
-                    "route_id": forward_route.id,
-                    "query_state": query_states
-                }))
-            else:
-                # send each query state entry individually
-                logger.debug(f'forwarding {len(query_states)} individual query state entries to route {forward_route.id}')
-                for qs_entry in query_states:
-                    await state_router_route.publish(json.dumps({
-                        "type": "query_state_entry",
-                        "route_id": forward_route.id,
-                        "query_state": [qs_entry]
-                    }))
+        # serialize once, publish to all forward routes concurrently and flush once
+        with stage_latency.time(stage="forward"):
+            await self.query_state_publisher.publish(
+                forward_route_ids=plan.forward_route_ids,
+                query_states=query_states,
+                dispatch=plan.dispatch
+            )
+
+    def execute_manage(self, message: dict):
+        """
+        Handle a management message, e.g. when a pipeline is edited:
+            {"type": "invalidate", "route_id": "...", "state_id": "..."}
+
+        Without a route_id or state_id, all cached route metadata, routing plans, states and state metadata are dropped.
+        """
+        message_type = message.get('type')
+        if message_type != 'invalidate':
+            logger.warning(f'unsupported management message type: {message_type}')
+            return
+
+        route_id = message.get('route_id')
+        state_id = message.get('state_id')
+
+        if route_id:
+            self.route_cache.invalidate(route_id)
+            # a route edit can add or remove a forward route of any state
+            self.routing_plan_cache.clear()
+        if state_id:
+            self.route_cache.invalidate_state(state_id)
+            self.routing_plan_cache.invalidate(state_id)
+            self.state_cache.invalidate(state_id)
+            self.state_metadata_cache.invalidate(state_id)
+        if not route_id and not state_id:
+            self.route_cache.clear()
+            self.routing_plan_cache.clear()
+            self.state_cache.clear()
+            self.state_metadata_cache.clear()
+
+        logger.info(f'invalidated caches for route_id: {route_id}, state_id: {state_id}')
+
+    async def on_receive_manage(self, route: BaseRoute, msg: Any, data: Any):
+        try:
+            self.execute_manage(message=json_codec.loads(data))
+        except Exception as e:
+            logger.warning(f'unable to process management message: {data}, error: {e}')
+
+    async def start_manage_consumer(self):
+        # plain NATS subscription (no queue group), such that every replica invalidates its own caches
+        manage_route = get_state_sync_manage_route()
+        manage_route.callback = self.on_receive_manage
+        if not await manage_route.connect():
+            logger.warning(f'unable to listen on management topic {MSG_MANAGE_TOPIC}, '
+                           f'caches will only refresh on expiry')
+            return
+
+        await manage_route.subscribe_request()
+
+    @staticmethod
+    def batch_group_key(message: dict) -> Optional[str]:
+        # direct writes carry a state id rather than a route id, they are grouped by state
+        if message.get('type') == 'query_state_direct':
+            return f"{DIRECT_GROUP_PREFIX}{message['state_id']}" if message.get('state_id') else None
+        return message.get('route_id')
+
+    def create_batch_route(self, route: NATSRoute) -> StateSyncRouteBatch:
+        return StateSyncRouteBatch.from_route(
+            route=route,
+            batch_callback=self.on_receive_batch,
+            group_by_fn=self.batch_group_key,
+            batch_sizer=self.batch_sizer,
+            max_in_flight=CONSUMER_MAX_IN_FLIGHT,
+            persist_workers=CONSUMER_PERSIST_WORKERS,
+            nak_delay=CONSUMER_NAK_DELAY,
+            dedup=self.dedup_window,
+            scheduler=CONSUMER_SCHEDULER,
+            group_max_concurrency=CONSUMER_GROUP_MAX_CONCURRENCY,
+            priority_classes=self.priority_classes,
+            priority_fn=self.group_priority
+        )
+
+    def group_priority(self, group_key: str) -> Optional[str]:
+        """
+        The priority class of a batch group, from the cached routing plan of its state. None (normal) until
+        the state of the group was persisted once, such that scheduling never waits for the database.
+        """
+        if group_key.startswith(DIRECT_GROUP_PREFIX):
+            state_id = group_key[len(DIRECT_GROUP_PREFIX):]
+        else:
+            resolution = self.route_cache.peek(group_key)
+            state_id = resolution.state_id if resolution else None
+
+        plan = self.routing_plan_cache.peek(state_id) if state_id else None
+        return plan.priority if plan else None
+
+    async def partition_key(self, message: dict) -> str:
+        """Partition by state, such that each state is written by a single partition (worker) only."""
+        if message.get('state_id'):
+            return message['state_id']
+
+        route_id = message.get('route_id')
+        try:
+            resolution = await self.route_cache.resolve(route_id=route_id)
+            return resolution.state_id
+        except Exception as e:
+            logger.warning(f'unable to resolve state of route id {route_id}, partitioning by route: {e}')
+            return route_id
+
+    async def start_partitioned_consumer(self):
+        """
+        Partitioned consumption: the forwarder republishes each consumed message to the partition of its
+        state, and every owned partition is consumed by its own batch route (and durable consumer), such
+        that N replicas or workers each own a disjoint set of states.
+        """
+        partition_ids = parse_partition_ids(PARTITION_IDS, PARTITION_COUNT, PARTITION_REPLICAS)
+
+        # in multi-process mode, the workers of this process split its partitions between them
+        if WORKER_COUNT > 1:
+            partition_ids = partition_ids[WORKER_INDEX::WORKER_COUNT]
+
+        logger.info(
+            f'starting partitioned consumer, partitions: {partition_ids} of {PARTITION_COUNT}, '
+            f'forwarder: {PARTITION_FORWARD}'
+        )
 
+        if PARTITION_FORWARD:
+            self.partition_routes.append(StateSyncRouteBatch.from_route(
+                route=self.route,
+                batch_callback=None,
+                group_by_fn=lambda msg: msg.get('route_id') or msg.get('state_id'),
+                partition_count=PARTITION_COUNT,
+                partition_key_fn=self.partition_key
+            ))
+
+        self.partition_routes.extend(
+            self.create_batch_route(create_partition_route(route=self.route, partition=partition))
+            for partition in partition_ids
+        )
+
+        if not self.partition_routes:
+            raise ValueError(f'no partitions owned and forwarding is disabled, nothing to consume')
+
+        for route in self.partition_routes:
+            if not await self.establish(f'route {route.subject}', route.connect):
+                return
+
+        await ensure_partition_stream(
+            connected_route=self.partition_routes[0],
+            route=self.route,
+            partition_count=PARTITION_COUNT
+        )
+
+        for route in self.partition_routes:
+            await route.subscribe()
+        self.readiness.set(CHECK_NATS)
+
+        async def consume(route: StateSyncRouteBatch):
+            while self.RUNNING:
+                try:
+                    await route.consume()
+                except InterruptedError as e:
+                    logger.error(f"stop receiving messages on {route.subject}: {e}")
+                    break
+
+        await asyncio.gather(*[consume(route) for route in self.partition_routes])
+
+    def graceful_shutdown(self, signum, frame):
+        super().graceful_shutdown(signum, frame)
+        self.readiness.stop()
+        for route in self.partition_routes:
+            route.consumer_active = False
+
+    async def start_metrics(self):
+        metrics.register_collector(self.services.collect_metrics)
+
+        if METRICS_PORT:
+            try:
+                await MetricsServer(
+                    registry=metrics,
+                    host=METRICS_HOST,
+                    port=METRICS_PORT,
+                    readiness=self.readiness
+                ).start()
+            except OSError as e:
+                logger.warning(f'unable to serve metrics on port {METRICS_PORT}: {e}')
+
+        self.metrics_tasks.append(asyncio.create_task(
+            monitor_event_loop_lag(gauge=event_loop_lag, histogram=event_loop_lag_histogram)
+        ))
+
+        if self.monitor_route and METRICS_PUBLISH_INTERVAL > 0:
+            self.metrics_tasks.append(asyncio.create_task(
+                publish_metrics(registry=metrics, route=self.monitor_route, interval=METRICS_PUBLISH_INTERVAL)
+            ))
+
+    async def establish(self, name: str, connect: Callable[[], Awaitable[Any]]) -> bool:
+        """
+        Retry a connection with exponential backoff until it is established, returns False if the consumer
+        was stopped in the meantime. A connect function signals failure by raising or returning False.
+        """
+        delay = CONNECT_RETRY_BASE
+        while self.RUNNING:
+            try:
+                if await asyncio.wait_for(connect(), timeout=CONNECT_TIMEOUT) is not False:
+                    return True
+                error = 'not connected'
+            except asyncio.TimeoutError:
+                error = f'timed out after {CONNECT_TIMEOUT:.0f} seconds'
+            except Exception as e:
+                error = e
+
+            logger.warning(f'unable to connect to {name}, retrying in {delay:.0f} seconds: {error}')
+            await asyncio.sleep(delay)
+            delay = min(CONNECT_RETRY_MAX, delay * 2)
+        return False
+
+    async def prewarm(self) -> bool:
+        """
+        Establish the nats connections of the routes published to and the database connections of the storage
+        threads, before the first message is consumed. Returns False if the consumer was stopped.
+        """
+        started = time.monotonic()
+
+        # downstream and monitor routes, connected now rather than by the first publish
+        router_route = self.query_state_publisher.route
+        if router_route and not await self.establish(f'route {router_route.subject}', router_route.connect):
+            return False
+        if self.monitor_route and not await self.monitor_route.connect():
+            logger.warning(f'unable to connect to monitor route {self.monitor_route.subject}')
+
+        if not await self.establish('database', self.async_storage.prewarm):
+            return False
+        self.readiness.set(CHECK_DATABASE)
+
+        logger.info(f'connections established in {time.monotonic() - started:.2f} seconds')
+        return True
 
     async def start_consumer(self):
-        if USE_LIGHTWEIGHT_MODE:
+        # workers share the stream, their appends to a state are only serialized by the state writer's row lock
+        if WORKER_COUNT > 1 and not self.state_write_coalescer.writer.supports_direct_write:
+            logger.error('multi-process mode requires a storage class with a connection pool, such that the '
+                         'state writer can lock each state while appending to it')
+            return
+
+        self.RUNNING = True
+        await self.start_metrics()
+        if not await self.prewarm():
+            return
+        await self.start_manage_consumer()
+
+        # replays the batches spooled by this or a previous run, once the storage accepts them
+        if self.write_spool:
+            self.spool_task = asyncio.create_task(self.write_spool.replay(handler=self.replay_spooled))
+        for spool in self.services.orphaned_spools:
+            self.spool_tasks.append(asyncio.create_task(self.replay_orphaned_spool(spool)))
+
+        if self.lightweight and PARTITION_COUNT > 0:
+            await self.start_partitioned_consumer()
+            return
+
+        if PARTITION_COUNT > 0:
+            logger.warning('partitioned consumption requires lightweight mode, consuming unpartitioned')
+
+        if self.lightweight:
             logger.info(
-                f"switching to batch consumer with batch_size={self.route.batch_size}"
-            )
-            self.route = NATSRouteBatch.from_route(
-                route=self.route,
-                batch_callback=self.on_receive_batch,
-                group_by_fn=lambda msg: msg.get('route_id')
+                f"switching to batch consumer with batch_size={self.route.batch_size}, "
+                f"adaptive: {self.batch_sizer is not None}"
             )
-        await super().start_consumer()
+            self.route = self.create_batch_route(route=self.route)
+
+        # same as the base consumer, but retries connecting and signals readiness once subscribed
+        logger.info(f'starting up consumer {type(self)}')
+        self.route.callback = self.on_receive
+        if not await self.establish(f'route {self.route.subject}', self.route.connect):
+            return
+        await self.route.subscribe()
+        self.readiness.set(CHECK_NATS)
+        await self.consumer_loop()
 
     async def on_receive_batch(self, route, group_key: str, messages: list):
         """
-        Handle a batch of messages grouped by route_id.
-        Resolves route info once, flattens query_states, and persists in a single DB call.
+        Handle a batch of messages grouped by route_id (or by state_id, for direct writes).
+        Resolves route info once, flattens query_states, and persists in a single DB call, merged
+        with the concurrent batches of other routes into the same state.
+
+        Raises when the rows were neither persisted nor spooled, such that the batch route redelivers the
+        messages rather than acking them. Messages of a route that cannot be resolved are dropped, as are forwarding errors
+        once the rows are persisted.
         """
         route_id = group_key
+        direct = messages[0].get('type') == 'query_state_direct'
+        messages_consumed.inc(len(messages), type=messages[0].get('type') or 'unknown')
 
-        # Flatten all query_states from messages in this group
+        # Flatten all query_states from messages in this group, a single message list is used as is
         all_query_states = []
-        for msg in messages:
-            qs = msg.get('query_state', [])
-            if isinstance(qs, list):
-                all_query_states.extend(qs)
-            else:
-                all_query_states.append(qs)
+        if len(messages) == 1 and isinstance(messages[0].get('query_state'), list):
+            all_query_states = messages[0]['query_state']
+        else:
+            for msg in messages:
+                qs = msg.get('query_state', [])
+                if isinstance(qs, list):
+                    all_query_states.extend(qs)
+                else:
+                    all_query_states.append(qs)
 
         if not all_query_states:
             logger.warning(f"no query_states in batch for route_id: {route_id}")
             return
 
-        try:
-            # Resolve route info once per batch
-            processor_state = storage.fetch_processor_state_route(route_id=route_id)
-            if not processor_state or len(processor_state) != 1:
-                raise ValueError(
-                    f'unable to identity route id {route_id}, '
-                    f'expected 1 result, received {processor_state}'
-                )
-            processor_state = processor_state[0]
-            state_id = processor_state.state_id
-
-            processor = storage.fetch_processor(processor_id=processor_state.processor_id)
-            provider = storage.fetch_processor_provider(id=processor.provider_id)
+        batch_rows.observe(len(all_query_states))
 
-            logger.info(
-                f'persisting batch of {len(all_query_states)} rows '
-                f'to state: {state_id} (route: {route_id})'
-            )
-
-            updated_state = storage.append_state_data_direct(
-                state_id=state_id,
+        if direct:
+            state_id = messages[0]['state_id']
+            segment = self.direct_segment(state_id=state_id, query_states=all_query_states)
+        else:
+            # Resolve route info once per batch (cached across batches), an unknown route is not retried
+            try:
+                with stage_latency.time(stage="resolve"):
+                    resolution = await self.route_cache.resolve(route_id=route_id)
+            except ValueError as e:
+                logger.error(f"unable to resolve route_id {route_id}, dropping batch: {e}")
+                return
+
+            state_id = resolution.state_id
+            segment = WriteSegment(
                 query_states=all_query_states,
                 scope_variable_mappings={
-                    "route_id": route_id,
-                    "provider": provider,
-                    "processor": processor,
-                    "processor_state": processor_state,
+                    **resolution.scope_variable_mappings(),
                     "data": None,
                 }
             )
 
-            # Downstream routing
-            if updated_state:
+        logger.info(
+            f'persisting batch of {len(all_query_states)} rows '
+            f'to state: {state_id} (route: {route_id})'
+        )
+
+        # rows of other routes into the same state are merged into a single write
+        started = time.monotonic()
+        updated_state = await self.persist_segment(
+            state_id=state_id,
+            route_id=None if direct else route_id,
+            segment=segment
+        )
+
+        # feed the persist latency back into the adaptive batch window
+        if self.batch_sizer:
+            self.batch_sizer.record_persist(rows=len(all_query_states), seconds=time.monotonic() - started)
+
+        # Downstream routing, the rows are persisted and thus acked even if forwarding fails
+        if updated_state:
+            try:
                 await self.route_query_states(
-                    state=updated_state, query_states=all_query_states
+                    state=updated_state, query_states=self.direct_rows(segment) if direct else all_query_states
                 )
-        except Exception as e:
-            logger.error(f"error processing batch for route_id {route_id}: {e}")
+            except Exception as e:
+                logger.error(f"error routing batch for route_id {route_id}: {e}")
 
 
-if __name__ == '__main__':
+def run_consumer():
     consumer = MessagingStateSyncConsumer(
-        route=state_sync_route,
-        monitor_route=monitor_route
+        route=get_state_sync_route(),
+        monitor_route=get_monitor_route()
     )
 
     # TODO the bottleneck is going to be the state persistence, we need a mechanism to distribute the
@@ -453,3 +775,78 @@ if __name__ == '__main__':
 
     consumer.setup_shutdown_signal()
     asyncio.get_event_loop().run_until_complete(consumer.start_consumer())
+
+
+def worker_environment(index: int, workers: int) -> Dict[str, str]:
+    """
+    Settings of a worker process: its index, a local metrics port and a spool directory of its own, worker 0 also
+    replays the spools of workers that no longer run. The ready file is kept by the supervisor, from the readiness
+    of all workers.
+    """
+    env = {
+        "WORKER_INDEX": str(index),
+        "WORKER_COUNT": str(workers),
+        "READY_FILE": "",
+    }
+    if METRICS_PORT:
+        env["METRICS_HOST"] = "127.0.0.1"
+        env["METRICS_PORT"] = str(METRICS_PORT + 1 + index)
+    if WRITE_SPOOL_DIR:
+        env["WRITE_SPOOL_DIR"] = os.path.join(WRITE_SPOOL_DIR, f"worker-{index}")
+        env["WRITE_SPOOL_ORPHANS"] = os.pathsep.join(orphaned_spool_dirs(WRITE_SPOOL_DIR, workers)) if index == 0 else ""
+    return env
+
+
+async def supervise_workers(workers: int):
+    """
+    Multi-process mode: each worker runs its own consumer, with its own database pool and caches, bound
+    to the same durable consumer (or to partitions of their own) such that the stream is shared between them.
+    Workers may append to the same state at once, the state writer serializes them with a row lock.
+    """
+    supervisor = WorkerSupervisor(
+        workers=workers,
+        target=run_consumer,
+        worker_env=lambda index: worker_environment(index, workers),
+        grace_period=WORKER_SHUTDOWN_GRACE
+    )
+
+    readiness_task = None
+    if METRICS_PORT:
+        server = AggregatedMetricsServer(
+            supervisor=supervisor,
+            worker_ports=[METRICS_PORT + 1 + index for index in range(workers)],
+            host=METRICS_HOST,
+            port=METRICS_PORT,
+            readiness=Readiness(checks=[f'worker-{index}' for index in range(workers)], ready_file=READY_FILE)
+        )
+        try:
+            await server.start()
+        except OSError as e:
+            logger.warning(f'unable to serve metrics on port {METRICS_PORT}: {e}')
+
+        if READY_FILE:
+            readiness_task = asyncio.create_task(server.watch_readiness())
+    elif READY_FILE:
+        logger.warning('the ready file requires METRICS_PORT in multi-process mode, workers report readiness over it')
+
+    try:
+        await supervisor.run()
+    finally:
+        if readiness_task:
+            readiness_task.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="state sync store consumer")
+    parser.add_argument("--workers", default=WORKERS,
+                        help='consumer processes, "auto" for one per available core (default: 1)')
+    args = parser.parse_args()
+
+    workers = resolve_worker_count(args.workers)
+    if workers > 1 and not USE_LIGHTWEIGHT_MODE:
+        parser.error('--workers requires lightweight mode (STATE_SYNC_LIGHTWEIGHT=true), standard mode saves '
+                     'whole states, which are not locked against the other workers')
+    if workers > 1:
+        asyncio.run(supervise_workers(workers))
+    else:
+        run_consumer()
@@ -1,22 +1,60 @@
-# pulsar messaging provider is used, the routes are defined in the routing.yaml
+# nats messaging provider is used, the routes are defined in the routing.yaml
+#
+# the provider, router and routes are created on first use rather than on import, such that importing the
+# consumer modules has no side effects (e.g. in the benchmarks, or a worker supervisor that never consumes)
+import functools
 import os
 
 from ismcore.messaging.base_message_router import Router
 from ismcore.messaging.nats_message_provider import NATSMessageProvider
+from ismcore.messaging.nats_message_route import NATSRoute
+
+from environment import MSG_MANAGE_TOPIC
 
 ROUTING_FILE = os.environ.get("ROUTING_FILE", '.routing.yaml')
 
-message_provider = NATSMessageProvider()
-message_router = Router(
-    provider=message_provider,
-    yaml_file=ROUTING_FILE
-)
 
-# find the monitor route for telemetry updates
-monitor_route = message_router.find_route("processor/monitor")
+@functools.lru_cache(maxsize=None)
+def get_message_provider() -> NATSMessageProvider:
+    """The message provider shared by all routes of the process."""
+    return NATSMessageProvider()
+
+
+@functools.lru_cache(maxsize=None)
+def get_message_router() -> Router:
+    """The routing table of the routing file, parsed once."""
+    return Router(
+        provider=get_message_provider(),
+        yaml_file=ROUTING_FILE
+    )
+
+
+def get_monitor_route() -> NATSRoute:
+    """The monitor route for telemetry updates."""
+    return get_message_router().find_route("processor/monitor")
+
+
+def get_state_sync_route() -> NATSRoute:
+    """The state sync route, consumed by this processor."""
+    return get_message_router().find_route("processor/state/sync")
+
+
+def get_state_router_route() -> NATSRoute:
+    """The state router route, on which query states are forwarded downstream."""
+    return get_message_router().find_route("processor/state/router")
 
-# find the state sync route
-state_sync_route = message_router.find_route("processor/state/sync")
 
-# find the state router route
-state_router_route = message_router.find_route("processor/state/router")
+@functools.lru_cache(maxsize=None)
+def get_state_sync_manage_route() -> NATSRoute:
+    """
+    The management route (cache invalidation), derived from the state sync route connection but on the
+    manage topic, as a core nats subject (not jetstream) so that every replica receives each message.
+    """
+    state_sync_route = get_state_sync_route()
+    return state_sync_route.clone({
+        "name": f"{state_sync_route.name}_manage",
+        "selector": "processor/state/sync/manage",
+        "subject": MSG_MANAGE_TOPIC,
+        "queue": None,
+        "jetstream_enabled": False,
+    })
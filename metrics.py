@@ -0,0 +1,317 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from ismcore.messaging.base_message_route_model import BaseRoute
+from ismcore.utils.ism_logger import ism_logger
+
+from codec import json_codec
+from readiness import Readiness
+
+logger = ism_logger(__name__)
+
+# (metric name, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+
+# series of a collector: (metric name, metric type, description, [(labels, value), ...])
+Collected = Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def escape_label_value(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """A named series with optional labels. Safe to update from the storage threads."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, Any]) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def labels_of(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.label_names, key))
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = ()):
+        super().__init__(name, description, label_names)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self.lock:
+            return [(self.name, self.labels_of(key), value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.series: Dict[tuple, list] = {}     # key => [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        with self.lock:
+            for key, series in self.series.items():
+                labels = self.labels_of(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', {**labels, "le": format_value(bound)}, cumulative))
+                samples.append((f'{self.name}_sum', labels, series[-2]))
+                samples.append((f'{self.name}_count', labels, series[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Metrics of the hot path, rendered in the Prometheus text format.
+
+    Series are either updated in place (counters, gauges, histograms) or collected when rendered,
+    from the counters that the caches, publisher and batch sizer already keep.
+    """
+
+    def __init__(self, namespace: str = "state_sync"):
+        self.namespace = namespace
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], Iterable[Collected]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        metric.name = f'{self.namespace}_{metric.name}'
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, label_names: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, label_names: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, label_names, buckets))
+
+    def register_collector(self, collector: Callable[[], Iterable[Collected]]):
+        """
+        Register a callable invoked on every render, returning the series it collected as
+        (name, type, description, [(labels, value), ...]) tuples.
+        """
+        self.collectors.append(collector)
+
+    def collect(self) -> List[Tuple[str, str, str, List[Sample]]]:
+        collected = [
+            (metric.name, metric.type, metric.description, metric.samples())
+            for metric in self.metrics.values()
+        ]
+
+        for collector in self.collectors:
+            try:
+                for name, metric_type, description, values in collector():
+                    name = f'{self.namespace}_{name}'
+                    samples = [(name, labels, value) for labels, value in values]
+                    collected.append((name, metric_type, description, samples))
+            except Exception as e:
+                logger.warning(f'failed to collect metrics: {e}')
+
+        return collected
+
+    def render(self) -> str:
+        lines = []
+        for metric_name, metric_type, description, samples in self.collect():
+            lines.append(f'# HELP {metric_name} {description}')
+            lines.append(f'# TYPE {metric_name} {metric_type}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict[str, float]:
+        """Flat series => value, without histogram buckets, as published on the monitor route."""
+        return {
+            f'{name}{format_labels(labels)}': value
+            for _, _, _, samples in self.collect()
+            for name, labels, value in samples
+            if not name.endswith('_bucket')
+        }
+
+
+class MetricsServer:
+    """Serves the registry on GET /metrics of a local http port, and the readiness on GET /ready."""
+
+    def __init__(self, registry: MetricsRegistry, host: str = "0.0.0.0", port: int = 9090,
+                 readiness: Optional[Readiness] = None):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.readiness = readiness
+        self.server: Optional[asyncio.base_events.Server] = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # drain the request headers
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else ''
+            if path == '/metrics':
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", await self.render()
+            elif path == '/ready' and self.readiness:
+                status = "200 OK" if await self.check_ready() else "503 Service Unavailable"
+                content_type, body = "text/plain", self.readiness.render()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+
+            payload = body.encode('utf-8')
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + payload
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f'metrics request failed: {e}')
+        finally:
+            writer.close()
+
+    async def render(self) -> str:
+        return self.registry.render()
+
+    async def check_ready(self) -> bool:
+        return self.readiness.ready
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, host=self.host, port=self.port)
+        logger.info(f'serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+async def monitor_event_loop_lag(gauge: Gauge, histogram: Histogram, interval: float = 0.5):
+    """Measure how late the event loop wakes up a sleeping task, i.e. how long callbacks block it."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        gauge.set(lag)
+        histogram.observe(lag)
+
+
+async def publish_metrics(registry: MetricsRegistry, route: BaseRoute, interval: float = 60.0):
+    """Periodically publish a snapshot of the registry on the monitor route."""
+    source = os.environ.get("HOSTNAME", "")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await route.publish(json_codec.dumps({
+                "type": "metrics",
+                "source": source,
+                "timestamp": time.time(),
+                "metrics": registry.snapshot(),
+            }))
+        except Exception as e:
+            logger.warning(f'unable to publish metrics on monitor route: {e}')
+
+
+# the registry of this process, along with the series instrumented on the hot path
+metrics = MetricsRegistry()
+
+messages_consumed = metrics.counter(
+    "messages_consumed_total", "Consumed messages, by message type", ["type"])
+rows_persisted = metrics.counter(
+    "rows_persisted_total", "Query state rows persisted")
+batch_rows = metrics.histogram(
+    "batch_rows", "Query state rows per persisted batch", buckets=DEFAULT_SIZE_BUCKETS)
+stage_latency = metrics.histogram(
+    "stage_latency_seconds", "Latency of the processing stages: resolve, transform, persist and forward", ["stage"])
+event_loop_lag = metrics.gauge(
+    "event_loop_lag_seconds", "Most recently measured event loop lag")
+event_loop_lag_histogram = metrics.histogram(
+    "event_loop_lag_histogram_seconds", "Event loop lag")
+in_flight_messages = metrics.gauge(
+    "in_flight_messages", "Consumed messages not yet acked (buffered, queued or persisting), by subject", ["subject"])
+consumer_lag = metrics.gauge(
+    "consumer_lag_seconds", "Age of the oldest consumed message not yet acked, by subject", ["subject"])
+consumer_pending = metrics.gauge(
+    "consumer_pending_messages", "Messages of the stream not yet delivered to the consumer, by subject", ["subject"])
+consumer_paused = metrics.counter(
+    "consumer_paused_seconds_total", "Time the consumer stopped fetching for lack of in-flight capacity", ["subject"])
+messages_nacked = metrics.counter(
+    "messages_nacked_total", "Messages negatively acked for redelivery, after a failed persist", ["subject"])
+groups_scheduled = metrics.counter(
+    "groups_scheduled_total", "Groups taken by the persist workers, by priority class and subject",
+    ["priority", "subject"])
+group_wait = metrics.histogram(
+    "group_wait_seconds", "Time a ready group waited for a persist worker, by priority class", ["priority"])
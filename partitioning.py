@@ -0,0 +1,102 @@
+import os
+import re
+import zlib
+from typing import List
+
+import nats.js.api
+import nats.js.errors
+from ismcore.messaging.nats_message_route import NATSRoute
+from ismcore.utils.ism_logger import ism_logger
+from nats.js.api import StorageType, RetentionPolicy
+
+logger = ism_logger(__name__)
+
+
+def partition_for(key: str, partition_count: int) -> int:
+    """Stable partition of a key (state_id or route_id), the same on every replica and restart."""
+    return zlib.crc32(key.encode('utf-8')) % partition_count
+
+
+def partition_subject(subject: str, partition: int) -> str:
+    # partitions live in their own stream, outside of {subject}.> which the main stream already owns
+    return f"{subject}_part.{partition}"
+
+
+def parse_partition_ids(spec: str, partition_count: int, replicas: int = 1) -> List[int]:
+    """
+    Parse the partitions owned by this process:
+        all         - every partition
+        0,2,5 / 0-3 - explicit partition ids and ranges
+        ordinal     - derived from the pod ordinal (statefulset hostname suffix), partition % replicas == ordinal
+    """
+    spec = (spec or "all").strip().lower()
+    if spec == "all":
+        return list(range(partition_count))
+
+    if spec == "ordinal":
+        hostname = os.environ.get("HOSTNAME", "")
+        match = re.search(r'-(\d+)$', hostname)
+        if not match:
+            raise ValueError(f'unable to derive partition ordinal from hostname: {hostname}')
+        ordinal = int(match.group(1))
+        return [partition for partition in range(partition_count) if partition % replicas == ordinal]
+
+    partitions = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            partitions.update(range(int(start), int(end) + 1))
+        else:
+            partitions.add(int(part))
+
+    invalid = [partition for partition in partitions if partition < 0 or partition >= partition_count]
+    if invalid:
+        raise ValueError(f'invalid partition ids {invalid}, partition count is {partition_count}')
+
+    return sorted(partitions)
+
+
+def create_partition_route(route: NATSRoute, partition: int) -> NATSRoute:
+    """Clone the route for one partition, with its own subject and durable consumer."""
+    return route.clone({
+        "name": f"{route.name}_part",
+        "subject": partition_subject(route.subject, partition),
+        "consumer_id": f"p{partition}",
+    })
+
+
+async def ensure_partition_stream(connected_route: NATSRoute, route: NATSRoute, partition_count: int):
+    """
+    Create or update the partition stream of a route such that it accepts every partition subject,
+    before any partition is published to or consumed from.
+    """
+    js = connected_route._nc.jetstream()
+    name = f"{route.name}_part"
+    required_subjects = []
+    for partition in range(partition_count):
+        subject = partition_subject(route.subject, partition)
+        required_subjects.extend([subject, f"{subject}.>"])
+
+    try:
+        stream_info = await js.stream_info(name)
+        current_subjects = stream_info.config.subjects or []
+        missing = [subject for subject in required_subjects if subject not in current_subjects]
+        if missing:
+            logger.info(f"updating partition stream {name} to add subjects: {missing}")
+            await js.update_stream(config=nats.js.api.StreamConfig(
+                name=name,
+                subjects=current_subjects + missing,
+                storage=stream_info.config.storage,
+                retention=stream_info.config.retention,
+            ))
+    except nats.js.errors.NotFoundError:
+        logger.info(f"creating partition stream: {name} with {partition_count} partitions")
+        await js.add_stream(nats.js.api.StreamConfig(
+            name=name,
+            subjects=required_subjects,
+            storage=StorageType.FILE,
+            retention=RetentionPolicy.WORK_QUEUE
+        ))
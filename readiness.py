@@ -0,0 +1,72 @@
+import os
+from typing import Dict, Iterable, List
+
+from ismcore.utils.ism_logger import ism_logger
+
+logger = ism_logger(__name__)
+
+# checks of a consumer process, the database connection pool and the nats connections of its routes
+CHECK_DATABASE = "database"
+CHECK_NATS = "nats"
+
+
+class Readiness:
+    """
+    Whether the process is ready to take traffic, i.e. all of its checks passed.
+
+    Served on GET /ready of the metrics server, and optionally signalled by a file that exists only
+    while the process is ready (e.g. for an exec probe). A process is no longer ready once it shuts down.
+    """
+
+    def __init__(self, checks: Iterable[str], ready_file: str = None):
+        self.checks: Dict[str, bool] = {check: False for check in checks}
+        self.ready_file = ready_file
+        self.stopping = False
+
+        # a file left by a previous run does not signal readiness of this one
+        if ready_file and os.path.exists(ready_file):
+            os.remove(ready_file)
+
+    @property
+    def ready(self) -> bool:
+        return not self.stopping and all(self.checks.values())
+
+    def pending(self) -> List[str]:
+        """The checks that did not pass yet."""
+        return [check for check, passed in self.checks.items() if not passed]
+
+    def set(self, check: str, passed: bool = True):
+        was_ready = self.ready
+        self.checks[check] = passed
+        self.changed(was_ready)
+
+    def stop(self):
+        was_ready = self.ready
+        self.stopping = True
+        self.changed(was_ready)
+
+    def changed(self, was_ready: bool):
+        if self.ready == was_ready:
+            return
+
+        if self.ready:
+            logger.info('ready to consume')
+        else:
+            logger.info(f'not ready, pending: {", ".join(self.pending()) or "shutdown"}')
+
+        if not self.ready_file:
+            return
+
+        try:
+            if self.ready:
+                with open(self.ready_file, 'w') as file:
+                    file.write('ready\n')
+            elif os.path.exists(self.ready_file):
+                os.remove(self.ready_file)
+        except OSError as e:
+            logger.warning(f'unable to update ready file {self.ready_file}: {e}')
+
+    def render(self) -> str:
+        if self.ready:
+            return 'ready\n'
+        return f'not ready, pending: {", ".join(self.pending()) or "shutdown"}\n'
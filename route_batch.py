@@ -0,0 +1,359 @@
+import asyncio
+import time
+from typing import Optional, Any, Dict, List, Callable
+
+import nats.js.errors
+from nats.aio.errors import ErrConnectionClosed, ErrTimeout, ErrNoServers
+from ismcore.messaging.nats_message_route import NATSRoute
+from ismcore.messaging.nats_message_route_batch import NATSRouteBatch
+from ismcore.utils.ism_logger import ism_logger
+from pydantic import PrivateAttr
+
+from batching import PendingGroup
+from codec import json_codec
+from metrics import in_flight_messages, consumer_lag, consumer_pending, consumer_paused, messages_nacked
+from partitioning import partition_for, partition_subject
+from scheduling import GroupScheduler, SCHEDULER_FIFO
+
+logger = ism_logger(__name__)
+
+
+class StateSyncRouteBatch(NATSRouteBatch):
+    """
+    Batch route for the state sync consumer.
+
+    Unlike NATSRouteBatch, which awaits each group in turn, ready groups are handed to a scheduler
+    and persisted by a number of workers, so that batches for different route ids persist at the same
+    time while the next messages are fetched. The storage layer bounds how many of them actually hit
+    the database at once. The scheduler takes the groups in the order they are ready (fifo), or shares
+    the workers fairly between the group keys, weighted by their priority class (fair).
+
+    Flow control: once max_in_flight messages are fetched but not yet acked, or the scheduler is full,
+    the route stops fetching until the workers free capacity. Messages are acked only after their
+    group was persisted, and negatively acked (redelivered after nak_delay) when persisting failed.
+
+    When a batch sizer is set, groups are buffered across fetches and each group is flushed once it
+    reaches the sizer's row count, byte size or linger time (adaptive batch window). Otherwise every
+    group is flushed right after the fetch it arrived in.
+
+    When a partition count is set, the route acts as the partition forwarder: rather than processing
+    a group, its raw messages are republished to the partition subject of the group's partition key.
+
+    When a dedup window is set, messages already persisted, or buffered and in flight, are acked and
+    dropped as they are fetched. The keys of a group are added to the window once it was persisted.
+    """
+    batch_sizer: Optional[Any] = None   # AdaptiveBatchSizer
+
+    # partition forwarding
+    partition_count: Optional[int] = 0
+    partition_key_fn: Optional[Callable] = None     # async (message) -> partition key
+
+    # flow control, 0 disables the in-flight bound (the scheduler always holds at most persist_workers groups)
+    max_in_flight: Optional[int] = 0
+    persist_workers: Optional[int] = 4
+    nak_delay: Optional[float] = 1.0
+    pending_sample_interval: Optional[float] = 5.0
+
+    # scheduling of the ready groups, see GroupScheduler
+    scheduler: Optional[str] = SCHEDULER_FIFO
+    group_max_concurrency: Optional[int] = 0
+    priority_classes: Optional[Dict[str, Any]] = None       # name => PriorityClass
+    priority_fn: Optional[Callable] = None          # (group key) -> priority class name
+
+    # deduplication of redelivered messages and upstream retries
+    dedup: Optional[Any] = None     # DedupWindow
+
+    _pending: Dict[str, PendingGroup] = PrivateAttr(default_factory=dict)
+    _scheduler: Optional[GroupScheduler] = PrivateAttr(default=None)
+    _processing: set = PrivateAttr(default_factory=set)     # groups queued or being persisted
+    _in_flight: int = PrivateAttr(default=0)
+    _capacity: Optional[asyncio.Event] = PrivateAttr(default=None)
+    _pending_sampled_at: float = PrivateAttr(default=0.0)
+    _in_flight_keys: set = PrivateAttr(default_factory=set)
+
+    @classmethod
+    def from_route(cls, route: NATSRoute, batch_callback: callable, group_by_fn: callable,
+                   **kwargs) -> 'StateSyncRouteBatch':
+        """Construct a StateSyncRouteBatch from an existing NATSRoute's config."""
+        return cls(
+            **route.model_dump(),
+            batch_callback=batch_callback,
+            group_by_fn=group_by_fn,
+            **kwargs
+        )
+
+    def buffer_messages(self, messages: list) -> list:
+        """
+        Parse and add the messages to their pending group, returns the messages that cannot be grouped
+        or are duplicates of persisted messages, to be acked right away.
+        """
+        unprocessable = []
+        dedup = self.dedup if self.dedup and self.dedup.enabled and not self.partition_count else None
+        for msg in messages:
+            dedup_key = dedup.key_of(msg) if dedup else None
+            if dedup and dedup_key is not None and dedup_key in self._in_flight_keys:
+                # a redelivery of a message whose group is still persisting has the same stream sequence, acking
+                # the copy would ack the original too, so it is dropped unacked and the group's ack or nak decides
+                logger.debug("dropping duplicate of an in-flight message, without acking it")
+                dedup.duplicates += 1
+                continue
+
+            if dedup and dedup.seen(dedup_key):
+                logger.debug("dropping duplicate message")
+                unprocessable.append(msg)
+                continue
+
+            try:
+                # the codec decodes the raw utf-8 payload, without an intermediate str copy
+                data = json_codec.loads(msg.data)
+            except Exception as e:
+                logger.warning(f"skipping unparseable message: {e}")
+                unprocessable.append(msg)
+                continue
+
+            try:
+                key = self.group_by_fn(data) if self.group_by_fn else None
+            except Exception as e:
+                logger.warning(f"failed to extract group key: {e}")
+                key = None
+
+            if key is None:
+                logger.warning("message has no group key, skipping")
+                unprocessable.append(msg)
+                continue
+
+            group = self._pending.get(key)
+            if group is None:
+                group = self._pending[key] = PendingGroup(group_key=key)
+            group.add(msg=msg, data=data, size=len(msg.data), key=dedup_key)
+            self._in_flight += 1
+            if dedup_key is not None:
+                self._in_flight_keys.add(dedup_key)
+
+        return unprocessable
+
+    def take_ready_groups(self, force: bool = False) -> List[PendingGroup]:
+        ready = []
+        for key, group in list(self._pending.items()):
+            if self.batch_sizer and not force:
+                trigger = self.batch_sizer.flush_trigger(group)
+                if not trigger:
+                    continue
+                self.batch_sizer.record_flush(group, trigger)
+
+            ready.append(self._pending.pop(key))
+        return ready
+
+    def fetch_timeout(self, backoff_time: float) -> float:
+        if not self.batch_sizer or not self._pending:
+            return backoff_time
+
+        # wake up in time to flush the oldest lingering group
+        deadline = self.batch_sizer.next_deadline(list(self._pending.values()))
+        return max(0.001, min(backoff_time, deadline))
+
+    async def fetch(self, timeout: float) -> list:
+        try:
+            return await self._fetch_messages(timeout=timeout)
+        except (ErrConnectionClosed, ErrTimeout, ErrNoServers):
+            raise
+        except (nats.js.errors.FetchTimeoutError, TimeoutError):
+            return []
+
+    async def ack_messages(self, messages: list):
+        for msg in messages:
+            try:
+                await self.ack(msg)
+            except Exception as e:
+                logger.warning(f"failed to ack message: {e}")
+
+    async def nak_messages(self, messages: list):
+        """Negatively ack the messages, such that they are redelivered after the nak delay."""
+        if not self.jetstream_enabled:
+            return
+
+        messages_nacked.inc(len(messages), subject=self.subject)
+        for msg in messages:
+            try:
+                await msg.nak(delay=self.nak_delay)
+            except Exception as e:
+                logger.warning(f"failed to nak message: {e}")
+
+    async def forward_group(self, group: PendingGroup):
+        try:
+            key = group.group_key
+            if self.partition_key_fn:
+                key = await self.partition_key_fn(group.data[0])
+
+            subject = partition_subject(self.subject, partition_for(key, self.partition_count))
+            await asyncio.gather(*[
+                self._js.publish(subject=subject, payload=msg.data)
+                for msg in group.messages
+            ])
+        except Exception as e:
+            logger.error(f"failed to forward group {group.group_key} to its partition: {e}")
+            await self.nak_messages(group.messages)
+            return
+
+        await self.ack_messages(group.messages)
+
+    async def process_group(self, group: PendingGroup):
+        if self.partition_count:
+            await self.forward_group(group)
+            return
+
+        try:
+            await self.batch_callback(self, group.group_key, group.data)
+        except Exception as e:
+            # not persisted, redeliver the messages of the group rather than acking them
+            logger.error(f"error processing batch for group {group.group_key}: {e}")
+            await self.nak_messages(group.messages)
+            return
+
+        # ack the messages of the group only once it was persisted, from then on their copies are duplicates
+        if self.dedup:
+            self.dedup.mark(group.keys)
+        await self.ack_messages(group.messages)
+
+    async def persist_worker(self):
+        while True:
+            group = await self._scheduler.get()
+            try:
+                await self.process_group(group)
+            except Exception as e:
+                logger.error(f"unexpected error processing group {group.group_key}: {e}")
+            finally:
+                self._processing.discard(group)
+                self._in_flight_keys.difference_update(group.keys)
+                self._in_flight -= len(group.messages)
+                self._capacity.set()
+                self._scheduler.done(group)
+
+    async def enqueue_groups(self, groups: List[PendingGroup]):
+        """Hand the groups to the scheduler of the persist workers, waits while the scheduler is full."""
+        if not groups:
+            return
+
+        logger.info(
+            f"queueing {len(groups)} groups "
+            f"({sum(len(group.messages) for group in groups)} messages)"
+        )
+        for group in groups:
+            self._processing.add(group)
+            if not self._scheduler.full():
+                self._scheduler.put_nowait(group)
+                continue
+
+            # all workers are busy, fetching resumes once one of them takes a group
+            paused_at = time.monotonic()
+            await self._scheduler.put(group)
+            consumer_paused.inc(time.monotonic() - paused_at, subject=self.subject)
+
+    def has_capacity(self) -> bool:
+        return not self.max_in_flight or self._in_flight < self.max_in_flight
+
+    async def wait_for_capacity(self):
+        """Stop fetching while max_in_flight messages are not yet acked."""
+        if self.has_capacity():
+            return
+
+        # lingering groups are flushed, or they would hold on to capacity that only they can free
+        paused_at = time.monotonic()
+        logger.debug(f"{self._in_flight} messages in flight on subject: {self.subject}, pausing fetch")
+        await self.enqueue_groups(self.take_ready_groups(force=True))
+
+        while not self.has_capacity() and self.consumer_active:
+            self._capacity.clear()
+            try:
+                await asyncio.wait_for(self._capacity.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            self.update_lag()
+
+        consumer_paused.inc(time.monotonic() - paused_at, subject=self.subject)
+
+    def update_lag(self):
+        groups = list(self._pending.values()) + list(self._processing)
+        in_flight_messages.set(self._in_flight, subject=self.subject)
+        consumer_lag.set(max((group.age for group in groups), default=0.0), subject=self.subject)
+
+    async def sample_pending(self):
+        """Messages of the stream not yet delivered to this consumer, sampled every few seconds."""
+        now = time.monotonic()
+        if not self._js_pull_sub or now - self._pending_sampled_at < self.pending_sample_interval:
+            return
+
+        self._pending_sampled_at = now
+        try:
+            info = await self._js_pull_sub.consumer_info()
+            consumer_pending.set(info.num_pending or 0, subject=self.subject)
+        except Exception as e:
+            logger.debug(f"unable to sample pending messages on subject: {self.subject}: {e}")
+
+    async def consume(self, wait: bool = True):
+        logger.info(
+            f'consume:start (batch) for route: {self.name}, subject: {self.subject}, '
+            f'batch_size: {self.batch_size}, adaptive: {self.batch_sizer is not None}, '
+            f'max_in_flight: {self.max_in_flight}, persist_workers: {self.persist_workers}, '
+            f'scheduler: {self.scheduler}'
+        )
+
+        backoff_base = 0.1
+        backoff_factor = 2
+        max_backoff = 1.0
+        backoff_time = backoff_base
+        self.consumer_active = True
+
+        # groups lingering from a previous consume are still in flight
+        workers = max(1, self.persist_workers or 1)
+        self._scheduler = GroupScheduler(
+            mode=self.scheduler,
+            max_concurrency=self.group_max_concurrency,
+            # as few groups wait as keep the workers busy, such that a burst of a key cannot queue ahead of others
+            max_queued=workers,
+            priority_classes=self.priority_classes,
+            priority_fn=self.priority_fn,
+            subject=self.subject
+        )
+        self._capacity = asyncio.Event()
+        self._in_flight = sum(len(group.messages) for group in self._pending.values())
+        self._in_flight_keys = {key for group in self._pending.values() for key in group.keys}
+        tasks = [asyncio.create_task(self.persist_worker()) for _ in range(workers)]
+
+        try:
+            while wait and self.consumer_active:
+                try:
+                    await self.wait_for_capacity()
+                    messages = await self.fetch(timeout=self.fetch_timeout(backoff_time))
+
+                    if messages:
+                        logger.info(f"fetched {len(messages)} messages on subject: {self.subject}")
+                        await self.ack_messages(self.buffer_messages(messages))
+                        backoff_time = backoff_base
+                    else:
+                        logger.debug(f"no data received, backing off for {backoff_time} seconds...")
+                        backoff_time = min(backoff_time * backoff_factor, max_backoff)
+
+                    await self.enqueue_groups(self.take_ready_groups())
+                    self.update_lag()
+                    await self.sample_pending()
+                except (ErrConnectionClosed, ErrTimeout, ErrNoServers) as e:
+                    raise InterruptedError(e)
+                except ValueError as e:
+                    logger.critical(f"failed to process batch, ignoring: {e}")
+                except Exception as e:
+                    if self.consumer_active:
+                        raise ValueError(e)
+
+            # flush whatever is still buffered and wait for it to persist before shutting down
+            await self.enqueue_groups(self.take_ready_groups(force=True))
+            await self._scheduler.join()
+        finally:
+            # on an interrupted consume, queued groups are not acked and thus redelivered
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._processing.clear()
+            self.update_lag()
+
+        self.consumer_active = False
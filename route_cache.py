@@ -0,0 +1,262 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Dict, Callable, List
+
+from ismcore.model.base_model import Processor, ProcessorProvider, ProcessorState, ProcessorStateDirection
+from ismcore.model.processor_state import State, RoutingMode, RoutingDispatch
+from ismcore.utils.ism_logger import ism_logger
+
+from async_storage import AsyncStorage
+from route_publisher import ROUTING_DISPATCH_CHUNKED
+
+logger = ism_logger(__name__)
+
+
+class TTLCache:
+    """
+    Size bounded cache with a time-to-live per entry and least recently used eviction.
+    Not thread-safe, it is only meant to be used from the event loop.
+    """
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 300.0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple] = OrderedDict()   # key => (expires_at, value)
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, key: str) -> Optional[Any]:
+        """The value of a key that did not expire yet, without counting a hit or miss or refreshing its recency."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def invalidate(self, key: str) -> bool:
+        if self.entries.pop(key, None) is None:
+            return False
+        self.invalidations += 1
+        return True
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]) -> int:
+        keys = [key for key, (_, value) in self.entries.items() if predicate(value)]
+        for key in keys:
+            self.invalidate(key)
+        return len(keys)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hit_ratio,
+        }
+
+
+class RouteResolution:
+    """The resolved route metadata required to persist the query states of a route."""
+
+    def __init__(self, route_id: str, processor_state: ProcessorState,
+                 processor: Processor, provider: ProcessorProvider):
+        self.route_id: str = route_id
+        self.processor_state: ProcessorState = processor_state
+        self.processor: Processor = processor
+        self.provider: ProcessorProvider = provider
+
+    @property
+    def state_id(self) -> str:
+        return self.processor_state.state_id
+
+    def scope_variable_mappings(self) -> dict:
+        return {
+            "route_id": self.route_id,
+            "provider": self.provider,
+            "processor": self.processor,
+            "processor_state": self.processor_state,
+        }
+
+
+class RouteCache(TTLCache):
+    """
+    Caches the processor state route, processor and provider of a route_id, such that a batch
+    does not need three database round trips before it can write any data.
+    """
+
+    def __init__(self, storage: AsyncStorage, max_size: int = 1024, ttl: float = 300.0):
+        super().__init__(name="route", max_size=max_size, ttl=ttl)
+        self.storage = storage
+        self.pending: Dict[str, asyncio.Future] = {}    # in-flight lookups, by route_id
+
+    async def resolve(self, route_id: str) -> RouteResolution:
+        resolution = self.get(route_id)
+        if resolution:
+            return resolution
+
+        # concurrent misses on the same route share a single lookup
+        if route_id in self.pending:
+            return await asyncio.shield(self.pending[route_id])
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[route_id] = future
+        try:
+            resolution = await self.load(route_id=route_id)
+            self.put(route_id, resolution)
+            future.set_result(resolution)
+            return resolution
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved, the caller receives the raised exception
+            raise
+        finally:
+            self.pending.pop(route_id, None)
+
+    async def load(self, route_id: str) -> RouteResolution:
+        processor_state = await self.storage.fetch_processor_state_route(route_id=route_id)
+
+        # ensure that processor state route is correct
+        if not processor_state or len(processor_state) != 1:
+            raise ValueError(
+                f'unable to identity route id {route_id}, '
+                f'expected 1 result, received {processor_state}'
+            )
+
+        # unpack the processor state since there should only be one result
+        processor_state = processor_state[0]
+        processor = await self.storage.fetch_processor(processor_id=processor_state.processor_id)
+        provider = await self.storage.fetch_processor_provider(id=processor.provider_id)
+
+        return RouteResolution(
+            route_id=route_id,
+            processor_state=processor_state,
+            processor=processor,
+            provider=provider
+        )
+
+    def invalidate_state(self, state_id: str) -> int:
+        return self.invalidate_where(lambda resolution: resolution.state_id == state_id)
+
+
+class RoutingPlan:
+    """
+    The compiled downstream routing of a state: whether to route after save, how and to where, and the
+    priority class its batches are persisted with.
+    """
+
+    def __init__(self, state_id: str, route_after_save: bool, dispatch: str, forward_route_ids: List[str],
+                 priority: Optional[str] = None):
+        self.state_id: str = state_id
+        self.route_after_save: bool = route_after_save
+        self.dispatch: str = dispatch
+        self.forward_route_ids: List[str] = forward_route_ids
+        self.priority: Optional[str] = priority
+
+    @property
+    def dispatch_batch(self) -> bool:
+        return self.dispatch == RoutingDispatch.BATCH.value
+
+    @staticmethod
+    def compile_properties(state: State) -> tuple:
+        """Parse the typed routing properties of a state once, returns (route_after_save, dispatch)."""
+        props = state.typed_properties
+        route_after_save = False
+        dispatch = RoutingDispatch.INDIVIDUAL.value
+
+        if props.routing and props.routing.mode:
+            route_after_save = RoutingMode(props.routing.mode) == RoutingMode.AFTER_SAVE
+
+        if props.routing and props.routing.dispatch:
+            dispatch = props.routing.dispatch
+            if dispatch != ROUTING_DISPATCH_CHUNKED:
+                dispatch = RoutingDispatch(dispatch).value
+
+        return route_after_save, dispatch
+
+    @staticmethod
+    def compile_priority(state: State) -> Optional[str]:
+        """The priority class of the state, from the untyped routing properties: {"routing": {"priority": "high"}}."""
+        routing = (state.properties or {}).get('routing')
+        priority = routing.get('priority') if isinstance(routing, dict) else None
+        return str(priority).lower() if priority else None
+
+
+class RoutingPlanCache(TTLCache):
+    """
+    Caches the routing plan of a state by state_id, such that routing a saved batch does not
+    need to re-parse the state properties or query the forward routes when the cache is warm.
+    """
+
+    def __init__(self, storage: AsyncStorage, max_size: int = 1024, ttl: float = 300.0):
+        super().__init__(name="routing_plan", max_size=max_size, ttl=ttl)
+        self.storage = storage
+
+    async def resolve(self, state: State) -> RoutingPlan:
+        plan = self.get(state.id)
+        if plan:
+            return plan
+
+        plan = await self.load(state=state)
+        self.put(state.id, plan)
+        return plan
+
+    async def load(self, state: State) -> RoutingPlan:
+        route_after_save, dispatch = RoutingPlan.compile_properties(state)
+
+        # the forward routes are only needed when routing after save is enabled
+        forward_route_ids = []
+        if route_after_save:
+            # the current state id is an INPUT into other processors (if any)
+            forward_routes = await self.storage.fetch_processor_state_route(
+                state_id=state.id,
+                direction=ProcessorStateDirection.INPUT
+            )
+            forward_route_ids = [forward_route.id for forward_route in forward_routes or []]
+
+        return RoutingPlan(
+            state_id=state.id,
+            route_after_save=route_after_save,
+            dispatch=dispatch,
+            forward_route_ids=forward_route_ids,
+            priority=RoutingPlan.compile_priority(state)
+        )
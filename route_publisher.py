@@ -0,0 +1,89 @@
+import asyncio
+from collections import defaultdict
+from typing import List, Dict, Iterable, Iterator
+
+from ismcore.messaging.base_message_route_model import BaseRoute, MessageStatus
+from ismcore.model.processor_state import RoutingDispatch
+from ismcore.utils.ism_logger import ism_logger
+
+from codec import json_codec
+
+logger = ism_logger(__name__)
+
+# dispatch mode in between individual and batch, sends the query states in fixed size chunks
+ROUTING_DISPATCH_CHUNKED = "chunked"
+
+
+class QueryStatePublisher:
+    """
+    Publishes forwarded query states to the state router route.
+
+    Each query state entry is serialized once and the serialized form is reused for every forward
+    route, publishes are issued concurrently with a bounded number in flight and the route is
+    flushed once all of them completed.
+    """
+
+    def __init__(self, route: BaseRoute, max_in_flight: int = 64, chunk_size: int = 50):
+        self.route = route
+        self.max_in_flight = max_in_flight
+        self.chunk_size = chunk_size
+
+        # publish counters by forward route id
+        self.published: Dict[str, int] = defaultdict(int)
+        self.failed: Dict[str, int] = defaultdict(int)
+
+    @staticmethod
+    def envelope(route_id: str, query_state_json: str) -> str:
+        # equivalent to dumps({"type": ..., "route_id": ..., "query_state": [...]}), without
+        # re-serializing the query state (list) for every forward route
+        return (f'{{"type": "query_state_entry", '
+                f'"route_id": {json_codec.dumps(route_id)}, '
+                f'"query_state": {query_state_json}}}')
+
+    def serialize(self, query_states: List[Dict], dispatch: str) -> List[str]:
+        """Serialize the query states into the query_state lists of the messages to send, per route."""
+        if dispatch == RoutingDispatch.BATCH.value:
+            return [json_codec.dumps(query_states)]
+
+        entries = [json_codec.dumps(entry) for entry in query_states]
+        if dispatch == ROUTING_DISPATCH_CHUNKED:
+            return [
+                f'[{", ".join(entries[offset:offset + self.chunk_size])}]'
+                for offset in range(0, len(entries), self.chunk_size)
+            ]
+
+        return [f'[{entry}]' for entry in entries]
+
+    async def publish_all(self, messages: Iterable[tuple]):
+        """Publish (route_id, payload) pairs with at most max_in_flight publishes pending at once."""
+        iterator: Iterator[tuple] = iter(messages)
+
+        async def worker():
+            # every worker pulls the next message off the shared iterator
+            for route_id, payload in iterator:
+                status = await self.route.publish(payload)
+                if status and status.status == MessageStatus.FAILED:
+                    self.failed[route_id] += 1
+                else:
+                    self.published[route_id] += 1
+
+        await asyncio.gather(*[worker() for _ in range(self.max_in_flight)])
+
+    async def publish(self, forward_route_ids: List[str], query_states: List[Dict], dispatch: str) -> int:
+        if not forward_route_ids or not query_states:
+            return 0
+
+        serialized = self.serialize(query_states=query_states, dispatch=dispatch)
+        logger.debug(
+            f'forwarding {len(query_states)} query state entries as {len(serialized)} {dispatch} '
+            f'messages to routes {forward_route_ids}'
+        )
+
+        await self.publish_all(
+            (route_id, self.envelope(route_id, query_state_json))
+            for route_id in forward_route_ids
+            for query_state_json in serialized
+        )
+
+        await self.route.flush()
+        return len(serialized) * len(forward_route_ids)
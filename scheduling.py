@@ -0,0 +1,212 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+from ismcore.utils.ism_logger import ism_logger
+
+from metrics import groups_scheduled, group_wait
+
+logger = ism_logger(__name__)
+
+SCHEDULER_FAIR = "fair"     # weighted fair queuing across groups (route or state)
+SCHEDULER_FIFO = "fifo"     # groups are persisted in the order they are ready
+SCHEDULERS = (SCHEDULER_FAIR, SCHEDULER_FIFO)
+
+DEFAULT_PRIORITY = "normal"
+
+
+class PriorityClass:
+    """The share of the persist workers of the groups of a priority class, relative to the other classes."""
+
+    def __init__(self, name: str, weight: float = 1.0, max_concurrency: int = 0):
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency      # groups of the class persisted at once per group key, 0 = default
+
+
+def parse_priority_classes(spec: str) -> Dict[str, PriorityClass]:
+    """
+    Parse the priority classes, a list of name:weight[:max_concurrency], e.g. "high:8,normal:1,low:0.25:1".
+    The normal class (weight 1) is always defined, it is the class of groups without a priority.
+    """
+    classes = {}
+    for part in (spec or "").split(','):
+        part = part.strip()
+        if not part:
+            continue
+
+        fields = part.split(':')
+        if len(fields) > 3:
+            raise ValueError(f'invalid priority class {part}, expected name:weight[:max_concurrency]')
+
+        name = fields[0].strip().lower()
+        weight = float(fields[1]) if len(fields) > 1 else 1.0
+        max_concurrency = int(fields[2]) if len(fields) > 2 else 0
+        if weight <= 0 or max_concurrency < 0:
+            raise ValueError(f'invalid priority class {part}, expected a positive weight and max_concurrency >= 0')
+        classes[name] = PriorityClass(name=name, weight=weight, max_concurrency=max_concurrency)
+
+    classes.setdefault(DEFAULT_PRIORITY, PriorityClass(name=DEFAULT_PRIORITY))
+    return classes
+
+
+class Flow:
+    """The queued groups of a group key, and the virtual time its last queued group finishes."""
+
+    def __init__(self, key: str, priority: PriorityClass):
+        self.key = key
+        self.priority = priority
+        self.queue: Deque[tuple] = deque()      # (virtual start, queued at, group)
+        self.finish = 0.0
+        self.running = 0
+
+
+class GroupScheduler:
+    """
+    Decides which ready group the next free persist worker takes.
+
+    In fair mode, each group key (route or state) is a flow of its own and the groups are ordered by
+    start-time fair queuing: a group starts at the virtual time (or where the previous group of its flow
+    finishes, if later) and finishes its rows divided by the weight of its priority class later, the
+    group with the earliest start is taken first. A burst of a hot route thus only delays the groups of
+    other routes by about one group, while the hot route keeps the workers nobody else needs. The
+    priority class of a group key is looked up when its first group is queued, unknown keys are normal.
+
+    A group key is persisted by at most max_concurrency workers at once (that of its class, if set),
+    its other groups wait without holding up those of other keys. In fifo mode there is a single flow
+    without a cap, i.e. the groups are taken in the order they are queued.
+
+    Used like the asyncio queue it replaces: put waits while max_queued groups are queued (0 is
+    unbounded), and join waits until every group taken was marked done.
+    """
+
+    def __init__(self, mode: str = SCHEDULER_FAIR, max_concurrency: int = 0, max_queued: int = 0,
+                 priority_classes: Dict[str, PriorityClass] = None,
+                 priority_fn: Callable[[str], Optional[str]] = None, subject: str = ""):
+        if mode not in SCHEDULERS:
+            raise ValueError(f'unsupported scheduler {mode}, must be one of {SCHEDULERS}')
+
+        self.mode = mode
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.priority_classes = priority_classes or parse_priority_classes("")
+        self.priority_fn = priority_fn
+        self.subject = subject
+
+        self.flows: Dict[str, Flow] = {}
+        self.virtual_time = 0.0
+        self.queued = 0
+        self.unfinished = 0
+        self.changed = asyncio.Event()      # set when a group was queued, taken or done
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def flow_key(self, group: Any) -> str:
+        return group.group_key if self.mode == SCHEDULER_FAIR else ""
+
+    def priority_of(self, key: str) -> PriorityClass:
+        name = None
+        if self.priority_fn and self.mode == SCHEDULER_FAIR:
+            try:
+                name = self.priority_fn(key)
+            except Exception as e:
+                logger.debug(f'unable to look up the priority of group {key}: {e}')
+
+        priority = self.priority_classes.get((name or DEFAULT_PRIORITY).lower())
+        if priority is None:
+            logger.debug(f'unknown priority class {name} of group {key}, scheduling as {DEFAULT_PRIORITY}')
+            priority = self.priority_classes[DEFAULT_PRIORITY]
+        return priority
+
+    def cap(self, flow: Flow) -> int:
+        if self.mode != SCHEDULER_FAIR:
+            return 0
+        return flow.priority.max_concurrency or self.max_concurrency
+
+    def full(self) -> bool:
+        return bool(self.max_queued) and self.queued >= self.max_queued
+
+    def put_nowait(self, group: Any):
+        key = self.flow_key(group)
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = self.flows[key] = Flow(key=key, priority=self.priority_of(key))
+
+        start = max(self.virtual_time, flow.finish)
+        flow.finish = start + max(1, group.rows) / flow.priority.weight
+        flow.queue.append((start, time.monotonic(), group))
+
+        self.queued += 1
+        self.unfinished += 1
+        self.finished.clear()
+        self.changed.set()
+
+    async def put(self, group: Any):
+        while self.full():
+            self.changed.clear()
+            await self.changed.wait()
+        self.put_nowait(group)
+
+    def next_flow(self) -> Optional[Flow]:
+        """The flow whose next group starts first, among the flows below their concurrency cap."""
+        best = None
+        for flow in self.flows.values():
+            if not flow.queue:
+                continue
+
+            cap = self.cap(flow)
+            if cap and flow.running >= cap:
+                continue
+
+            if best is None or flow.queue[0][0] < best.queue[0][0]:
+                best = flow
+        return best
+
+    def get_nowait(self) -> Optional[Any]:
+        flow = self.next_flow()
+        if flow is None:
+            return None
+
+        start, queued_at, group = flow.queue.popleft()
+        self.virtual_time = max(self.virtual_time, start)
+        flow.running += 1
+        self.queued -= 1
+        self.changed.set()
+
+        groups_scheduled.inc(priority=flow.priority.name, subject=self.subject)
+        group_wait.observe(time.monotonic() - queued_at, priority=flow.priority.name)
+        return group
+
+    async def get(self) -> Any:
+        while True:
+            group = self.get_nowait()
+            if group is not None:
+                return group
+            self.changed.clear()
+            await self.changed.wait()
+
+    def done(self, group: Any):
+        """The group taken was persisted (or failed), the next group of its key may be taken."""
+        key = self.flow_key(group)
+        flow = self.flows.get(key)
+        if flow:
+            flow.running -= 1
+
+            # an idle flow is dropped once the virtual time caught up with it, it would start there anyway
+            if not flow.queue and not flow.running and flow.finish <= self.virtual_time:
+                del self.flows[key]
+
+        # once no group waits there is nobody to be fair to, the idle flows of keys that went quiet are dropped
+        # rather than kept for good (e.g. one per state of direct writes)
+        if not self.queued:
+            for key in [key for key, flow in self.flows.items() if not flow.running]:
+                del self.flows[key]
+
+        self.unfinished -= 1
+        if self.unfinished <= 0:
+            self.finished.set()
+        self.changed.set()
+
+    async def join(self):
+        await self.finished.wait()
@@ -0,0 +1,161 @@
+from typing import List, Optional
+
+from ismcore.messaging.base_message_route_model import BaseRoute
+from ismcore.utils.ism_logger import ism_logger
+
+from async_storage import AsyncStorage
+from batching import AdaptiveBatchSizer
+from dedup import DedupWindow
+from environment import STORAGE_MAX_CONCURRENCY, ROUTE_CACHE_MAX_SIZE, ROUTE_CACHE_TTL, STATE_CACHE_MAX_BYTES, \
+    STATE_CACHE_TTL, PUBLISH_MAX_IN_FLIGHT, ROUTING_DISPATCH_CHUNK_SIZE, CONSUMER_BATCH_SIZE, CONSUMER_ADAPTIVE_BATCH, \
+    CONSUMER_BATCH_MIN_ROWS, CONSUMER_BATCH_MAX_ROWS, CONSUMER_BATCH_MAX_BYTES, CONSUMER_BATCH_MAX_LINGER, \
+    CONSUMER_BATCH_TARGET_LATENCY, STATE_WRITE_BULK_MODE, STATE_WRITE_BULK_CHUNK_SIZE, WRITE_SPOOL_DIR, \
+    WRITE_SPOOL_MAX_BYTES, WRITE_SPOOL_SEGMENT_BYTES, WRITE_SPOOL_RETRY_BASE, WRITE_SPOOL_RETRY_MAX, \
+    WRITE_SPOOL_MAX_ATTEMPTS, WRITE_SPOOL_ORPHANS, DEDUP_MODE, DEDUP_WINDOW_SIZE, DEDUP_WINDOW_TTL, WORKER_COUNT
+from route_cache import RouteCache, RoutingPlanCache, TTLCache
+from route_publisher import QueryStatePublisher
+from spool import WriteSpool, orphaned_spool_dirs
+from state_cache import StateCache
+from state_writer import StateWriter, StateWriteCoalescer
+
+logger = ism_logger(__name__)
+
+
+class StateSyncServices:
+    """
+    The storage, caches, writer and publisher of the state sync consumer, built around a single
+    storage class and router route, such that the consumer runs against any storage (e.g. the
+    postgres storage in production, or an in-memory storage in the benchmarks).
+    """
+
+    def __init__(self, storage, router_route: BaseRoute, max_concurrency: int = STORAGE_MAX_CONCURRENCY,
+                 adaptive_batch: bool = CONSUMER_ADAPTIVE_BATCH, spool_dir: str = WRITE_SPOOL_DIR,
+                 dedup_mode: str = DEDUP_MODE, orphan_spool_dirs: List[str] = None):
+
+        # catch-all storage class configuration, blocking calls are run off the event loop by the async storage
+        self.storage = storage
+        self.async_storage = AsyncStorage(storage=storage, max_concurrency=max_concurrency)
+
+        # state metadata (config and column definitions) for the appends of the lightweight and batch modes, such
+        # that consecutive appends to a state do not load it again
+        self.state_metadata_cache = TTLCache(name="state_metadata", max_size=ROUTE_CACHE_MAX_SIZE, ttl=ROUTE_CACHE_TTL)
+
+        # appends rows to states, merging concurrent writes from different routes into the same state
+        self.state_write_coalescer = StateWriteCoalescer(
+            storage=self.async_storage,
+            writer=StateWriter(
+                storage=storage,
+                bulk_mode=STATE_WRITE_BULK_MODE,
+                bulk_chunk_size=STATE_WRITE_BULK_CHUNK_SIZE
+            ),
+            state_metadata=self.state_metadata_cache
+        )
+
+        # local spool of the batches that failed to persist, replayed once the storage recovers
+        self.write_spool: Optional[WriteSpool] = self.open_spool(spool_dir) if spool_dir else None
+
+        # spools left with records by workers that no longer run, replayed until drained, see orphaned_spool_dirs
+        if orphan_spool_dirs is None:
+            orphan_spool_dirs = WRITE_SPOOL_ORPHANS if WORKER_COUNT > 1 else orphaned_spool_dirs(spool_dir, workers=1)
+        self.orphaned_spools: List[WriteSpool] = [self.open_spool(directory) for directory in orphan_spool_dirs]
+
+        # keys of recently persisted messages, to drop redelivered messages and upstream retries
+        self.dedup_window = DedupWindow(mode=dedup_mode, max_size=DEDUP_WINDOW_SIZE, ttl=DEDUP_WINDOW_TTL)
+
+        # shared route metadata cache (processor state route, processor and provider by route id)
+        self.route_cache = RouteCache(storage=self.async_storage, max_size=ROUTE_CACHE_MAX_SIZE, ttl=ROUTE_CACHE_TTL)
+
+        # compiled downstream routing plans (routing mode, dispatch mode and forward routes by state id)
+        self.routing_plan_cache = RoutingPlanCache(
+            storage=self.async_storage,
+            max_size=ROUTE_CACHE_MAX_SIZE,
+            ttl=ROUTE_CACHE_TTL
+        )
+
+        # fully loaded states for the standard mode, bounded by memory and refreshed incrementally
+        self.state_cache = StateCache(storage=self.async_storage, max_bytes=STATE_CACHE_MAX_BYTES, ttl=STATE_CACHE_TTL)
+
+        # publishes forwarded query states to downstream processors, through the state router route
+        self.query_state_publisher = QueryStatePublisher(
+            route=router_route,
+            max_in_flight=PUBLISH_MAX_IN_FLIGHT,
+            chunk_size=ROUTING_DISPATCH_CHUNK_SIZE
+        )
+
+        # adaptive batch window for the batch consumer (flush by row count, byte size or linger time)
+        self.batch_sizer: Optional[AdaptiveBatchSizer] = AdaptiveBatchSizer(
+            initial_rows=CONSUMER_BATCH_SIZE,
+            min_rows=CONSUMER_BATCH_MIN_ROWS,
+            max_rows=CONSUMER_BATCH_MAX_ROWS,
+            max_bytes=CONSUMER_BATCH_MAX_BYTES,
+            max_linger=CONSUMER_BATCH_MAX_LINGER,
+            target_latency=CONSUMER_BATCH_TARGET_LATENCY
+        ) if adaptive_batch else None
+
+    @staticmethod
+    def open_spool(directory: str) -> WriteSpool:
+        spool = WriteSpool(
+            directory=directory,
+            max_bytes=WRITE_SPOOL_MAX_BYTES,
+            segment_bytes=WRITE_SPOOL_SEGMENT_BYTES,
+            retry_base=WRITE_SPOOL_RETRY_BASE,
+            retry_max=WRITE_SPOOL_RETRY_MAX,
+            max_attempts=WRITE_SPOOL_MAX_ATTEMPTS
+        )
+        spool.open()
+        return spool
+
+    def collect_metrics(self):
+        """Series collected from the counters of the caches, publisher, write coalescer and batch sizer."""
+        caches = [self.route_cache.stats(), self.routing_plan_cache.stats(), self.state_cache.stats(),
+                  self.state_metadata_cache.stats(), self.dedup_window.stats()]
+        yield ("cache_hits_total", "counter", "Cache hits, by cache",
+               [({"cache": stats["name"]}, stats["hits"]) for stats in caches])
+        yield ("cache_misses_total", "counter", "Cache misses, by cache",
+               [({"cache": stats["name"]}, stats["misses"]) for stats in caches])
+        yield ("cache_hit_ratio", "gauge", "Cache hit ratio, by cache",
+               [({"cache": stats["name"]}, stats["hit_ratio"]) for stats in caches])
+        yield ("cache_entries", "gauge", "Cached entries, by cache",
+               [({"cache": stats["name"]}, stats["size"]) for stats in caches])
+        yield ("duplicates_total", "counter", "Redelivered or retried messages dropped as duplicates",
+               [({}, self.dedup_window.duplicates)])
+        yield ("state_cache_bytes", "gauge", "Estimated memory of the cached states",
+               [({}, self.state_cache.total_bytes)])
+        yield ("state_cache_reloads_total", "counter", "Full state loads of the state cache",
+               [({}, self.state_cache.reloads)])
+
+        publisher = self.query_state_publisher
+        yield ("published_total", "counter", "Messages published, by forward route",
+               [({"route_id": route_id}, count) for route_id, count in list(publisher.published.items())])
+        yield ("publish_failed_total", "counter", "Failed publishes, by forward route",
+               [({"route_id": route_id}, count) for route_id, count in list(publisher.failed.items())])
+
+        yield ("write_segments_total", "counter", "Write segments submitted to the write coalescer",
+               [({}, self.state_write_coalescer.submitted)])
+        yield ("writes_total", "counter", "State writes after coalescing",
+               [({}, self.state_write_coalescer.writes)])
+        yield ("writes_isolated_total", "counter", "Coalesced writes that failed and were retried segment by segment",
+               [({}, self.state_write_coalescer.isolated)])
+
+        if self.write_spool:
+            spool = self.write_spool.stats()
+            yield ("spool_records", "gauge", "Spooled records not yet replayed", [({}, spool["records"])])
+            yield ("spool_states", "gauge", "States with spooled records, their writes are spooled until replayed",
+                   [({}, spool["states"])])
+            yield ("spool_bytes", "gauge", "Disk used by the spool segments", [({}, spool["bytes"])])
+            yield ("spooled_total", "counter", "Batches spooled after a failed persist", [({}, spool["spooled"])])
+            yield ("spool_replayed_total", "counter", "Spooled records replayed", [({}, spool["replayed"])])
+            yield ("spool_retries_total", "counter", "Failed replays of spooled records", [({}, spool["retries"])])
+            yield ("spool_rejected_total", "counter", "Batches not spooled, the spool was full",
+                   [({}, spool["rejected"])])
+            yield ("spool_dead_total", "counter", "Spooled records moved to the dead letter file",
+                   [({}, spool["dead"])])
+
+        if self.batch_sizer:
+            yield ("batch_target_rows", "gauge", "Target rows of the adaptive batch window",
+                   [({}, self.batch_sizer.target_rows)])
+            yield ("batch_flushes_total", "counter", "Flushed batches, by trigger",
+                   [({"trigger": trigger}, count) for trigger, count in self.batch_sizer.flushes.items()])
+
+    def shutdown(self):
+        self.async_storage.shutdown()
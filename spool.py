@@ -0,0 +1,349 @@
+import asyncio
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from ismcore.utils.ism_logger import ism_logger
+
+from codec import json_codec
+
+logger = ism_logger(__name__)
+
+SEGMENT_SUFFIX = ".spool"
+DONE_SUFFIX = ".done"
+DEAD_LETTER_FILE = "dead.spool"
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+def transient_error_types() -> tuple:
+    """The errors of an unavailable database or connection, rather than of the rows written."""
+    types = (ConnectionError, TimeoutError)
+    try:
+        import psycopg2
+        from psycopg2.pool import PoolError
+        types += (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+    except ImportError:
+        pass
+    return types
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Whether a failed write may succeed once retried later, also when the error was raised from a transient one."""
+    types = transient_error_types()
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, types):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def has_segments(directory: str) -> bool:
+    """Whether a spool directory has segment files with records left to replay."""
+    if not os.path.isdir(directory):
+        return False
+    return any(
+        name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        and os.path.getsize(os.path.join(directory, name)) > 0
+        for name in os.listdir(directory)
+    )
+
+
+def orphaned_spool_dirs(directory: str, workers: int) -> List[str]:
+    """
+    The spool directories under directory that no running process replays, left with records by an earlier run
+    with another worker count: those of workers with an index of workers or more (worker-<index>), and the directory
+    itself, used by a single process, once there is more than one worker.
+    """
+    if not directory or not os.path.isdir(directory):
+        return []
+
+    orphans = [directory] if workers > 1 and has_segments(directory) else []
+    for name in sorted(os.listdir(directory)):
+        index = name[len('worker-'):]
+        if name.startswith('worker-') and index.isdigit() and (workers <= 1 or int(index) >= workers):
+            path = os.path.join(directory, name)
+            if has_segments(path):
+                orphans.append(path)
+    return orphans
+
+
+class SpoolRecord:
+    """The rows of a batch that failed to persist, to be written to the state once storage recovers."""
+
+    def __init__(self, id: int, state_id: str, query_states: List[Dict], route_id: str = None,
+                 spooled_at: float = None, attempts: int = 0):
+        self.id = id
+        self.state_id = state_id
+        self.route_id = route_id      # None for direct writes
+        self.query_states = query_states
+        self.spooled_at = spooled_at or time.time()
+        self.attempts = attempts
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "state_id": self.state_id,
+            "route_id": self.route_id,
+            "query_states": self.query_states,
+            "spooled_at": self.spooled_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SpoolRecord':
+        return cls(
+            id=data['id'],
+            state_id=data['state_id'],
+            route_id=data.get('route_id'),
+            query_states=data['query_states'],
+            spooled_at=data.get('spooled_at')
+        )
+
+
+class WriteSpool:
+    """
+    Local, append-only spool of the batches that failed to persist.
+
+    Records are appended (and fsynced) as json lines to numbered segment files, such that a batch
+    can be acked once it is on disk. A single replay task writes the records back through a
+    handler, oldest segment first, retrying the oldest record with exponential backoff until the
+    storage recovers. Replayed record ids are appended to a .done file next to the segment, so a
+    restart resumes where the replay left off, and a segment is deleted once all of it replayed.
+
+    The spool also tracks the states with records not yet replayed, such that the caller can spool the
+    new rows of those states behind them rather than write them ahead of the replay.
+
+    The segments are bounded by max_bytes, once the budget is used up append raises SpoolFullError
+    and the caller falls back to redelivery. Records that still fail after max_attempts are moved to
+    a dead letter file rather than blocking the replay of the records behind them.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024, segment_bytes: int = 16 * 1024 * 1024,
+                 retry_base: float = 1.0, retry_max: float = 60.0, max_attempts: int = 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+
+        self.lock = asyncio.Lock()
+        self.available = asyncio.Event()
+        self.segments: List[int] = []       # sequence numbers of the segments on disk, oldest first
+        self.segment_sizes: Dict[int, int] = {}
+        self.next_id = 0
+        self.opened = False
+
+        # records not yet replayed by state id, the writes of these states are spooled behind them to keep their order
+        self.pending_states: Dict[str, int] = {}
+
+        # metrics
+        self.records = 0        # records not yet replayed
+        self.spooled = 0
+        self.replayed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.dead = 0
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.segment_sizes.values())
+
+    def segment_path(self, seq: int, suffix: str = SEGMENT_SUFFIX) -> str:
+        return os.path.join(self.directory, f'{seq:010d}{suffix}')
+
+    def open(self):
+        """Pick up the segments left by a previous run, their records are replayed first."""
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                self.segments.append(seq)
+                self.segment_sizes[seq] = os.path.getsize(self.segment_path(seq))
+
+        for seq in self.segments:
+            records = self.read_segment(seq)
+            self.records += len(records)
+            for record in records:
+                self.track(record.state_id, 1)
+            if records:
+                self.next_id = max(self.next_id, max(record.id for record in records) + 1)
+
+        # appends always go to a new segment, the ones on disk are only read from now on
+        self.segments.append(self.segments[-1] + 1 if self.segments else 0)
+        self.segment_sizes[self.segments[-1]] = 0
+        self.opened = True
+
+        if self.records:
+            logger.warning(f'{self.records} spooled records of a previous run in {self.directory}, replaying')
+            self.available.set()
+
+    def track(self, state_id: str, records: int):
+        count = self.pending_states.get(state_id, 0) + records
+        if count > 0:
+            self.pending_states[state_id] = count
+        else:
+            self.pending_states.pop(state_id, None)
+
+    def has_pending(self, state_id: str) -> bool:
+        """Whether records of the state are spooled and not yet replayed."""
+        return state_id in self.pending_states
+
+    def read_done(self, seq: int) -> Set[int]:
+        path = self.segment_path(seq, DONE_SUFFIX)
+        if not os.path.exists(path):
+            return set()
+        with open(path, 'r') as file:
+            return {int(line) for line in file if line.strip().isdigit()}
+
+    def read_segment(self, seq: int) -> List[SpoolRecord]:
+        """The records of a segment that are not replayed yet."""
+        path = self.segment_path(seq)
+        if not os.path.exists(path):
+            return []
+
+        done = self.read_done(seq)
+        records = []
+        with open(path, 'rb') as file:
+            for line in file:
+                try:
+                    record = SpoolRecord.from_dict(json_codec.loads(line))
+                except Exception:
+                    # a line torn by a crash, its batch was never acked and is redelivered instead
+                    logger.warning(f'skipping unreadable record in spool segment {path}')
+                    continue
+                if record.id not in done:
+                    records.append(record)
+        return records
+
+    def write_line(self, path: str, line: bytes):
+        with open(path, 'ab') as file:
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+
+    async def append(self, state_id: str, query_states: List[Dict], route_id: str = None) -> SpoolRecord:
+        """Durably spool the rows of a batch, raises SpoolFullError when the disk budget is used up."""
+        async with self.lock:
+            record = SpoolRecord(id=self.next_id, state_id=state_id, route_id=route_id, query_states=query_states)
+            line = (json_codec.dumps(record.to_dict()) + '\n').encode('utf-8')
+
+            if self.total_bytes + len(line) > self.max_bytes:
+                self.rejected += 1
+                raise SpoolFullError(f'spool budget of {self.max_bytes} bytes used up, in use: {self.total_bytes}')
+
+            seq = self.segments[-1]
+            if self.segment_sizes[seq] and self.segment_sizes[seq] + len(line) > self.segment_bytes:
+                seq = self.rotate()
+
+            await asyncio.to_thread(self.write_line, self.segment_path(seq), line)
+            self.segment_sizes[seq] += len(line)
+            self.next_id += 1
+            self.records += 1
+            self.spooled += 1
+            self.track(state_id, 1)
+
+        self.available.set()
+        return record
+
+    def rotate(self) -> int:
+        seq = self.segments[-1] + 1
+        self.segments.append(seq)
+        self.segment_sizes[seq] = 0
+        return seq
+
+    async def take_segment(self) -> Optional[int]:
+        """The oldest segment with records, sealing the active segment if it is the only one."""
+        async with self.lock:
+            if len(self.segments) == 1:
+                if not self.segment_sizes[self.segments[0]]:
+                    return None
+                self.rotate()
+            return self.segments[0]
+
+    def remove_segment(self, seq: int):
+        for suffix in (SEGMENT_SUFFIX, DONE_SUFFIX):
+            path = self.segment_path(seq, suffix)
+            if os.path.exists(path):
+                os.remove(path)
+        self.segments.remove(seq)
+        self.segment_sizes.pop(seq, None)
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.retry_max, self.retry_base * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def replay_record(self, seq: int, record: SpoolRecord, handler: Callable[[SpoolRecord], Awaitable[Any]]):
+        while True:
+            try:
+                await handler(record)
+                break
+            except Exception as e:
+                record.attempts += 1
+                self.retries += 1
+
+                # retrying cannot fix the rows themselves (e.g. a failing transformation), only a database outage
+                if not is_transient_error(e) or (self.max_attempts and record.attempts >= self.max_attempts):
+                    logger.error(
+                        f'giving up on spooled record {record.id} of state {record.state_id} after '
+                        f'{record.attempts} attempts, moved to {DEAD_LETTER_FILE}: {e}'
+                    )
+                    line = (json_codec.dumps(record.to_dict()) + '\n').encode('utf-8')
+                    await asyncio.to_thread(self.write_line, os.path.join(self.directory, DEAD_LETTER_FILE), line)
+                    self.dead += 1
+                    break
+
+                delay = self.backoff(record.attempts)
+                logger.warning(
+                    f'failed to replay spooled record {record.id} of state {record.state_id}, '
+                    f'attempt {record.attempts}, retrying in {delay:.1f} seconds: {e}'
+                )
+                await asyncio.sleep(delay)
+
+        await asyncio.to_thread(self.write_line, self.segment_path(seq, DONE_SUFFIX), f'{record.id}\n'.encode())
+        self.records -= 1
+        self.replayed += 1
+        self.track(record.state_id, -1)
+
+    async def replay(self, handler: Callable[[SpoolRecord], Awaitable[Any]], drain: bool = False):
+        """
+        Replay the spooled records through the handler, oldest first, until cancelled, or with drain until no
+        record is left (e.g. for the spool of a worker that no longer runs, which nothing is appended to).
+        """
+        if not self.opened:
+            self.open()
+
+        while True:
+            seq = await self.take_segment()
+            if seq is None:
+                if drain:
+                    return
+                self.available.clear()
+                await self.available.wait()
+                continue
+
+            records = await asyncio.to_thread(self.read_segment, seq)
+            if records:
+                logger.info(f'replaying {len(records)} spooled records of segment {seq}')
+            for record in records:
+                await self.replay_record(seq, record, handler)
+
+            async with self.lock:
+                self.remove_segment(seq)
+
+    def stats(self) -> dict:
+        return {
+            "records": self.records,
+            "states": len(self.pending_states),
+            "bytes": self.total_bytes,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "dead": self.dead,
+        }
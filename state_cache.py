@@ -0,0 +1,257 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Dict
+
+from ismcore.model.processor_state import State
+from ismcore.utils.ism_logger import ism_logger
+
+from async_storage import AsyncStorage
+
+logger = ism_logger(__name__)
+
+
+def estimate_value_size(value: Any) -> int:
+    if isinstance(value, (dict, list)):
+        # nested values, approximated by their text form rather than walking every object
+        return sys.getsizeof(value) + len(repr(value))
+    return sys.getsizeof(value)
+
+
+def estimate_state_size(state: State, sample_size: int = 32) -> int:
+    """Approximate memory footprint (bytes) of the loaded data of a state, from a sample of each column."""
+    size = 0
+    for column in (state.data or {}).values():
+        values = column.values or []
+        if not values:
+            continue
+
+        step = max(1, len(values) // sample_size)
+        sample = values[::step][:sample_size]
+        per_value = sum(estimate_value_size(value) for value in sample) / len(sample)
+        size += int(per_value * len(values)) + 8 * len(values)     # values plus the list slots
+
+    for mapping in (state.mapping or {}).values():
+        size += sys.getsizeof(mapping.key) + 64 + 8 * len(mapping.values or [])
+
+    return size
+
+
+class CachedState:
+
+    def __init__(self, state: State):
+        self.state: State = state
+        self.size: int = estimate_state_size(state)
+        self.validated_at: float = time.monotonic()
+
+    @property
+    def has_unsaved_rows(self) -> bool:
+        # rows applied in memory by a save that is still in flight
+        return self.state.count != self.state.persisted_position + 1
+
+
+class StateDelta:
+    """Rows appended to a state in storage since it was cached, e.g. by another replica."""
+
+    def __init__(self, count: int, columns: Optional[dict] = None, data: Optional[dict] = None,
+                 mappings: Optional[dict] = None):
+        self.count = count
+        self.columns = columns
+        self.data = data or {}
+        self.mappings = mappings or {}
+
+
+class StateCache:
+    """
+    Memory bounded cache of fully loaded states, for the standard (non lightweight) mode.
+
+    Entries are evicted least recently used first once the estimated size of all cached states
+    exceeds max_bytes. An entry is served as is for ttl seconds, after which it is revalidated
+    against the state count in storage: rows appended in the meantime are loaded and merged into
+    the cached state, only a state that shrunk or gained columns is reloaded in full.
+    """
+
+    def __init__(self, storage: AsyncStorage, max_bytes: int = 512 * 1024 * 1024, ttl: float = 10.0):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict[str, CachedState] = OrderedDict()
+        self.pending: Dict[str, asyncio.Future] = {}    # in-flight loads, by state_id
+        self.total_bytes = 0
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.refreshes = 0
+        self.merged_rows = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(self, state_id: str) -> Optional[State]:
+        entry = self.entries.get(state_id)
+        if entry and (entry.has_unsaved_rows or time.monotonic() - entry.validated_at < self.ttl):
+            self.entries.move_to_end(state_id)
+            self.hits += 1
+            return entry.state
+
+        # concurrent callers of the same state share a single load or refresh
+        if state_id in self.pending:
+            return await asyncio.shield(self.pending[state_id])
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[state_id] = future
+        try:
+            async with self.storage.state_lock(state_id):
+                state = await self.load(state_id=state_id, entry=entry)
+            future.set_result(state)
+            return state
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved, the caller receives the raised exception
+            raise
+        finally:
+            self.pending.pop(state_id, None)
+
+    async def load(self, state_id: str, entry: Optional[CachedState]) -> Optional[State]:
+        if entry:
+            delta = await self.storage.run(self.fetch_delta, state=entry.state)
+            if delta and self.merge_delta(state=entry.state, delta=delta):
+                self.refreshes += 1
+                self.put(entry.state)
+                return entry.state
+
+        self.misses += 1
+        self.reloads += 1
+        state = await self.storage.load_state(state_id=state_id, load_data=True)
+        if not state:
+            self.invalidate(state_id)
+            return None
+
+        self.put(state)
+        return state
+
+    def fetch_delta(self, state: State) -> Optional[StateDelta]:
+        """Load the rows appended after the cached state's count (blocking), None if a full reload is required."""
+        current = self.storage.storage.fetch_state(state_id=state.id)
+        if not current or current.count < state.count:
+            return None
+
+        if current.count == state.count:
+            return StateDelta(count=current.count)
+
+        columns = self.storage.storage.load_state_columns(state_id=state.id)
+        offset, limit = state.count, current.count - state.count
+        data = self.storage.storage.load_state_data(
+            columns=columns,
+            state_count=current.count,
+            offset=offset,
+            limit=limit
+        )
+
+        # the mapping query bounds data_index by limit rather than offset + limit
+        mappings = self.storage.storage.load_state_data_mappings(
+            state_id=state.id,
+            offset=offset,
+            limit=current.count
+        )
+
+        return StateDelta(count=current.count, columns=columns, data=data, mappings=mappings)
+
+    def merge_delta(self, state: State, delta: StateDelta) -> bool:
+        """Append the delta rows to the cached state in place, returns False if it cannot be merged."""
+        # a save started while the delta was loaded, keep the cached state until the next revalidation
+        if state.count != state.persisted_position + 1:
+            return True
+        if delta.count == state.count:
+            return True
+        if delta.count < state.count:
+            return False
+
+        # new columns since the state was cached
+        if delta.columns is None or set(delta.columns) != set(state.columns or {}):
+            return False
+        if any(not state.data or column_name not in state.data for column_name in delta.data):
+            return False
+
+        for column_name, column_data in delta.data.items():
+            target = state.data[column_name]
+            target.values.extend(column_data.values or [])
+            target.count = len(target.values)
+
+        for state_key, indexes in delta.mappings.items():
+            for index in indexes.values or []:
+                state.add_row_data_mapping(state_key=state_key, index=index)
+
+        self.merged_rows += delta.count - state.count
+        logger.debug(f'merged {delta.count - state.count} rows into cached state: {state.id}')
+        state.count = delta.count
+        state.persisted_position = delta.count - 1
+        return True
+
+    def put(self, state: State):
+        """Cache (or re-measure) a state, e.g. after it was saved, evicting least recently used states."""
+        self.discard(state.id)
+
+        entry = CachedState(state=state)
+        if entry.size > self.max_bytes:
+            logger.warning(
+                f'state {state.id} of ~{entry.size} bytes exceeds the state cache budget '
+                f'of {self.max_bytes} bytes, not caching'
+            )
+            return
+
+        self.entries[state.id] = entry
+        self.total_bytes += entry.size
+
+        while self.total_bytes > self.max_bytes:
+            state_id, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+            self.evictions += 1
+            logger.debug(f'evicted state {state_id} (~{evicted.size} bytes) from the state cache')
+
+    def expire(self, state_id: str):
+        """Revalidate a state on its next use, e.g. after rows were appended to it outside of the cache."""
+        entry = self.entries.get(state_id)
+        if entry:
+            entry.validated_at = float('-inf')
+
+    def discard(self, state_id: str) -> bool:
+        entry = self.entries.pop(state_id, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry.size
+        return True
+
+    def invalidate(self, state_id: str) -> bool:
+        if not self.discard(state_id):
+            return False
+        self.invalidations += 1
+        return True
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.total_bytes = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": "state",
+            "size": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "refreshes": self.refreshes,
+            "merged_rows": self.merged_rows,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hit_ratio,
+        }
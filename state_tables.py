@@ -0,0 +1,263 @@
+import io
+from contextlib import contextmanager
+from importlib.metadata import version, PackageNotFoundError
+from itertools import islice
+from typing import Iterable, Iterator, Any, Optional
+
+from ismcore.utils.ism_logger import ism_logger
+from psycopg2.extras import Json, execute_values
+
+from codec import json_codec
+
+logger = ism_logger(__name__)
+
+# the alethic-ism-db release whose state tables and append statements are mirrored below, see StateTables
+MIRRORED_ISMDB_VERSION = "1.0.47"
+
+
+def installed_ismdb_version() -> Optional[str]:
+    try:
+        return version("alethic-ism-db")
+    except PackageNotFoundError:
+        return None
+
+
+def state_storage_of(storage) -> Any:
+    """The database state storage behind a storage class, which owns the connection pool, if it has one."""
+    return getattr(storage, '_delegate_state_storage', None)
+
+
+def copy_text(value: Any) -> str:
+    """Encode a cell value as a field of the COPY text format, the way psycopg2 would adapt it."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, (dict, list)):
+        value = json_codec.dumps(value)
+    elif not isinstance(value, str):
+        value = str(value)
+
+    return (value
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+class CopyStream(io.RawIOBase):
+    """File-like stream over lines generated on demand, such that COPY does not need the whole payload in memory."""
+
+    def __init__(self, lines: Iterator[str], encoding: str = 'utf-8'):
+        self.lines = lines
+        self.encoding = encoding
+        self.buffer = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line.encode(self.encoding)
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return chunk
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class StateTables:
+    """
+    Writes to the state tables of the ismdb schema (state, state_column_data and state_column_data_mapping),
+    through the connection pool of the database state storage.
+
+    ismdb has no public api to append rows of several routes in one transaction, so the statements of
+    StateDatabaseStorage.append_state_data_direct (alethic-ism-db MIRRORED_ISMDB_VERSION) are mirrored
+    here. This is the only module that depends on the private parts of ismdb, it must be compared with
+    append_state_data_direct when ismdb is upgraded (see tests/test_state_writer.py).
+    """
+
+    insert_sql_text = """
+        INSERT INTO state_column_data (column_id, data_index, data_value)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (column_id, data_index)
+        DO UPDATE SET data_value = EXCLUDED.data_value
+    """
+
+    insert_sql_json = """
+        INSERT INTO state_column_data (column_id, data_index, data_json_value)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (column_id, data_index)
+        DO UPDATE SET data_json_value = EXCLUDED.data_json_value
+    """
+
+    merge_mapping_sql = """
+        MERGE INTO state_column_data_mapping AS target
+        USING (SELECT %s AS state_id, %s AS state_key, %s AS data_index) AS source
+           ON target.state_id = source.state_id
+          AND target.state_key = source.state_key
+          AND target.data_index = source.data_index
+        WHEN NOT MATCHED THEN
+            INSERT (state_id, state_key, data_index)
+            VALUES (source.state_id, source.state_key, source.data_index)
+    """
+
+    reserve_rows_sql = "UPDATE state SET count = count + %s WHERE id = %s RETURNING count"
+
+    insert_sql_text_values = """
+        INSERT INTO state_column_data (column_id, data_index, data_value)
+        VALUES %s
+        ON CONFLICT (column_id, data_index)
+        DO UPDATE SET data_value = EXCLUDED.data_value
+    """
+
+    insert_sql_json_values = """
+        INSERT INTO state_column_data (column_id, data_index, data_json_value)
+        VALUES %s
+        ON CONFLICT (column_id, data_index)
+        DO UPDATE SET data_json_value = EXCLUDED.data_json_value
+    """
+
+    merge_mapping_sql_values = """
+        MERGE INTO state_column_data_mapping AS target
+        USING (VALUES %s) AS source (state_id, state_key, data_index)
+           ON target.state_id = source.state_id
+          AND target.state_key = source.state_key
+          AND target.data_index = source.data_index
+        WHEN NOT MATCHED THEN
+            INSERT (state_id, state_key, data_index)
+            VALUES (source.state_id, source.state_key, source.data_index)
+    """
+
+    create_staging_sql = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS state_column_data_staging (
+            column_id BIGINT,
+            data_index BIGINT,
+            data_value TEXT,
+            data_json_value JSONB,
+            is_json BOOLEAN
+        ) ON COMMIT DELETE ROWS
+    """
+
+    copy_staging_sql = """
+        COPY state_column_data_staging (column_id, data_index, data_value, data_json_value, is_json)
+        FROM STDIN
+    """
+
+    upsert_staging_text_sql = """
+        INSERT INTO state_column_data (column_id, data_index, data_value)
+        SELECT column_id, data_index, data_value FROM state_column_data_staging WHERE NOT is_json
+        ON CONFLICT (column_id, data_index)
+        DO UPDATE SET data_value = EXCLUDED.data_value
+    """
+
+    upsert_staging_json_sql = """
+        INSERT INTO state_column_data (column_id, data_index, data_json_value)
+        SELECT column_id, data_index, data_json_value FROM state_column_data_staging WHERE is_json
+        ON CONFLICT (column_id, data_index)
+        DO UPDATE SET data_json_value = EXCLUDED.data_json_value
+    """
+
+    clear_staging_sql = "DELETE FROM state_column_data_staging"
+
+    def __init__(self, storage, chunk_size: int = 5000):
+        self.state_storage = state_storage_of(storage)
+        self.chunk_size = chunk_size
+
+        installed = installed_ismdb_version()
+        if self.available and installed and installed != MIRRORED_ISMDB_VERSION:
+            logger.warning(f'state tables mirror alethic-ism-db {MIRRORED_ISMDB_VERSION}, '
+                           f'but {installed} is installed, check the append statements against it')
+
+    @property
+    def available(self) -> bool:
+        return hasattr(self.state_storage, 'create_connection')
+
+    @contextmanager
+    def transaction(self):
+        """A cursor on a pooled connection, committed when the block exits and rolled back if it raises."""
+        conn = self.state_storage.create_connection()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.state_storage.release_connection(conn)
+
+    def reserve_rows(self, cursor, state_id: str, rows: int) -> Optional[int]:
+        """
+        Add rows to the count of a state and return the new count, None if there is no such state. The update locks
+        the row of the state until the transaction ends, such that appends to the same state from other processes
+        (workers or replicas) wait for this one and then place their rows after it.
+        """
+        cursor.execute(self.reserve_rows_sql, [rows, state_id])
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    # executemany, as append_state_data_direct
+
+    def insert_cells(self, cursor, cells: Iterable[tuple], json_columns: bool):
+        """Upsert (column id, data index, value) cells of the text or json columns."""
+        if json_columns:
+            batch = [[column_id, data_index, Json(value) if value is not None else None]
+                     for column_id, data_index, value in cells]
+        else:
+            batch = [list(cell) for cell in cells]
+
+        if batch:
+            cursor.executemany(self.insert_sql_json if json_columns else self.insert_sql_text, batch)
+
+    def merge_mappings(self, cursor, mappings: Iterable[tuple]):
+        """Insert the (state id, state key, data index) mappings that do not exist yet."""
+        for mapping in mappings:
+            cursor.execute(self.merge_mapping_sql, list(mapping))
+
+    # bulk ingest, multi-row statements or COPY through a staging table
+
+    def insert_cells_values(self, cursor, cells: Iterable[tuple], json_columns: bool):
+        if json_columns:
+            cells = ((column_id, data_index, Json(value) if value is not None else None)
+                     for column_id, data_index, value in cells)
+
+        execute_values(
+            cursor,
+            self.insert_sql_json_values if json_columns else self.insert_sql_text_values,
+            cells,
+            page_size=self.chunk_size
+        )
+
+    def merge_mappings_values(self, cursor, mappings: Iterable[tuple]):
+        execute_values(cursor, self.merge_mapping_sql_values, mappings, page_size=self.chunk_size)
+
+    def copy_cells(self, cursor, cells: Iterable[tuple], json_columns: bool):
+        def lines() -> Iterator[str]:
+            for column_id, data_index, value in cells:
+                if json_columns:
+                    text = copy_text(json_codec.dumps(value) if value is not None else None)
+                    yield f'{column_id}\t{data_index}\t\\N\t{text}\tt\n'
+                else:
+                    yield f'{column_id}\t{data_index}\t{copy_text(value)}\t\\N\tf\n'
+
+        # rows are streamed into the staging table in chunks and upserted chunk by chunk, such that
+        # neither the payload nor the staging table grows with the size of the batch
+        cursor.execute(self.create_staging_sql)
+        upsert_sql = self.upsert_staging_json_sql if json_columns else self.upsert_staging_text_sql
+        for chunk in chunked(lines(), self.chunk_size):
+            cursor.copy_expert(self.copy_staging_sql, CopyStream(iter(chunk)))
+            cursor.execute(upsert_sql)
+            cursor.execute(self.clear_staging_sql)
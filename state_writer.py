@@ -0,0 +1,296 @@
+import asyncio
+from collections import defaultdict
+from typing import List, Dict, Optional, Tuple, Iterator
+
+from ismcore.model.processor_state import State
+from ismcore.utils.ism_logger import ism_logger
+
+from async_storage import AsyncStorage
+from metrics import stage_latency, rows_persisted
+from route_cache import TTLCache
+from state_tables import StateTables
+from transform import TransformPlan
+
+logger = ism_logger(__name__)
+
+
+# bulk ingest modes of the state writer
+BULK_MODE_OFF = "off"           # column wise executemany
+BULK_MODE_VALUES = "values"     # multi-row insert statements (execute_values)
+BULK_MODE_COPY = "copy"         # COPY into a temporary staging table, upserted from there
+BULK_MODES = [BULK_MODE_OFF, BULK_MODE_VALUES, BULK_MODE_COPY]
+
+
+class WriteSegment:
+    """
+    The query states of one route, along with the scope variables to transform them with, and the scope
+    variable each entry is bound to in its own row, if any (e.g. "data" for direct writes).
+    """
+
+    def __init__(self, query_states: List[Dict], scope_variable_mappings: dict = None, entry_variable: str = None):
+        self.query_states: List[Dict] = query_states
+        self.scope_variable_mappings: dict = scope_variable_mappings or {}
+        self.entry_variable: Optional[str] = entry_variable
+        self.rows: Optional[List[Dict]] = None      # the transformed rows, once written by the state writer
+
+
+class StateWriter:
+    """
+    Appends the rows of one or more write segments to a state in a single transaction.
+
+    This follows append_state_data_direct of the state storage: only the state metadata is loaded,
+    the query states are transformed without appending them to in-memory arrays and the rows are
+    written through the state tables. Unlike append_state_data_direct, each segment is transformed
+    with its own scope variable mappings, such that the rows of several routes are written at once,
+    and the state row is locked while appending, such that concurrent appends from other processes
+    do not write over each other's rows.
+    """
+
+    def __init__(self, storage, bulk_mode: str = BULK_MODE_OFF, bulk_chunk_size: int = 5000):
+        if bulk_mode not in BULK_MODES:
+            raise ValueError(f'unsupported bulk mode {bulk_mode}, must be one of {BULK_MODES}')
+
+        self.storage = storage
+        self.bulk_mode = bulk_mode
+        self.bulk_chunk_size = bulk_chunk_size
+
+        # the state tables of the database storage, if the storage class exposes its connection pool
+        self.tables = StateTables(storage=storage, chunk_size=bulk_chunk_size)
+
+    @property
+    def supports_direct_write(self) -> bool:
+        return self.tables.available
+
+    def supports_bulk(self, state: State) -> bool:
+        # bulk ingest writes to the state tables of the database storage class only
+        storage_class = state.config.storage_class if state.config else None
+        return self.bulk_mode != BULK_MODE_OFF and storage_class in (None, "database")
+
+    def transform(self, state: State, segment: WriteSegment) -> List[Dict]:
+        plan = TransformPlan(
+            state=state,
+            scope_variable_mappings=segment.scope_variable_mappings,
+            entry_variable=segment.entry_variable
+        )
+        return plan.apply(segment.query_states, skip_data_append=True)
+
+    def append(self, state_id: str, segments: List[WriteSegment], state: State = None) -> Optional[State]:
+        """
+        Append the rows of the segments to the state, given its metadata if already loaded (e.g. cached), and return
+        the updated metadata. The count of given metadata may be stale, the rows are placed after the stored count.
+        """
+        if not any(segment.query_states for segment in segments):
+            logger.warning(f'no query states provided for state_id: {state_id}')
+            return None
+
+        # storage classes without a connection pool write each segment through the storage class itself
+        if not self.supports_direct_write:
+            state = None
+            with stage_latency.time(stage="persist"):
+                for segment in segments:
+                    state = self.storage.append_state_data_direct(
+                        state_id=state_id,
+                        query_states=segment.query_states,
+                        scope_variable_mappings=segment.scope_variable_mappings
+                    ) or state
+            rows_persisted.inc(sum(len(segment.query_states) for segment in segments))
+            return state
+
+        # load only metadata (no data arrays), unless given
+        if state is None:
+            state = self.storage.load_state_metadata(state_id=state_id)
+        if not state:
+            logger.error(f'state not found: {state_id}')
+            return None
+
+        rows = []
+        with stage_latency.time(stage="transform"):
+            for segment in segments:
+                segment.rows = self.transform(state=state, segment=segment)
+                rows.extend(segment.rows)
+
+        if not state.columns:
+            logger.error(f'no columns found for state_id: {state_id} even after applying query_states')
+            return None
+
+        with stage_latency.time(stage="persist"):
+            # save any new column definitions, such that each column has an id
+            if any(column.id is None for column in state.columns.values()):
+                self.storage.insert_state_columns(state=state, force_update=False)
+
+            if self.supports_bulk(state):
+                state = self.write_rows_bulk(state=state, rows=rows)
+            else:
+                state = self.write_rows(state=state, rows=rows)
+
+        rows_persisted.inc(len(rows))
+        return state
+
+    @staticmethod
+    def iter_cells(state: State, rows: List[Dict], start_position: int, json_columns: bool) -> Iterator[tuple]:
+        """(column id, data index, value) of each cell of the text or json columns, column by column."""
+        for column_name, column_def in state.columns.items():
+            if (column_def.data_type == 'json') != json_columns:
+                continue
+            for row_offset, row in enumerate(rows):
+                yield column_def.id, start_position + row_offset, row.get(column_name, None)
+
+    @staticmethod
+    def iter_mappings(state_id: str, rows: List[Dict], start_position: int) -> Iterator[tuple]:
+        for row_offset, row in enumerate(rows):
+            state_key = row.get('state_key')
+            if state_key:
+                yield state_id, state_key, start_position + row_offset
+
+    def reserve_rows(self, cursor, state: State, rows: int) -> int:
+        """
+        Reserve the positions of the appended rows and return the first one, the state stays locked until the
+        transaction ends.
+
+        The count of the loaded (or cached) metadata may be stale, another process may have appended to the state
+        since, so the rows are placed after the count updated under the lock rather than after the loaded one.
+        """
+        new_count = self.tables.reserve_rows(cursor, state_id=state.id, rows=rows)
+        if new_count is None:
+            raise ValueError(f'state not found: {state.id}')
+
+        start_position = new_count - rows
+        if start_position != state.count:
+            logger.debug(f'state {state.id} was appended to by another writer, count: {state.count} -> {start_position}')
+        return start_position
+
+    def write_rows_bulk(self, state: State, rows: List[Dict]) -> State:
+        state_id = state.id
+
+        try:
+            with self.tables.transaction() as cursor:
+                start_position = self.reserve_rows(cursor, state=state, rows=len(rows))
+                for json_columns in (False, True):
+                    cells = self.iter_cells(state, rows, start_position, json_columns=json_columns)
+                    if self.bulk_mode == BULK_MODE_COPY:
+                        self.tables.copy_cells(cursor, cells, json_columns=json_columns)
+                    else:
+                        self.tables.insert_cells_values(cursor, cells, json_columns=json_columns)
+
+                # state key mappings, for rows with a primary key
+                self.tables.merge_mappings_values(cursor, self.iter_mappings(state_id, rows, start_position))
+        except Exception as e:
+            logger.error(f'error bulk appending data to state {state_id}: {e}')
+            raise e
+
+        state.count = start_position + len(rows)
+        state.persisted_position = state.count - 1
+        logger.info(f'appended {len(rows)} rows to state {state_id} ({self.bulk_mode}), new count: {state.count}')
+        return state
+
+    def write_rows(self, state: State, rows: List[Dict]) -> State:
+        state_id = state.id
+
+        try:
+            with self.tables.transaction() as cursor:
+                start_position = self.reserve_rows(cursor, state=state, rows=len(rows))
+
+                # the cells of the text columns and of the json columns, column by column, in one batch each
+                for json_columns in (False, True):
+                    cells = self.iter_cells(state, rows, start_position, json_columns=json_columns)
+                    self.tables.insert_cells(cursor, cells, json_columns=json_columns)
+
+                # state key mappings, for rows with a primary key
+                self.tables.merge_mappings(cursor, self.iter_mappings(state_id, rows, start_position))
+        except Exception as e:
+            logger.error(f'error appending data to state {state_id}: {e}')
+            raise e
+
+        state.count = start_position + len(rows)
+        state.persisted_position = state.count - 1
+        logger.info(f'appended {len(rows)} rows to state {state_id}, new count: {state.count}')
+        return state
+
+
+class StateWriteCoalescer:
+    """
+    Coalesces concurrent writes into the same state.
+
+    Segments submitted for a state while a write to that state is pending are merged into a single
+    append, such that several upstream routes feeding the same state cost one metadata load and one
+    transaction rather than one each. Each submitter receives the updated state once its rows commit.
+    When a merged write fails, each segment is written again on its own, such that only the segments
+    that fail by themselves raise and a bad route does not take the others into the state down with it.
+    """
+
+    def __init__(self, storage: AsyncStorage, writer: StateWriter, state_metadata: TTLCache = None):
+        self.storage = storage
+        self.writer = writer
+
+        # metadata of the written states, reused by the next append to the same state rather than loaded again,
+        # it is updated by the appends themselves and dropped when one fails or the state is edited
+        self.state_metadata = state_metadata if writer.supports_direct_write else None
+        self.pending: Dict[str, List[Tuple[WriteSegment, asyncio.Future]]] = defaultdict(list)
+        self.writers: Dict[str, asyncio.Task] = {}
+
+        # metrics
+        self.submitted = 0
+        self.writes = 0
+        self.isolated = 0       # coalesced writes that failed and were retried segment by segment
+
+    async def submit(self, state_id: str, segment: WriteSegment) -> Optional[State]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[state_id].append((segment, future))
+        self.submitted += 1
+
+        if state_id not in self.writers:
+            self.writers[state_id] = asyncio.create_task(self.write_pending(state_id))
+
+        return await future
+
+    async def write_pending(self, state_id: str):
+        try:
+            while self.pending.get(state_id):
+                batch = self.pending.pop(state_id)
+                if len(batch) > 1:
+                    logger.info(
+                        f'coalesced {len(batch)} segments '
+                        f'({sum(len(segment.query_states) for segment, _ in batch)} rows) into state: {state_id}'
+                    )
+
+                # without a connection pool each segment is a write of its own, a failed segment may follow
+                # segments that were already committed, so they are not merged
+                if self.writer.supports_direct_write:
+                    await self.write_batch(state_id, batch)
+                else:
+                    for item in batch:
+                        await self.write_batch(state_id, [item])
+        finally:
+            self.writers.pop(state_id, None)
+
+    async def write_batch(self, state_id: str, batch: List[Tuple[WriteSegment, asyncio.Future]]):
+        """Write the segments in one transaction, and each on its own if that fails, such that only bad ones fail."""
+        try:
+            async with self.storage.state_lock(state_id):
+                cached = self.state_metadata.get(state_id) if self.state_metadata else None
+                state = await self.storage.run(
+                    self.writer.append, state_id=state_id, segments=[segment for segment, _ in batch], state=cached)
+                if state and self.state_metadata:
+                    self.state_metadata.put(state_id, state)
+            self.writes += 1
+        except Exception as e:
+            if self.state_metadata:
+                self.state_metadata.invalidate(state_id)
+
+            if len(batch) == 1:
+                _, future = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+
+            # the transaction was rolled back, retry each segment so that a bad one does not fail the others
+            logger.warning(f'failed to write {len(batch)} coalesced segments into state: {state_id}, '
+                           f'writing them one by one: {e}')
+            self.isolated += 1
+            for item in batch:
+                await self.write_batch(state_id, [item])
+            return
+
+        for _, future in batch:
+            if not future.done():
+                future.set_result(state)
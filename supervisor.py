@@ -0,0 +1,234 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from ismcore.utils.ism_logger import ism_logger
+
+from metrics import MetricsServer
+from readiness import Readiness
+
+logger = ism_logger(__name__)
+
+
+def resolve_worker_count(workers: str) -> int:
+    """Number of worker processes, "auto" is one per core available to this process."""
+    workers = str(workers or "1").strip().lower()
+    if workers == "auto":
+        try:
+            return max(1, len(os.sched_getaffinity(0)))
+        except AttributeError:
+            return max(1, os.cpu_count() or 1)
+    return max(1, int(workers))
+
+
+@contextmanager
+def environment_overrides(overrides: Dict[str, str]):
+    """Temporarily set environment variables, spawned processes start with a copy of the environment."""
+    previous = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class WorkerSupervisor:
+    """
+    Runs a number of worker processes and keeps them running.
+
+    Workers are spawned (not forked, the parent may hold connections and threads) with their own
+    environment overrides, e.g. their index and metrics port, and restarted with exponential backoff
+    when they exit. SIGTERM and SIGINT are forwarded to the workers, which shut down gracefully and
+    are killed once the grace period is over.
+    """
+
+    def __init__(self, workers: int, target: Callable, worker_env: Callable[[int], Dict[str, str]] = None,
+                 grace_period: float = 30.0, restart_backoff_base: float = 1.0, restart_backoff_max: float = 30.0):
+        self.workers = workers
+        self.target = target
+        self.worker_env = worker_env or (lambda index: {})
+        self.grace_period = grace_period
+        self.restart_backoff_base = restart_backoff_base
+        self.restart_backoff_max = restart_backoff_max
+
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started_at: Dict[int, float] = {}
+        self.failures: Dict[int, int] = {index: 0 for index in range(workers)}
+        self.restart_at: Dict[int, float] = {}
+        self.stopping = asyncio.Event()
+
+        # metrics
+        self.restarts = 0
+
+    def start_worker(self, index: int):
+        with environment_overrides(self.worker_env(index)):
+            process = self.context.Process(target=self.target, name=f'state-sync-worker-{index}', daemon=False)
+            process.start()
+
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.info(f'started worker {index} (pid: {process.pid})')
+
+    def check_workers(self):
+        now = time.monotonic()
+        for index in range(self.workers):
+            process = self.processes.get(index)
+            if process and process.is_alive():
+                continue
+
+            if process and index not in self.restart_at:
+                # a worker that ran for a while is restarted right away, one that keeps failing backs off
+                uptime = now - self.started_at[index]
+                self.failures[index] = 0 if uptime > self.restart_backoff_max * 2 else self.failures[index] + 1
+                failures = self.failures[index]
+                delay = min(self.restart_backoff_max, self.restart_backoff_base * 2 ** (failures - 1)) if failures else 0
+                self.restart_at[index] = now + delay
+                logger.warning(
+                    f'worker {index} (pid: {process.pid}) exited with code {process.exitcode} '
+                    f'after {uptime:.1f} seconds, restarting in {delay:.1f} seconds'
+                )
+
+            if now >= self.restart_at.get(index, 0):
+                self.restart_at.pop(index, None)
+                if process:
+                    self.restarts += 1
+                self.start_worker(index)
+
+    def signal_workers(self, signum: int):
+        for process in self.processes.values():
+            if process.is_alive():
+                try:
+                    os.kill(process.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def shutdown(self, signum: int):
+        if self.stopping.is_set():
+            return
+        logger.info(f'received signal {signal.Signals(signum).name}, stopping {self.workers} workers')
+        self.stopping.set()
+        self.signal_workers(signal.SIGTERM)
+
+    async def stop_workers(self):
+        deadline = time.monotonic() + self.grace_period
+        while time.monotonic() < deadline and any(process.is_alive() for process in self.processes.values()):
+            await asyncio.sleep(0.2)
+
+        for index, process in self.processes.items():
+            if process.is_alive():
+                logger.warning(f'worker {index} (pid: {process.pid}) did not stop in time, killing it')
+                process.kill()
+            process.join(timeout=5)
+
+    async def run(self, interval: float = 0.5):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.shutdown, signum)
+
+        logger.info(f'supervising {self.workers} workers')
+        while not self.stopping.is_set():
+            self.check_workers()
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+        await self.stop_workers()
+        logger.info('all workers stopped')
+
+    def alive(self) -> int:
+        return sum(1 for process in self.processes.values() if process.is_alive())
+
+
+def add_label(line: str, name: str, value: str) -> str:
+    """Add a label to a sample line of the prometheus text format."""
+    series, _, sample = line.rpartition(' ')
+    if series.endswith('}'):
+        return f'{series[:-1]},{name}="{value}"}} {sample}'
+    return f'{series}{{{name}="{value}"}} {sample}'
+
+
+class AggregatedMetricsServer(MetricsServer):
+    """
+    Serves the metrics of all workers on a single port, such that the pod is scraped as before. Each
+    worker serves its own metrics on a local port, which are fetched on every scrape and labeled with
+    the worker index. The pod is ready once every worker is.
+    """
+
+    def __init__(self, supervisor: WorkerSupervisor, worker_ports: List[int], host: str = "0.0.0.0",
+                 port: int = 9090, readiness: Optional[Readiness] = None):
+        super().__init__(registry=None, host=host, port=port, readiness=readiness)
+        self.supervisor = supervisor
+        self.worker_ports = worker_ports
+
+    @staticmethod
+    async def fetch(port: int, path: str = '/metrics', timeout: float = 5.0) -> Optional[str]:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout=timeout)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), timeout=timeout)
+            writer.close()
+        except Exception as e:
+            logger.debug(f'unable to fetch worker {path} on port {port}: {e}')
+            return None
+
+        head, _, body = response.partition(b'\r\n\r\n')
+        return body.decode('utf-8') if head.startswith(b'HTTP/1.1 200') else None
+
+    async def render(self) -> str:
+        bodies = await asyncio.gather(*[self.fetch(port) for port in self.worker_ports])
+
+        lines = [
+            '# HELP state_sync_workers_alive Worker processes running',
+            '# TYPE state_sync_workers_alive gauge',
+            f'state_sync_workers_alive {self.supervisor.alive()}',
+            '# HELP state_sync_worker_restarts_total Worker processes restarted',
+            '# TYPE state_sync_worker_restarts_total counter',
+            f'state_sync_worker_restarts_total {self.supervisor.restarts}',
+        ]
+
+        # the series of every worker grouped under a single HELP and TYPE header per metric
+        headers = {}
+        samples: Dict[str, List[str]] = {}
+        for index, body in enumerate(bodies):
+            metric = None
+            for line in (body or '').splitlines():
+                if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                    metric = line.split(' ', 3)[2]
+                    header = headers.setdefault(metric, [])
+                    if line not in header:
+                        header.append(line)
+                    samples.setdefault(metric, [])
+                elif line and metric:
+                    samples[metric].append(add_label(line, "worker", str(index)))
+
+        for metric, header in headers.items():
+            lines.extend(header)
+            lines.extend(samples[metric])
+        return '\n'.join(lines) + '\n'
+
+    async def check_ready(self) -> bool:
+        if self.supervisor.stopping.is_set():
+            self.readiness.stop()
+            return False
+
+        bodies = await asyncio.gather(*[self.fetch(port, path='/ready') for port in self.worker_ports])
+        for index, body in enumerate(bodies):
+            self.readiness.set(f'worker-{index}', body is not None)
+        return self.readiness.ready
+
+    async def watch_readiness(self, interval: float = 1.0):
+        """Keep the readiness (file) of the pod up to date, when it is not polled on GET /ready."""
+        while True:
+            await self.check_ready()
+            await asyncio.sleep(interval)
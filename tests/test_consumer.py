@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+# a local routing file, before the consumer modules are imported
+os.environ.setdefault("ROUTING_FILE", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                   "benchmarks", "routing.yaml"))
+
+from benchmarks.fakes import FakeRoute, FakeStorage     # noqa: E402
+from main import MessagingStateSyncConsumer     # noqa: E402
+from services import StateSyncServices      # noqa: E402
+from state_writer import WriteSegment       # noqa: E402
+
+MESSAGE = {"type": "query_state_route", "route_id": "r1", "query_state": [{"input": "q", "output": "o"}]}
+
+
+class FakeMessage:
+    def __init__(self, payload: dict, sequence: int = 1):
+        self.data = json.dumps(payload).encode("utf-8")
+        self.sequence = sequence
+        self.headers = None
+        self.acks = 0
+        self.naks = 0
+
+    async def nak(self, delay: float = None):
+        self.naks += 1
+
+
+class FakeJetStreamRoute(FakeRoute):
+    jetstream_enabled = True
+
+    def get_message_id(self, msg: FakeMessage) -> int:
+        return msg.sequence
+
+    async def ack(self, msg: FakeMessage) -> bool:
+        msg.acks += 1
+        return True
+
+
+class FailingStorage(FakeStorage):
+    def __init__(self, error: Exception = None):
+        super().__init__()
+        self.error = error
+
+    def save_state(self, state, options: dict = None):
+        if self.error:
+            raise self.error
+        return super().save_state(state, options)
+
+
+def create_consumer(storage: FakeStorage) -> MessagingStateSyncConsumer:
+    storage.add_state("s1")
+    storage.add_route("r1", state_id="s1")
+    services = StateSyncServices(storage=storage, router_route=FakeRoute(), spool_dir="")
+    return MessagingStateSyncConsumer(route=FakeJetStreamRoute(), services=services, lightweight=False)
+
+
+def receive(storage: FakeStorage, payload: dict) -> FakeMessage:
+    async def run():
+        consumer = create_consumer(storage)
+        msg = FakeMessage(payload)
+        await consumer.on_receive(consumer.route, msg, msg.data)
+        return msg
+
+    return asyncio.run(run())
+
+
+def test_processed_message_is_acked():
+    msg = receive(FailingStorage(), MESSAGE)
+    assert (msg.acks, msg.naks) == (1, 0)
+
+
+def test_invalid_message_is_acked():
+    msg = receive(FailingStorage(), {"route_id": "r1", "query_state": [{"input": "q"}]})
+    assert (msg.acks, msg.naks) == (1, 0)
+
+
+@pytest.mark.parametrize("error", [RuntimeError("constraint violated"), ConnectionError("database down")])
+def test_failed_write_is_redelivered(error):
+    msg = receive(FailingStorage(error=error), MESSAGE)
+    assert (msg.acks, msg.naks) == (0, 1)
+
+
+def test_failed_save_drops_the_cached_state():
+    storage = FailingStorage()
+
+    async def run():
+        consumer = create_consumer(storage)
+        for sequence, error in enumerate([None, RuntimeError("constraint violated"), None]):
+            storage.error = error
+            msg = FakeMessage(MESSAGE, sequence=sequence)
+            await consumer.on_receive(consumer.route, msg, msg.data)
+
+            # the unsaved row of the failed message is not served from the cache
+            cached = consumer.state_cache.entries.get("s1")
+            assert (cached is None) == (error is not None)
+            if cached:
+                assert not cached.has_unsaved_rows
+
+        return consumer.state_cache.reloads
+
+    assert asyncio.run(run()) == 2
+    assert storage.states["s1"].count == 2
+
+
+def test_writes_of_a_state_with_spooled_rows_are_spooled_behind_them(tmp_path):
+    storage = FakeStorage()
+    storage.add_state("s1")
+    storage.add_state("s2")
+    services = StateSyncServices(storage=storage, router_route=FakeRoute(), spool_dir=str(tmp_path))
+    consumer = MessagingStateSyncConsumer(route=FakeJetStreamRoute(), services=services, lightweight=False)
+    written = []
+
+    async def submit(state_id: str, segment: WriteSegment):
+        if not written:
+            written.append(None)
+            raise ConnectionError("database down")
+        written.append(state_id)
+
+    consumer.state_write_coalescer.submit = submit
+
+    async def run():
+        for state_id in ["s1", "s1", "s2"]:
+            await consumer.persist_segment(state_id=state_id, segment=WriteSegment([{"input": "q"}], {}))
+
+    asyncio.run(run())
+
+    # the second write of s1 is not written ahead of the spooled first one, the write of s2 is
+    assert written == [None, "s2"]
+    assert [record.state_id for record in consumer.write_spool.read_segment(consumer.write_spool.segments[0])] \
+        == ["s1", "s1"]
@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import nats.js.errors
+import pytest
+
+from dedup import DEDUP_MODE_CONTENT, DEDUP_MODE_MESSAGE, DEDUP_MODE_OFF, DedupWindow
+from route_batch import StateSyncRouteBatch
+
+
+class FakeMetadata:
+    def __init__(self, sequence: int):
+        self.stream = "STATE_SYNC"
+        self.sequence = type("Sequence", (), {"stream": sequence})()
+
+
+class FakeMessage:
+    def __init__(self, payload: dict, sequence: int, headers: dict = None):
+        self.data = json.dumps(payload).encode("utf-8")
+        self.metadata = FakeMetadata(sequence)
+        self.headers = headers
+        self.acks = 0
+        self.naks = 0
+
+    async def ack(self):
+        self.acks += 1
+
+    async def nak(self, delay: float = None):
+        self.naks += 1
+
+
+def test_message_mode_keys_on_message_id_then_stream_sequence():
+    window = DedupWindow(mode=DEDUP_MODE_MESSAGE)
+    payload = {"route_id": "r1", "query_state": [{"a": 1}]}
+
+    assert window.key_of(FakeMessage(payload, 1, headers={"Nats-Msg-Id": "m1"})) == "id:m1"
+    assert window.key_of(FakeMessage(payload, 1)) == "seq:STATE_SYNC:1"
+    assert window.key_of(FakeMessage(payload, 1)) != window.key_of(FakeMessage(payload, 2))
+
+
+def test_content_mode_keys_on_payload():
+    window = DedupWindow(mode=DEDUP_MODE_CONTENT)
+    payload = {"route_id": "r1", "query_state": [{"a": 1}]}
+
+    assert window.key_of(FakeMessage(payload, 1)) == window.key_of(FakeMessage(payload, 2))
+    assert window.key_of(FakeMessage(payload, 1)) != window.key_of(FakeMessage({**payload, "route_id": "r2"}, 1))
+
+
+def test_off_mode_has_no_keys():
+    window = DedupWindow(mode=DEDUP_MODE_OFF)
+    assert not window.enabled
+    assert window.key_of(FakeMessage({}, 1)) is None
+
+
+def test_unsupported_mode():
+    with pytest.raises(ValueError):
+        DedupWindow(mode="payload")
+
+
+def test_seen_only_once_marked():
+    window = DedupWindow(mode=DEDUP_MODE_MESSAGE)
+
+    assert not window.seen("seq:STATE_SYNC:1")
+    window.mark(["seq:STATE_SYNC:1", None])
+    assert window.seen("seq:STATE_SYNC:1")
+    assert not window.seen(None)
+    assert window.duplicates == 1
+
+
+def test_window_is_bounded():
+    window = DedupWindow(mode=DEDUP_MODE_MESSAGE, max_size=2)
+    window.mark(["k1", "k2", "k3"])
+
+    assert not window.seen("k1")
+    assert window.seen("k2") and window.seen("k3")
+
+
+def consume(route: StateSyncRouteBatch, fetches: list):
+    async def fetch(timeout):
+        if not fetches:
+            await asyncio.sleep(timeout)
+            if not route._pending and not route._processing:
+                route.consumer_active = False
+            raise nats.js.errors.FetchTimeoutError()
+
+        # the groups of the previous fetch are persisted by the time the next arrives, unless they take longer
+        await asyncio.sleep(0.05)
+        return fetches.pop(0)
+
+    object.__setattr__(route, "_fetch_messages", fetch)
+    asyncio.run(route.consume())
+
+
+def make_route(dedup: DedupWindow, batch_callback) -> StateSyncRouteBatch:
+    return StateSyncRouteBatch(
+        name="state_sync", url="nats://localhost:4222", subject="processor.state.sync", selector="processor/state/sync",
+        jetstream_enabled=True, dedup=dedup, batch_callback=batch_callback,
+        group_by_fn=lambda message: message.get("route_id")
+    )
+
+
+def test_redelivery_of_persisted_message_is_acked_without_processing():
+    window = DedupWindow(mode=DEDUP_MODE_MESSAGE)
+    batches = []
+
+    async def persist(route, group_key, data):
+        batches.append(data)
+
+    payload = {"route_id": "r1", "query_state": [{"a": 1}]}
+    original, redelivered = FakeMessage(payload, 1), FakeMessage(payload, 1)
+    consume(make_route(window, persist), [[original], [redelivered]])
+
+    assert len(batches) == 1
+    assert (original.acks, redelivered.acks) == (1, 1)
+    assert window.duplicates == 1
+
+
+def test_redelivery_of_in_flight_message_is_not_acked():
+    window = DedupWindow(mode=DEDUP_MODE_MESSAGE)
+
+    async def persist(route, group_key, data):
+        await asyncio.sleep(0.2)
+        raise ConnectionError("database down")
+
+    payload = {"route_id": "r1", "query_state": [{"a": 1}]}
+    original, redelivered = FakeMessage(payload, 1), FakeMessage(payload, 1)
+    consume(make_route(window, persist), [[original], [redelivered]])
+
+    # the copy shares the stream sequence, acking it would ack the original whose group failed
+    assert (original.acks, original.naks) == (0, 1)
+    assert (redelivered.acks, redelivered.naks) == (0, 0)
+    assert window.duplicates == 1
@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+from scheduling import DEFAULT_PRIORITY, SCHEDULER_FAIR, SCHEDULER_FIFO, GroupScheduler, parse_priority_classes
+
+
+class Group:
+    def __init__(self, group_key: str, rows: int = 10):
+        self.group_key = group_key
+        self.rows = rows
+
+
+def drain(scheduler: GroupScheduler) -> list:
+    """Take the queued groups one at a time, each done before the next is taken."""
+    order = []
+    while True:
+        group = scheduler.get_nowait()
+        if group is None:
+            return order
+        order.append(group.group_key)
+        scheduler.done(group)
+
+
+def test_parse_priority_classes():
+    classes = parse_priority_classes("High:8, low:0.25:1")
+
+    assert classes["high"].weight == 8
+    assert (classes["low"].weight, classes["low"].max_concurrency) == (0.25, 1)
+    assert classes[DEFAULT_PRIORITY].weight == 1
+
+
+@pytest.mark.parametrize("spec", ["high:0", "high:1:-1", "high:1:2:3", "high:x"])
+def test_parse_invalid_priority_classes(spec):
+    with pytest.raises(ValueError):
+        parse_priority_classes(spec)
+
+
+def test_unsupported_mode():
+    with pytest.raises(ValueError):
+        GroupScheduler(mode="lottery")
+
+
+def test_fifo_takes_groups_in_order():
+    scheduler = GroupScheduler(mode=SCHEDULER_FIFO)
+    for key in ["hot", "hot", "hot", "cold", "hot"]:
+        scheduler.put_nowait(Group(key))
+
+    assert drain(scheduler) == ["hot", "hot", "hot", "cold", "hot"]
+
+
+def test_fair_interleaves_a_burst_with_other_keys():
+    scheduler = GroupScheduler(mode=SCHEDULER_FAIR)
+    for key in ["hot", "hot", "hot", "hot", "cold", "warm"]:
+        scheduler.put_nowait(Group(key))
+
+    assert drain(scheduler)[:3] == ["hot", "cold", "warm"]
+
+
+def test_fair_weights_by_priority_class():
+    priorities = {"high": "high", "normal": None}
+    scheduler = GroupScheduler(
+        mode=SCHEDULER_FAIR,
+        priority_classes=parse_priority_classes("high:4"),
+        priority_fn=priorities.get
+    )
+    for _ in range(5):
+        scheduler.put_nowait(Group("normal"))
+        scheduler.put_nowait(Group("high"))
+
+    # four groups of the high class per normal one, while both have groups waiting
+    assert drain(scheduler)[:6] == ["normal", "high", "high", "high", "high", "normal"]
+
+
+def test_unknown_priority_is_normal():
+    scheduler = GroupScheduler(mode=SCHEDULER_FAIR, priority_fn=lambda key: "urgent")
+    scheduler.put_nowait(Group("r1"))
+
+    assert scheduler.flows["r1"].priority.name == DEFAULT_PRIORITY
+
+
+def test_failing_priority_lookup_is_normal():
+    def lookup(key):
+        raise KeyError(key)
+
+    scheduler = GroupScheduler(mode=SCHEDULER_FAIR, priority_fn=lookup)
+    scheduler.put_nowait(Group("r1"))
+
+    assert scheduler.flows["r1"].priority.name == DEFAULT_PRIORITY
+
+
+def test_group_concurrency_cap():
+    scheduler = GroupScheduler(mode=SCHEDULER_FAIR, max_concurrency=1)
+    first, second, other = Group("hot"), Group("hot"), Group("cold")
+    for group in (first, second, other):
+        scheduler.put_nowait(group)
+
+    assert scheduler.get_nowait() is first
+    assert scheduler.get_nowait() is other
+    assert scheduler.get_nowait() is None        # the next hot group waits for the first
+
+    scheduler.done(first)
+    assert scheduler.get_nowait() is second
+
+
+def test_priority_class_cap_overrides_default():
+    scheduler = GroupScheduler(
+        mode=SCHEDULER_FAIR,
+        max_concurrency=0,
+        priority_classes=parse_priority_classes("low:1:1"),
+        priority_fn=lambda key: "low"
+    )
+    scheduler.put_nowait(Group("r1"))
+    scheduler.put_nowait(Group("r1"))
+
+    assert scheduler.get_nowait() is not None
+    assert scheduler.get_nowait() is None
+
+
+def test_put_waits_while_full_and_join_waits_until_done():
+    async def run():
+        scheduler = GroupScheduler(mode=SCHEDULER_FAIR, max_queued=1)
+        scheduler.put_nowait(Group("r1"))
+        assert scheduler.full()
+
+        put = asyncio.create_task(scheduler.put(Group("r2")))
+        await asyncio.sleep(0.01)
+        assert not put.done()
+
+        first = await scheduler.get()
+        await asyncio.wait_for(put, timeout=1)
+
+        join = asyncio.create_task(scheduler.join())
+        second = await scheduler.get()
+        scheduler.done(first)
+        await asyncio.sleep(0.01)
+        assert not join.done()
+
+        scheduler.done(second)
+        await asyncio.wait_for(join, timeout=1)
+        return first.group_key, second.group_key
+
+    assert asyncio.run(run()) == ("r1", "r2")
+
+
+def test_idle_flows_are_dropped():
+    scheduler = GroupScheduler(mode=SCHEDULER_FAIR)
+    scheduler.put_nowait(Group("r1"))
+    scheduler.put_nowait(Group("r2"))
+    drain(scheduler)
+
+    assert not scheduler.flows
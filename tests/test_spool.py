@@ -0,0 +1,233 @@
+import asyncio
+import os
+
+import psycopg2
+import pytest
+
+from spool import DEAD_LETTER_FILE, DONE_SUFFIX, SpoolFullError, WriteSpool, is_transient_error, orphaned_spool_dirs
+
+
+def make_spool(directory, **kwargs) -> WriteSpool:
+    spool = WriteSpool(directory=str(directory), retry_base=0.001, retry_max=0.002, **kwargs)
+    spool.open()
+    return spool
+
+
+async def replay_until(spool: WriteSpool, handler, replayed: int, timeout: float = 5.0):
+    """Run the replay task until the given number of records were replayed (or dead lettered)."""
+    task = asyncio.create_task(spool.replay(handler))
+    try:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while spool.replayed < replayed and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_replay_writes_records_in_order_and_removes_segments(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path)
+        for index in range(3):
+            await spool.append(state_id="s1", route_id="r1", query_states=[{"a": index}])
+
+        replayed = []
+
+        async def handler(record):
+            replayed.append(record.query_states[0]["a"])
+
+        await replay_until(spool, handler, replayed=3)
+        return spool, replayed
+
+    spool, replayed = asyncio.run(run())
+    assert replayed == [0, 1, 2]
+    assert spool.stats()["records"] == 0
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(DONE_SUFFIX)]
+    assert not any(os.path.getsize(os.path.join(tmp_path, name)) for name in os.listdir(tmp_path))
+
+
+def test_restart_resumes_after_done_records(tmp_path):
+    async def spool_and_replay_first():
+        spool = make_spool(tmp_path)
+        for index in range(3):
+            await spool.append(state_id="s1", query_states=[{"a": index}])
+
+        async def handler(record):
+            if record.query_states[0]["a"] > 0:
+                raise psycopg2.OperationalError("database down")
+
+        await replay_until(spool, handler, replayed=1)
+
+    async def replay_after_restart():
+        spool = make_spool(tmp_path)
+        replayed = []
+
+        async def handler(record):
+            replayed.append(record.query_states[0]["a"])
+
+        await replay_until(spool, handler, replayed=2)
+        return replayed
+
+    asyncio.run(spool_and_replay_first())
+    assert asyncio.run(replay_after_restart()) == [1, 2]
+
+
+def test_transient_errors_are_retried(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path)
+        await spool.append(state_id="s1", query_states=[{"a": 1}])
+        attempts = []
+
+        async def handler(record):
+            attempts.append(record.id)
+            if len(attempts) < 3:
+                raise psycopg2.OperationalError("database down")
+
+        await replay_until(spool, handler, replayed=1)
+        return spool, attempts
+
+    spool, attempts = asyncio.run(run())
+    assert len(attempts) == 3
+    assert spool.stats()["retries"] == 2
+    assert spool.stats()["dead"] == 0
+
+
+def test_records_are_dead_lettered_after_max_attempts(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path, max_attempts=2)
+        await spool.append(state_id="s1", query_states=[{"a": 1}])
+        await spool.append(state_id="s1", query_states=[{"a": 2}])
+        replayed = []
+
+        async def handler(record):
+            if record.query_states[0]["a"] == 1:
+                raise ConnectionError("database down")
+            replayed.append(record.query_states[0]["a"])
+
+        await replay_until(spool, handler, replayed=2)
+        return spool, replayed
+
+    spool, replayed = asyncio.run(run())
+    assert replayed == [2]
+    assert spool.stats()["dead"] == 1
+    assert spool.stats()["retries"] == 2
+    with open(os.path.join(tmp_path, DEAD_LETTER_FILE)) as file:
+        assert len(file.readlines()) == 1
+
+
+def test_non_transient_errors_are_dead_lettered_right_away(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path, max_attempts=20)
+        await spool.append(state_id="s1", query_states=[{"a": 1}])
+
+        async def handler(record):
+            raise ValueError("invalid row")
+
+        await replay_until(spool, handler, replayed=1)
+        return spool
+
+    spool = asyncio.run(run())
+    assert spool.stats()["dead"] == 1
+    assert spool.stats()["retries"] == 1
+
+
+def test_append_raises_once_budget_is_used_up(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path, max_bytes=200)
+        await spool.append(state_id="s1", query_states=[{"a": 1}])
+        with pytest.raises(SpoolFullError):
+            await spool.append(state_id="s1", query_states=[{"a": "x" * 200}])
+        return spool
+
+    assert asyncio.run(run()).stats()["rejected"] == 1
+
+
+def test_unreadable_lines_are_skipped(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path)
+        await spool.append(state_id="s1", query_states=[{"a": 1}])
+        with open(spool.segment_path(spool.segments[-1]), "ab") as file:
+            file.write(b'{"id": 1, "state_')        # torn by a crash
+        return make_spool(tmp_path).read_segment(spool.segments[-1])
+
+    assert [record.query_states for record in asyncio.run(run())] == [[{"a": 1}]]
+
+
+def test_is_transient_error():
+    def raised_from(error):
+        try:
+            raise error
+        except Exception as e:
+            try:
+                raise RuntimeError("write failed") from e
+            except RuntimeError as wrapped:
+                return wrapped
+
+    assert is_transient_error(psycopg2.OperationalError())
+    assert is_transient_error(psycopg2.InterfaceError())
+    assert is_transient_error(ConnectionRefusedError())
+    assert is_transient_error(asyncio.TimeoutError())
+    assert is_transient_error(raised_from(psycopg2.OperationalError()))
+    assert not is_transient_error(ValueError())
+    assert not is_transient_error(psycopg2.IntegrityError())
+    assert not is_transient_error(raised_from(ValueError()))
+
+
+def test_orphaned_spool_dirs_of_a_lower_worker_count(tmp_path):
+    async def spool_to(directory):
+        await make_spool(directory).append(state_id="s1", query_states=[{"a": 1}])
+
+    async def run():
+        for directory in (tmp_path, tmp_path / "worker-0", tmp_path / "worker-2", tmp_path / "worker-3"):
+            await spool_to(directory)
+        make_spool(tmp_path / "worker-4")       # no records
+
+    asyncio.run(run())
+    assert orphaned_spool_dirs(str(tmp_path), workers=3) == [str(tmp_path), str(tmp_path / "worker-3")]
+    assert orphaned_spool_dirs(str(tmp_path), workers=1) == \
+           [str(tmp_path / "worker-0"), str(tmp_path / "worker-2"), str(tmp_path / "worker-3")]
+    assert orphaned_spool_dirs(str(tmp_path / "missing"), workers=2) == []
+
+
+def test_drain_replays_an_orphaned_spool_and_returns(tmp_path):
+    async def run():
+        orphan = make_spool(tmp_path)
+        for index in range(3):
+            await orphan.append(state_id="s1", query_states=[{"a": index}])
+
+        replayed = []
+
+        async def handler(record):
+            replayed.append(record.query_states[0]["a"])
+
+        spool = make_spool(tmp_path)        # as reopened by the worker replaying it
+        await asyncio.wait_for(spool.replay(handler, drain=True), timeout=5)
+        return spool, replayed
+
+    spool, replayed = asyncio.run(run())
+    assert replayed == [0, 1, 2]
+    assert spool.records == 0
+    assert orphaned_spool_dirs(str(tmp_path), workers=2) == []
+
+
+def test_states_are_pending_until_their_records_are_replayed(tmp_path):
+    async def spool_records():
+        spool = make_spool(tmp_path)
+        for state_id in ["s1", "s1", "s2"]:
+            await spool.append(state_id=state_id, query_states=[{"a": 1}])
+
+        async def handler(record):
+            if record.state_id == "s2":
+                raise psycopg2.OperationalError("database down")
+
+        # the records of s1 are replayed, the one of s2 is left for the next start
+        await replay_until(spool, handler, replayed=2)
+        return spool
+
+    spool = asyncio.run(spool_records())
+    assert (spool.has_pending("s1"), spool.has_pending("s2")) == (False, True)
+
+    reopened = make_spool(tmp_path)
+    assert (reopened.has_pending("s1"), reopened.has_pending("s2")) == (False, True)
+    assert reopened.stats()["states"] == 1
@@ -0,0 +1,73 @@
+from ismcore.model.processor_state import State, StateConfig, StateDataColumnIndex, StateDataKeyDefinition, \
+    StateDataRowColumnData
+
+from state_cache import StateCache, StateDelta
+
+
+def make_state(rows: int, primary_key: bool = True) -> State:
+    config = StateConfig(name="s1", primary_key=[StateDataKeyDefinition(name="a")] if primary_key else None)
+    state = State(id="s1", config=config)
+    for index in range(rows):
+        state.apply_query_state(query_state={"a": f"v{index}", "b": index})
+    state.persisted_position = state.count - 1
+    return state
+
+
+def delta_of(stored: State, cached_count: int) -> StateDelta:
+    """The rows of the stored state after cached_count, as fetch_delta loads them, with a key mapping per row."""
+    return StateDelta(
+        count=stored.count,
+        columns=stored.columns,
+        data={name: StateDataRowColumnData(values=column.values[cached_count:]) for name, column in stored.data.items()},
+        mappings={f"key-{index}": StateDataColumnIndex(key=f"key-{index}", values=[index])
+                  for index in range(cached_count, stored.count)}
+    )
+
+
+def test_merge_delta_appends_rows_and_mappings():
+    cache = StateCache(storage=None)
+    cached, stored = make_state(5), make_state(8)
+
+    assert cache.merge_delta(cached, delta_of(stored, cached_count=5))
+    assert cached.count == 8
+    assert cached.persisted_position == 7
+    assert {name: column.values for name, column in cached.data.items()} == \
+           {name: column.values for name, column in stored.data.items()}
+    assert {key: cached.mapping[key].values for key in ("key-5", "key-6", "key-7")} == \
+           {"key-5": [5], "key-6": [6], "key-7": [7]}
+    assert cache.merged_rows == 3
+
+
+def test_merge_delta_without_new_rows_keeps_state():
+    cache = StateCache(storage=None)
+    cached = make_state(5)
+
+    assert cache.merge_delta(cached, StateDelta(count=5))
+    assert cached.count == 5
+    assert cache.merged_rows == 0
+
+
+def test_merge_delta_rejects_new_columns():
+    cache = StateCache(storage=None)
+    cached, stored = make_state(5), make_state(8)
+    stored.apply_query_state(query_state={"a": "v8", "b": 8, "c": True})
+
+    assert not cache.merge_delta(cached, delta_of(stored, cached_count=5))
+    assert cached.count == 5
+
+
+def test_merge_delta_rejects_shrunk_state():
+    cache = StateCache(storage=None)
+    cached = make_state(5)
+
+    assert not cache.merge_delta(cached, StateDelta(count=3))
+
+
+def test_merge_delta_skips_state_with_unsaved_rows():
+    cache = StateCache(storage=None)
+    cached, stored = make_state(5), make_state(8)
+    cached.apply_query_state(query_state={"a": "local", "b": -1})     # applied by a save still in flight
+
+    assert cache.merge_delta(cached, delta_of(stored, cached_count=5))
+    assert cached.count == 6
+    assert cache.merged_rows == 0
@@ -0,0 +1,284 @@
+import asyncio
+import copy
+import json
+import re
+
+import pytest
+from ismcore.model.processor_state import State, StateConfig, StateDataColumnDefinition, StateDataKeyDefinition
+from ismdb.state_storage import StateDatabaseStorage
+
+from async_storage import AsyncStorage
+from route_cache import TTLCache
+from state_tables import MIRRORED_ISMDB_VERSION, installed_ismdb_version
+from state_writer import StateWriter, StateWriteCoalescer, WriteSegment, BULK_MODES
+
+QUERY_STATES = [
+    {"input": f"q {i}", "score": i / 3, "flag": i % 2 == 0, "n": i,
+     "meta": {"i": i, "tags": ["a", "b\tc"]} if i != 2 else None,
+     "note": "tab\there, line\nbreak and back\\slash" if i == 1 else None}
+    for i in range(7)
+]
+
+
+def copy_field(text: str):
+    """Decode a field of the COPY text format."""
+    if text == '\\N':
+        return None
+    return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n', 'r': '\r'}.get(m.group(1), m.group(1)), text)
+
+
+def pg_text(value):
+    """The value of a TEXT column once postgres stores a psycopg2 adapted parameter."""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def pg_json(value):
+    """The value of a JSONB column once postgres stores a psycopg2 Json parameter (tuples become arrays)."""
+    return json.loads(json.dumps(value))
+
+
+class FakeCursor:
+    """Interprets the statements of the state tables against the in-memory tables of a fake database."""
+
+    def __init__(self, database: 'FakeDatabase', connection: 'FakeConnection'):
+        self.database = database
+        self.connection = connection
+        self.mogrified = []
+        self.staging = []
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def mogrify(self, template, args):
+        self.mogrified.append(tuple(args))
+        return f'@{len(self.mogrified) - 1}@'.encode()
+
+    def fetchone(self):
+        return self.result
+
+    def executemany(self, sql, batch):
+        for params in batch:
+            self.execute(sql, params)
+
+    def execute(self, sql, params=None):
+        sql = sql.decode() if isinstance(sql, bytes) else sql
+        rows = [self.mogrified[int(index)] for index in re.findall(r'@(\d+)@', sql)] or [params]
+        sql = ' '.join(re.sub(r'@\d+@,?', '', sql).split())
+        tables = self.database
+
+        if sql == 'BEGIN' or sql.startswith('CREATE TEMPORARY TABLE'):
+            return
+        elif sql.startswith('INSERT INTO state_column_data (column_id, data_index, data_value) VALUES'):
+            for column_id, data_index, value in rows:
+                tables.cells[(column_id, data_index)] = ('text', pg_text(value))
+        elif sql.startswith('INSERT INTO state_column_data (column_id, data_index, data_json_value) VALUES'):
+            for column_id, data_index, value in rows:
+                tables.cells[(column_id, data_index)] = ('json', pg_json(value.adapted if value is not None else None))
+        elif sql.startswith('INSERT INTO state_column_data (column_id, data_index, data_value) SELECT'):
+            for column_id, data_index, value, _, is_json in self.staging:
+                if not is_json:
+                    tables.cells[(column_id, data_index)] = ('text', value)
+        elif sql.startswith('INSERT INTO state_column_data (column_id, data_index, data_json_value) SELECT'):
+            for column_id, data_index, _, value, is_json in self.staging:
+                if is_json:
+                    tables.cells[(column_id, data_index)] = ('json', value)
+        elif sql.startswith('DELETE FROM state_column_data_staging'):
+            self.staging = []
+        elif sql.startswith('MERGE INTO state_column_data_mapping'):
+            tables.mappings.update(tuple(row) for row in rows)
+        elif sql.startswith('UPDATE state SET count = count + %s WHERE id = %s RETURNING count'):
+            rows, state_id = params
+            self.result = None
+            if state_id in tables.counts:
+                tables.counts[state_id] += rows
+                self.result = (tables.counts[state_id],)
+        elif sql.startswith('UPDATE state SET count = %s WHERE id = %s'):
+            count, state_id = params
+            tables.counts[state_id] = count
+        else:
+            raise AssertionError(f'unexpected statement: {sql}')
+
+    def copy_expert(self, sql, file):
+        for line in file.read().decode().splitlines():
+            column_id, data_index, value, json_value, is_json = [copy_field(field) for field in line.split('\t')]
+            self.staging.append((int(column_id), int(data_index), value,
+                                 json.loads(json_value) if json_value is not None else None, is_json == 't'))
+
+
+class FakeConnection:
+
+    def __init__(self, database: 'FakeDatabase'):
+        self.database = database
+        self.autocommit = True
+        self.encoding = 'UTF8'
+
+    def cursor(self):
+        return FakeCursor(self.database, self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeDatabase:
+    """
+    In-memory state tables, standing in for both the storage class (as seen by the state writer) and
+    the database state storage (as seen by append_state_data_direct of ismdb).
+    """
+
+    def __init__(self, state: State):
+        self.configs = {state.id: state.config}
+        self.columns = {state.id: copy.deepcopy(state.columns)}
+        self.counts = {state.id: state.count}
+        self.cells = {}
+        self.mappings = set()
+        self.next_column_id = 1 + max([column.id for column in state.columns.values()], default=0)
+        self.metadata_loads = 0
+        self.column_inserts = 0
+        self._delegate_state_storage = self
+
+    def load_state_metadata(self, state_id: str) -> State:
+        self.metadata_loads += 1
+        state = State(id=state_id, config=self.configs[state_id], count=self.counts[state_id],
+                      columns=copy.deepcopy(self.columns[state_id]))
+        state.persisted_position = state.count - 1
+        return state
+
+    def insert_state_columns(self, state: State, force_update: bool = False):
+        self.column_inserts += 1
+        for column in state.columns.values():
+            if column.id is None:
+                column.id = self.next_column_id
+                self.next_column_id += 1
+        self.columns[state.id] = copy.deepcopy(state.columns)
+
+    def create_connection(self):
+        return FakeConnection(self)
+
+    def release_connection(self, connection):
+        pass
+
+    def tables(self):
+        return self.cells, self.mappings, self.counts, \
+            {name: (column.id, column.data_type) for name, column in self.columns["s1"].items()}
+
+
+def make_database() -> FakeDatabase:
+    state = State(
+        id="s1",
+        count=2,
+        config=StateConfig(name="s1", storage_class="database", primary_key=[StateDataKeyDefinition(name="input")])
+    )
+    state.columns = {
+        "input": StateDataColumnDefinition(id=1, name="input"),
+        "calc": StateDataColumnDefinition(id=2, name="calc", value="query_state['n'] * 2 + len(route_id)",
+                                          callable=True),
+    }
+    return FakeDatabase(state)
+
+
+def ismdb_append(database: FakeDatabase, query_states: list, scope_variable_mappings: dict):
+    StateDatabaseStorage.append_state_data_direct(
+        database, state_id="s1", query_states=query_states, scope_variable_mappings=scope_variable_mappings)
+
+
+@pytest.mark.parametrize("bulk_mode", BULK_MODES)
+def test_writer_matches_ismdb_append(bulk_mode):
+    expected = make_database()
+    ismdb_append(expected, QUERY_STATES, {"route_id": "r1"})
+
+    database = make_database()
+    writer = StateWriter(storage=database, bulk_mode=bulk_mode, bulk_chunk_size=4)
+    state = writer.append("s1", [WriteSegment(QUERY_STATES, scope_variable_mappings={"route_id": "r1"})])
+
+    assert state.count == 2 + len(QUERY_STATES)
+    assert database.tables() == expected.tables()
+
+
+@pytest.mark.parametrize("bulk_mode", BULK_MODES)
+def test_coalesced_segments_match_ismdb_appends(bulk_mode):
+    first, second = QUERY_STATES[:3], QUERY_STATES[3:]
+    expected = make_database()
+    ismdb_append(expected, first, {"route_id": "r1"})
+    ismdb_append(expected, second, {"route_id": "route-2"})
+
+    database = make_database()
+    writer = StateWriter(storage=database, bulk_mode=bulk_mode, bulk_chunk_size=4)
+    writer.append("s1", [
+        WriteSegment(first, scope_variable_mappings={"route_id": "r1"}),
+        WriteSegment(second, scope_variable_mappings={"route_id": "route-2"}),
+    ])
+
+    assert database.tables() == expected.tables()
+
+
+@pytest.mark.parametrize("bulk_mode", BULK_MODES)
+def test_writer_appends_after_the_count_updated_under_the_lock(bulk_mode):
+    database = make_database()
+    load_state_metadata = database.load_state_metadata
+
+    def load_stale_state_metadata(state_id: str) -> State:
+        # another process appends 3 rows once the metadata is loaded, before the writer locks the state
+        state = load_state_metadata(state_id)
+        database.counts[state_id] += 3
+        return state
+
+    database.load_state_metadata = load_stale_state_metadata
+    writer = StateWriter(storage=database, bulk_mode=bulk_mode)
+    state = writer.append("s1", [WriteSegment(QUERY_STATES, scope_variable_mappings={"route_id": "r1"})])
+
+    assert state.count == database.counts["s1"] == 5 + len(QUERY_STATES)
+    assert state.persisted_position == state.count - 1
+    assert {data_index for _, data_index in database.cells} == set(range(5, 5 + len(QUERY_STATES)))
+    assert {data_index for _, _, data_index in database.mappings} == set(range(5, 5 + len(QUERY_STATES)))
+
+
+def test_writer_fails_for_a_missing_state():
+    database = make_database()
+    database.load_state_metadata = lambda state_id: State(id="s1", config=database.configs["s1"], count=2,
+                                                          columns=copy.deepcopy(database.columns["s1"]))
+    del database.counts["s1"]
+
+    with pytest.raises(ValueError):
+        StateWriter(storage=database).append("s1", [WriteSegment(QUERY_STATES, {"route_id": "r1"})])
+    assert not database.cells
+
+
+def test_coalescer_reuses_cached_state_metadata():
+    database = make_database()
+    cache = TTLCache(name="state_metadata")
+    coalescer = StateWriteCoalescer(storage=AsyncStorage(database), writer=StateWriter(database), state_metadata=cache)
+
+    async def write(rows: list):
+        return await coalescer.submit("s1", WriteSegment(rows, scope_variable_mappings={"route_id": "r1"}))
+
+    async def run():
+        for row in QUERY_STATES:
+            await write([row])
+        assert (database.metadata_loads, database.column_inserts) == (1, 2)    # "note" is a new column of row 1
+
+        # an edited state is loaded again, as is one whose write failed
+        cache.invalidate("s1")
+        await write(QUERY_STATES[:1])
+        with pytest.raises(ValueError):
+            await write([{"input": None}])      # a primary key without a value
+        await write(QUERY_STATES[:1])
+        return database.metadata_loads
+
+    assert asyncio.run(run()) == 3
+    assert database.counts["s1"] == 2 + len(QUERY_STATES) + 2
+
+
+def test_mirrored_ismdb_version_is_installed():
+    # the state tables mirror the append statements of this release, see state_tables.StateTables
+    assert installed_ismdb_version() == MIRRORED_ISMDB_VERSION
@@ -0,0 +1,82 @@
+import copy
+
+import pytest
+from ismcore.model.processor_state import State, StateConfig, StateDataColumnDefinition, StateDataKeyDefinition
+
+from transform import TransformPlan
+
+ROWS = [
+    {"Input": f"q {i}", "output": "o", "Score": i / 3, "index": i,
+     **({"extra col": 1} if i == 5 else {}), **({"nested": {"a": 1}} if i == 7 else {})}
+    for i in range(20)
+] + [{"Input": "q 3", "output": "o", "Score": 1, "index": 3}]     # a duplicate key, with a primary key
+
+CONFIGS = {
+    "plain": {},
+    "primary_key": {"primary_key": True},
+    "remap": {"remap": True},
+    "template": {"template": True},
+    "json_string": {"flatten": False},
+    "primary_key_json_string": {"primary_key": True, "flatten": False},
+}
+
+
+def make_state(primary_key: bool = False, remap: bool = False, template: bool = False, flatten: bool = True) -> State:
+    config = {"name": "s"}
+    if primary_key:
+        config["primary_key"] = [StateDataKeyDefinition(name="input"), StateDataKeyDefinition(name="index")]
+    if remap:
+        config["remap_query_state_columns"] = [StateDataKeyDefinition(name="score", alias="rating")]
+    if template:
+        config["template_columns"] = [StateDataKeyDefinition(name="output")]
+
+    state = State(
+        id="sid",
+        config=StateConfig(**config),
+        properties=None if flatten else {"persistence": {"flatten": "json_string"}}
+    )
+    state.columns = {
+        "const": StateDataColumnDefinition(name="const", value="K"),
+        "calc": StateDataColumnDefinition(name="calc", value="query_state['index'] * 2 + len(route_id)", callable=True),
+        "d": StateDataColumnDefinition(name="d", value="data['Input'] if data else 'x'", callable=True),
+    }
+    return state
+
+
+@pytest.mark.parametrize("entry_variable", [None, "data"])
+@pytest.mark.parametrize("skip_data_append", [True, False])
+@pytest.mark.parametrize("config", CONFIGS.values(), ids=list(CONFIGS))
+def test_plan_matches_apply_query_state(config, skip_data_append, entry_variable):
+    expected_state, state = make_state(**config), make_state(**config)
+    scope = {"route_id": "r1", "data": None}
+
+    expected = [
+        expected_state.apply_query_state(
+            query_state=copy.deepcopy(entry),
+            skip_data_append=skip_data_append,
+            scope_variable_mappings={**scope, "data": entry} if entry_variable else scope
+        )
+        for entry in ROWS
+    ]
+    plan = TransformPlan(state, scope_variable_mappings=scope, entry_variable=entry_variable)
+    rows = plan.apply(copy.deepcopy(ROWS), skip_data_append=skip_data_append)
+
+    assert rows == expected
+    assert state.columns == expected_state.columns
+    assert state.count == expected_state.count
+    assert (state.data or {}) == (expected_state.data or {})
+    assert state.mapping == expected_state.mapping
+
+
+def test_entry_variable_binds_each_entry():
+    state = make_state()
+    rows = TransformPlan(state, scope_variable_mappings={"route_id": "r1"}, entry_variable="data").apply(
+        [{"Input": "a", "index": 0}, {"Input": "b", "index": 1}])
+    assert [row["d"] for row in rows] == ["a", "b"]
+
+
+def test_invalid_expression_raises_value_error():
+    state = make_state()
+    state.columns["bad"] = StateDataColumnDefinition(name="bad", value="undefined_name + 1", callable=True)
+    with pytest.raises(ValueError):
+        TransformPlan(state, scope_variable_mappings={"route_id": "r1", "data": None}).apply([{"index": 0}])
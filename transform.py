@@ -0,0 +1,195 @@
+import functools
+import hashlib
+import math
+import random
+from typing import Any, Dict, List, Optional
+
+from ismcore.model.processor_state import State
+from ismcore.utils.evaluate import compile_code, hashit, now, now_utc
+from ismcore.utils.general_utils import clean_string_for_ddl_naming
+from ismcore.utils.ism_logger import ism_logger
+
+logger = ism_logger(__name__)
+
+
+@functools.lru_cache(maxsize=4096)
+def clean_name(name: str) -> str:
+    """clean_string_for_ddl_naming, cached, the same keys recur in every row of a state."""
+    return clean_string_for_ddl_naming(name)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expression(code: str):
+    return compile_code(code)
+
+
+def expression_globals() -> dict:
+    """The restricted globals of safer_evaluate, built once per batch rather than once per evaluation."""
+    from RestrictedPython.Eval import default_guarded_getitem, default_guarded_getiter
+    from RestrictedPython.Guards import guarded_iter_unpack_sequence, safe_builtins, safer_getattr
+    return {
+        "__builtins__": {
+            **safe_builtins,
+            'sum': sum,
+            'range': range,
+            'math': math,
+            'random': random,
+            'hashlib': hashlib,
+        },
+        '_getattr_': safer_getattr,
+        "_getitem_": default_guarded_getitem,
+        "_getiter_": default_guarded_getiter,
+        '_iter_unpack_sequence_': guarded_iter_unpack_sequence,
+        'hashit': hashit,
+        'now': now,
+        'utc': now_utc(),
+        'rand_hash': lambda x: hashit(str(random.random()) + str(x)),
+    }
+
+
+class TransformPlan:
+    """
+    The transformation of query states into rows of a state, compiled once per batch.
+
+    Equivalent to calling state.apply_query_state for each entry, but the per-row work that only
+    depends on the state and the scope variables is done once: column names are cleaned through a
+    cache, constant column values and the scope of callable columns are computed once, callable
+    expressions are compiled once and evaluated column by column, the state properties are parsed
+    once, and the columns are only rebuilt when a row brings keys the state does not have yet.
+
+    States with template columns or remapped columns that are not plain aliases, and rows with
+    nested values that are flattened, fall back to apply_query_state per row.
+
+    With entry_variable set (e.g. "data"), each entry is also bound to that scope variable of its
+    own row, as the standard mode does.
+    """
+
+    def __init__(self, state: State, scope_variable_mappings: dict = None, entry_variable: str = None):
+        self.state = state
+        config = state.config
+
+        # dynamic per-row transformations of the state configuration
+        remap = config.remap_query_state_columns if config else None
+        self.remap: Dict[str, str] = {}
+        self.per_row = bool(config and config.template_columns)
+        for key in remap or []:
+            if isinstance(key.alias, str) and key.alias:
+                self.remap[key.name] = key.alias
+            else:
+                self.per_row = True
+
+        self.flatten = state._should_flatten_on_save()
+        self.primary_key = state.flag_require_primary_key()
+        self.scope_variable_mappings = scope_variable_mappings or {}
+        self.entry_variable = entry_variable
+
+        # constant columns are computed once, callable columns are evaluated per row within a shared scope
+        self.constants: Dict[str, Any] = {}
+        self.callables: Dict[str, Any] = {}
+        for name, definition in (state.columns or {}).items():
+            if not definition.value:
+                continue
+            if definition.callable:
+                self.callables[name] = definition.value
+            else:
+                self.constants[name] = definition.value
+
+        self.scope: Optional[dict] = None
+        self.globals: Optional[dict] = None
+        if self.callables:
+            self.scope = {
+                **self.scope_variable_mappings,
+                "id": state.id,
+                "state_type": state.state_type,
+                "config": state.config
+            }
+            self.globals = expression_globals()
+
+    def scope_variables(self, entry: dict) -> dict:
+        if not self.entry_variable:
+            return self.scope_variable_mappings
+        return {**self.scope_variable_mappings, self.entry_variable: entry}
+
+    def evaluate(self, code: str, query_state: dict, entry: dict) -> Any:
+        # same scope and errors as build_column_value, the scope variables take precedence over query_state
+        allowed_vars = {"query_state": query_state, **self.scope}
+        if self.entry_variable:
+            allowed_vars[self.entry_variable] = entry
+        self.globals['utc'] = now_utc()
+        try:
+            return eval(compile_expression(code), self.globals, allowed_vars)
+        except NameError as ne:
+            raise ValueError(ne)
+        except Exception as e:
+            logger.warning(f'critical exception when trying to evaluate expression {code} with {e}')
+            raise ValueError(e)
+
+    def prepare(self, query_state: dict) -> Optional[dict]:
+        """Clean and remap the keys of an entry, None if it needs to be applied by the state itself."""
+        row = {}
+        for key, value in query_state.items():
+            name = clean_name(key)
+            row[self.remap.get(name, name)] = value
+
+        if self.flatten:
+            for value in row.values():
+                if isinstance(value, (dict, list)):
+                    return None
+        return row
+
+    def apply(self, query_states: List[dict], skip_data_append: bool = True) -> List[dict]:
+        """Transform the entries into rows, adding new columns to the state (and rows, unless skipped)."""
+        state = self.state
+        if self.per_row:
+            return [
+                state.apply_query_state(
+                    query_state=entry,
+                    skip_data_append=skip_data_append,
+                    scope_variable_mappings=self.scope_variables(entry)
+                )
+                for entry in query_states
+            ]
+
+        rows = [self.prepare(entry) for entry in query_states]
+        planned = [index for index, row in enumerate(rows) if row is not None]
+
+        # callable columns are evaluated column by column against the prepared rows, then merged with the constants
+        computed = {name: [self.evaluate(code, rows[index], query_states[index]) for index in planned]
+                    for name, code in self.callables.items()}
+        for position, index in enumerate(planned):
+            extra = {name: values[position] for name, values in computed.items()}
+            if self.constants or extra:
+                rows[index] = {**rows[index], **self.constants, **extra}
+
+        results = []
+        for entry, row in zip(query_states, rows):
+            if row is None:
+                results.append(state.apply_query_state(
+                    query_state=entry,
+                    skip_data_append=skip_data_append,
+                    scope_variable_mappings=self.scope_variables(entry)
+                ))
+                continue
+
+            if self.primary_key:
+                row = {clean_name(key): value for key, value in row.items()}
+                state_key, state_key_plain = state.build_row_key_from_query_state(query_state=row)
+                if state_key:
+                    row["state_key"] = state_key
+                    row["state_key_plain"] = state_key_plain
+
+                if state.has_query_state(query_state=row):
+                    results.append(row)
+                    continue
+
+            # only rows with keys the state has no column for change the columns
+            columns = state.columns
+            if not row or not columns or any(key not in columns for key in row):
+                state.process_and_add_columns(query_state=row)
+
+            if not skip_data_append:
+                state.process_and_add_row_data(query_state=row)
+                state.process_and_add_row_data_mapping(query_state=row)
+
+            results.append(row)
+        return results